@@ -0,0 +1,475 @@
+"""
+Headless run of the attribution analysis, without papermill, nbconvert or a Jupyter kernel.
+
+Runs the same steps as multi_touch_attribution.ipynb, driven by analysis_config.yaml: fetch the touches from the warehouse, separate the
+conversion events, group touches outside the top k, map and dedup touches, collect the journeys, and compute the Shapley, Markov,
+last touch and first touch values. The exploratory parts of the notebook (data distribution) are skipped, and the plots and the
+bootstrap stability analysis run only if asked. The notebook stays as the report layer.
+The steps shared with the notebook (fetching and cleaning up the touches) are in load_data.py and preprocessing.py, so both run the same code.
+With data.chunksize, the touches are read (and cleaned up, in the warehouse with data.pushdown) a chunk at a time and folded into an
+AttributionState per day, and the values are solved from the state, so the memory does not grow with the no:of users. Only first order Markov values are available then, and no bootstrap.
+With attribution_state.state_dir, the state of each day (journeys split by the day they end) is saved there along with the state of the
+analysis window (the last attribution_state.window_days days). With attribution_state.refresh, a run then reads only the touches of the
+users active since the previous run, refreshes the daily states and the window state with them, and solves the values from the window state
+(refresh_attribution_state). Touches that land late, with a timestamp before the previous run's max_date, are missed until a run without refresh.
+
+Outputs, in <output_path>/<run_id>/ (same as the notebook):
+    mta_values.parquet: Attribution values of each touch, by method. They are also written to the warehouse results table
+     (prediction_output_table_name in the credentials), if one is given.
+    attribution_state.npz: Counts behind the values, of the journeys that end in the window, mergeable across runs (AttributionState)
+    metrics.json: Row, journey and conversion counts of the run
+    pipeline_profile.json/csv: Time and memory of each stage
+
+Usage:
+    python attribution_runner.py --config config/analysis_config.yaml --credentials credentials.yaml --run_id 1657781887
+"""
+
+import os
+import copy
+import json
+import time
+import hashlib
+import logging
+import argparse
+from pathlib import Path
+from typing import Optional, Dict, List
+
+import yaml
+import pandas as pd
+
+from journeys import JourneyStore
+from preprocessing import EventEncoder, separate_conversions, label_conversions, get_events_type_mapping, process_raw_data
+from load_data import (fetch_touches, fetch_clean_touches, fetch_touch_chunks, fetch_clean_touch_chunks, fetch_active_user_touches,
+                       fetch_max_timestamp, fit_event_encoder, get_touches_table_name)
+from wh_connectors import get_pooled_connector
+from attribution_state import (AttributionState, AttributionStateStore, get_journey_periods, states_by_period, fold_states_by_period,
+                               get_window_state)
+from instrumentation import PipelineProfiler, count_rows
+from models import get_shapley_values, get_markov_attribution, get_rule_based_attribution, merge_dictionaries
+
+
+IMAGE_FORMAT = "png"
+METRICS_FILE_NAME = "metrics.json"
+
+
+def get_state_fingerprint(config: dict, creds: dict) -> str:
+    """Hash of the parts of the config (and of the touches table) that the attribution states depend on. Stored states with another
+    fingerprint can not be refreshed, and are rebuilt from all the touches."""
+    data_config, analysis_config = config["data"], config["analysis"]
+    state_inputs = {key: data_config.get(key) for key in ("primary_key_column", "events_column_name", "timestamp_column_name", "filter_columns",
+                                                        "conversion_event_name", "multi_conversion", "ignore_events", "min_date",
+                                                        "n_top_events", "group_events", "group_events_mapping")}
+    state_inputs.update({"table_name": get_touches_table_name(creds.get("data_warehouse") or {}),
+                         "min_event_interval_in_sec": analysis_config["min_event_interval_in_sec"],
+                         "rule_based": analysis_config.get("rule_based", {})})
+    return hashlib.sha256(json.dumps(state_inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+
+def get_state_meta(config: dict, creds: dict, vocabulary: List[str]) -> dict:
+    """meta.json of the stored states: config fingerprint, top k vocabulary (EventEncoder.vocabulary) and the max_date of the touches read"""
+    return {"fingerprint": get_state_fingerprint(config, creds), "vocabulary": vocabulary, "max_date": config["data"].get("max_date")}
+
+
+def get_window_start(max_date: Optional[str], window_days: Optional[int]) -> Optional[str]:
+    """First day of the analysis window, the last window_days days till max_date. None (all the days) if window_days is not set."""
+    if not window_days or max_date is None:
+        return None
+    return (pd.Timestamp(max_date).normalize() - pd.Timedelta(days=window_days - 1)).strftime("%Y-%m-%d")
+
+
+def get_daily_states(raw_touches: pd.DataFrame, config: dict, event_encoder: EventEncoder) -> Dict[str, AttributionState]:
+    """States of each day (attribution_state.states_by_period) of the raw touches of some users, cleaned up with the same steps as
+    run_attribution (separate_conversions, event_encoder, process_raw_data and label_conversions)."""
+    data_config, analysis_config = config["data"], config["analysis"]
+    primary_key_column = data_config["primary_key_column"]
+    events_column_name = data_config["events_column_name"]
+    timestamp_column_name = data_config["timestamp_column_name"]
+    converted_ts_col = f"converted_{timestamp_column_name}"
+    rule_based_config = analysis_config.get("rule_based", {})
+    event_data, conversion_timestamps = separate_conversions(raw_touches,
+                                                             primary_key_column,
+                                                             timestamp_column_name,
+                                                             events_column_name,
+                                                             data_config["conversion_event_name"],
+                                                             converted_ts_col,
+                                                             multi_conversion=data_config.get("multi_conversion", False))
+    event_data[events_column_name] = event_encoder.transform(event_data[events_column_name])
+    touches = process_raw_data(event_data,
+                               primary_key_column,
+                               timestamp_column_name,
+                               events_column_name,
+                               analysis_config["min_event_interval_in_sec"],
+                               data_config["filter_columns"],
+                               data_config["ignore_events"])
+    touches = label_conversions(touches, primary_key_column, conversion_timestamps, converted_ts_col)
+    return states_by_period(touches, primary_key_column, timestamp_column_name, events_column_name, converted_ts_col,
+                            position_weights=tuple(rule_based_config.get("position_weights", (0.4, 0.2, 0.4))),
+                            half_life_days=rule_based_config.get("half_life_days", 7))
+
+
+def refresh_attribution_state(config: dict,
+                              creds: dict,
+                              store: AttributionStateStore,
+                              window_start: Optional[str],
+                              profiler: PipelineProfiler) -> Optional[AttributionState]:
+    """Refreshes the daily states of the store with the touches since the previous run (data.max_date of its meta.json) till data.max_date,
+    and returns the refreshed window state. Only the touches of the users who have new touches are read (load_data.fetch_active_user_touches):
+    their journeys as the previous run saw them are removed from the stored days, their journeys with the new touches are added, and
+    the days that fell out of the window are subtracted from the window state (AttributionStateStore.refresh).
+    Touches that land in the warehouse after a run with a timestamp before its max_date are missed, until the states are rebuilt.
+
+    Returns:
+        Optional[AttributionState]: Refreshed window state. None if the store can not be refreshed (no states yet, or states of another config
+         or another top k vocabulary, which includes a default event named after the time when 'others' is one of the touches), in which
+         case the states should be rebuilt from all the touches.
+    """
+    meta = store.read_meta()
+    if meta is None or meta.get("max_date") is None or meta.get("fingerprint") != get_state_fingerprint(config, creds):
+        logging.info("No attribution states of the same config to refresh. They are rebuilt from all the touches.")
+        return None
+    event_encoder = fit_event_encoder(config, creds)
+    if event_encoder.vocabulary != meta["vocabulary"]:
+        logging.info("The top k touches changed since the attribution states were computed. They are rebuilt from all the touches.")
+        return None
+    timestamp_column_name = config["data"]["timestamp_column_name"]
+    with profiler.span("fetch_active_user_touches") as span:
+        raw_touches = fetch_active_user_touches(config, creds, meta["max_date"])
+        span.rows_out = len(raw_touches)
+    with profiler.span("refresh_attribution_state", rows_in=raw_touches) as span:
+        old_touches = raw_touches[pd.to_datetime(raw_touches[timestamp_column_name]) <= pd.Timestamp(meta["max_date"])]
+        window_state = store.refresh(get_daily_states(old_touches, config, event_encoder),
+                                     get_daily_states(raw_touches, config, event_encoder),
+                                     window_start,
+                                     {**meta, "max_date": config["data"]["max_date"]})
+        span.rows_out = int(window_state.n_conversions + window_state.n_dropoffs)
+    return window_state
+
+
+def fold_touch_chunks(config: dict, creds: dict, event_encoder: Optional[EventEncoder], profiler: PipelineProfiler) -> Dict[str, AttributionState]:
+    """Folds the touches, read data.chunksize rows at a time (load_data.fetch_clean_touch_chunks with data.pushdown, and
+    load_data.fetch_touch_chunks otherwise), into the state of each day (attribution_state.fold_states_by_period).
+    event_encoder is load_data.fit_event_encoder's. It is optional with data.pushdown, where it only names the default event."""
+    data_config = config["data"]
+    rule_based_config = config["analysis"].get("rule_based", {})
+    with profiler.span("fold_touch_chunks") as span:
+        if data_config.get("pushdown", False):
+            touch_chunks = fetch_clean_touch_chunks(config, creds, event_encoder.default_event if event_encoder is not None else None)
+        else:
+            touch_chunks = fetch_touch_chunks(config, creds, event_encoder)
+        states = fold_states_by_period(touch_chunks,
+                                       data_config["primary_key_column"],
+                                       data_config["timestamp_column_name"],
+                                       data_config["events_column_name"],
+                                       f"converted_{data_config['timestamp_column_name']}",
+                                       position_weights=tuple(rule_based_config.get("position_weights", (0.4, 0.2, 0.4))),
+                                       half_life_days=rule_based_config.get("half_life_days", 7))
+        span.rows_out = len(states)
+    return states
+
+
+def solve_attribution_state(state: AttributionState, profiler: PipelineProfiler, make_plots: bool = False) -> Dict[str, Optional[dict]]:
+    """Solves the attribution values of each method from the state alone (Shapley, first order Markov and the rule based methods).
+
+    Returns:
+        Dict[str, Optional[dict]]: Values of each method (None if it failed)
+    """
+    with profiler.span("shapley") as span:
+        values = {"shap": state.get_shapley_values()}
+        span.rows_out = len(values["shap"])
+    try:
+        with profiler.span("markov") as span:
+            values["markov"], _ = state.get_markov_attribution(solver="sherman_morrison", visualize=make_plots)
+            span.rows_out = len(values["markov"])
+    except Exception as e:
+        logging.error(f"Markov attribution failed: {e}")
+        values["markov"] = None
+    with profiler.span("rule_based") as span:
+        values.update(state.get_rule_based_attribution())
+        span.rows_out = len(state.vocabulary)
+    return values
+
+
+def run_attribution(config: dict,
+                    creds: dict,
+                    run_id: Optional[str] = None,
+                    output_path: str = "data",
+                    mode: str = "local",
+                    make_plots: bool = False,
+                    run_stability: bool = False,
+                    raw_data: Optional[pd.DataFrame] = None,
+                    write_results: bool = True) -> pd.DataFrame:
+    """Runs the attribution analysis end to end, as in multi_touch_attribution.ipynb, and writes the outputs to output_path/run_id.
+
+    Args:
+        config (dict): Analysis config (analysis_config.yaml)
+        creds (dict): Warehouse credentials (credentials.yaml)
+        run_id (Optional[str], optional): Id of the run, and name of its output folder. Defaults to the current epoch time.
+        output_path (str, optional): Folder under which the run's output folder is created. Defaults to "data".
+        mode (str, optional): "local" or "container". The query cache is used only locally. Defaults to "local".
+        make_plots (bool, optional): Whether to save the transition probabilities and results summary plots. Defaults to False.
+        run_stability (bool, optional): Whether to run the bootstrap stability analysis (config analysis.bootstrap), and save the
+         confidence intervals as csv files. Defaults to False.
+        raw_data (Optional[pd.DataFrame], optional): Touches, if already fetched. If None, they are read from the warehouse, already
+         cleaned up there if data.pushdown is set. Defaults to None.
+        write_results (bool, optional): Whether to write the values to the warehouse results table, if the credentials name one.
+         Rows of the same run_id are replaced. Defaults to True.
+
+    Returns:
+        pd.DataFrame: Attribution values, with touches as rows and methods as columns (same as mta_values in the notebook)
+    """
+    run_id = str(run_id) if run_id else str(int(time.time()))
+    state_config = config.get("attribution_state") or {}
+    store = AttributionStateStore(state_config["state_dir"]) if state_config.get("state_dir") else None
+    if store is not None and config["data"].get("max_date") is None:
+        # The states record the latest touch they have seen, so that the next refresh reads only what came after
+        config = copy.deepcopy(config)
+        config["data"]["max_date"] = fetch_max_timestamp(config, creds) if raw_data is None else str(raw_data[config["data"]["timestamp_column_name"]].max())
+    data_config, analysis_config = config["data"], config["analysis"]
+    primary_key_column = data_config["primary_key_column"]
+    events_column_name = data_config["events_column_name"]
+    timestamp_column_name = data_config["timestamp_column_name"]
+    conversion_event_name = data_config["conversion_event_name"]
+    events_type_mapping = get_events_type_mapping(data_config["group_events_mapping"])
+    rule_based_config = analysis_config.get("rule_based", {})
+    position_weights = tuple(rule_based_config.get("position_weights", (0.4, 0.2, 0.4)))
+    half_life_days = rule_based_config.get("half_life_days", 7)
+    window_start = get_window_start(data_config.get("max_date"), state_config.get("window_days"))
+
+    output_directory = os.path.join(output_path, run_id)
+    Path(output_directory).mkdir(parents=True, exist_ok=True)
+    logging.info(f"All the output files will be saved to following location: {output_directory}")
+    profiler = PipelineProfiler(run_id, trace_memory=(config.get("instrumentation") or {}).get("trace_memory", False))
+    metrics = {"run_id": run_id, "max_date": data_config.get("max_date"), "window_start": window_start}
+
+    state = None
+    if raw_data is None and store is not None and state_config.get("refresh", False):
+        if analysis_config.get("markov_order", 1) != 1 or run_stability:
+            raise ValueError("attribution_state.refresh supports neither analysis.markov_order above 1 nor the bootstrap stability analysis")
+        state = refresh_attribution_state(config, creds, store, window_start, profiler)
+        metrics["refreshed_state"] = state is not None
+    if state is None and raw_data is None and data_config.get("chunksize"):
+        if analysis_config.get("markov_order", 1) != 1 or run_stability:
+            raise ValueError("data.chunksize supports neither analysis.markov_order above 1 nor the bootstrap stability analysis")
+        # With data.pushdown, only for the meta of the stored states
+        event_encoder = fit_event_encoder(config, creds) if store is not None or not data_config.get("pushdown", False) else None
+        states = fold_touch_chunks(config, creds, event_encoder, profiler)
+        if store is not None:
+            state = store.rebuild(states, window_start, get_state_meta(config, creds, event_encoder.vocabulary), position_weights, half_life_days)
+        else:
+            state = get_window_state(states, window_start, position_weights, half_life_days)
+    if state is not None:
+        values = solve_attribution_state(state, profiler, make_plots)
+        metrics.update({"n_converted_journeys": int(state.n_conversions),
+                        "n_non_converted_journeys": int(state.n_dropoffs),
+                        "n_touches": len(state.vocabulary),
+                        "total_conversions": state.n_conversions,
+                        "markov_succeeded": values["markov"] is not None})
+        if make_plots and values["markov"] is not None:
+            import matplotlib.pyplot as plt
+            plt.savefig(os.path.join(output_directory, f"markov_transition_probabilities.{IMAGE_FORMAT}"))
+            plt.close("all")
+        return write_outputs(merge_dictionaries(list(values.values()), list(values.keys())), state, metrics, profiler, output_directory,
+                             config, creds, run_id, make_plots, write_results)
+
+    converted_ts_col = f"converted_{timestamp_column_name}"
+    if raw_data is None and data_config.get("pushdown", False):
+        # Conversion separation, top k, event grouping, dedup and ignore_events all run in the warehouse. With stored states, the top k
+        # is read first for their meta, and the default event gets the same name in the warehouse.
+        state_event_encoder = fit_event_encoder(config, creds) if store is not None else None
+        with profiler.span("fetch_clean_touches") as span:
+            touch_data_filtered, conversion_timestamps = fetch_clean_touches(config, creds, mode,
+                                                                             state_event_encoder.default_event if state_event_encoder else None)
+            span.rows_out = len(touch_data_filtered)
+        event_encoder = EventEncoder()
+        touch_data_filtered[events_column_name] = event_encoder.fit_transform(touch_data_filtered[events_column_name])
+    else:
+        if raw_data is None:
+            with profiler.span("fetch_data") as span:
+                raw_data = fetch_touches(config, creds, mode)
+                span.rows_out = len(raw_data)
+        metrics["n_raw_rows"] = len(raw_data)
+
+        with profiler.span("separate_conversion_events", rows_in=raw_data) as span:
+            event_data, conversion_timestamps = separate_conversions(raw_data,
+                                                                     primary_key_column,
+                                                                     timestamp_column_name,
+                                                                     events_column_name,
+                                                                     conversion_event_name,
+                                                                     converted_ts_col,
+                                                                     multi_conversion=data_config.get("multi_conversion", False))
+            span.rows_out = len(event_data)
+
+        # Top k folding and the event grouping, as a categorical column over the encoder's vocabulary
+        with profiler.span("encode_events", rows_in=event_data) as span:
+            event_encoder = EventEncoder(top_k=data_config["n_top_events"], mapping=events_type_mapping if data_config["group_events"] else None)
+            event_data[events_column_name] = event_encoder.fit_transform(event_data[events_column_name])
+            span.rows_out = len(event_encoder.vocabulary)
+
+        with profiler.span("process_raw_data", rows_in=event_data) as span:
+            touch_data_filtered = process_raw_data(event_data,
+                                                   primary_key_column,
+                                                   timestamp_column_name,
+                                                   events_column_name,
+                                                   analysis_config["min_event_interval_in_sec"],
+                                                   data_config["filter_columns"],
+                                                   data_config["ignore_events"])
+            span.rows_out = len(touch_data_filtered)
+    metrics["n_touch_rows"] = len(touch_data_filtered)
+
+    with profiler.span("label_conversions", rows_in=touch_data_filtered) as span:
+        touch_data_filtered = label_conversions(touch_data_filtered, primary_key_column, conversion_timestamps, converted_ts_col)
+        span.rows_out = len(touch_data_filtered)
+
+    # One state per day, before the touches are cut to the window, so that later runs can refresh them
+    try:
+        with profiler.span("daily_states", rows_in=touch_data_filtered) as span:
+            states = states_by_period(touch_data_filtered, primary_key_column, timestamp_column_name, events_column_name, converted_ts_col,
+                                      position_weights=position_weights, half_life_days=half_life_days)
+            span.rows_out = len(states)
+        if store is not None:
+            vocabulary = state_event_encoder.vocabulary if raw_data is None and data_config.get("pushdown", False) else event_encoder.vocabulary
+            state = store.rebuild(states, window_start, get_state_meta(config, creds, vocabulary), position_weights, half_life_days)
+        else:
+            state = get_window_state(states, window_start, position_weights, half_life_days)
+    except Exception as e:
+        logging.error(f"Computing the attribution state failed: {e}")
+        state = None
+    if window_start is not None:
+        # Journeys that end in the window, same as the window state
+        journey_periods = get_journey_periods(touch_data_filtered, primary_key_column, timestamp_column_name, converted_ts_col)
+        touch_data_filtered = touch_data_filtered[touch_data_filtered[primary_key_column].map(journey_periods >= window_start).fillna(False).to_numpy(bool)]
+
+    with profiler.span("collect_journeys", rows_in=touch_data_filtered) as span:
+        is_converted = touch_data_filtered["is_converted"] == 1
+        journeys_pos = JourneyStore.from_dataframe(touch_data_filtered[is_converted], primary_key_column, timestamp_column_name, events_column_name)
+        journeys_neg = JourneyStore.from_dataframe(touch_data_filtered[~is_converted], primary_key_column, timestamp_column_name, events_column_name)
+        span.rows_out = len(journeys_pos) + len(journeys_neg)
+
+    with profiler.span("compress_journeys", rows_in=len(journeys_pos) + len(journeys_neg)) as span:
+        paths_pos = journeys_pos.compress()
+        paths_neg = journeys_neg.compress()
+        span.rows_out = len(paths_pos) + len(paths_neg)
+    all_touches = event_encoder.observed(touch_data_filtered[events_column_name])
+    metrics.update({"n_converted_journeys": len(journeys_pos),
+                    "n_non_converted_journeys": len(journeys_neg),
+                    "n_distinct_converted_paths": len(paths_pos),
+                    "n_distinct_non_converted_paths": len(paths_neg),
+                    "n_touches": len(all_touches)})
+
+    with profiler.span("shapley", rows_in=paths_pos) as span:
+        touches_shapley_values = get_shapley_values(paths_pos)
+        span.rows_out = count_rows(touches_shapley_values)
+
+    try:
+        with profiler.span("markov", rows_in=len(paths_pos) + len(paths_neg)) as span:
+            markov_attribution_values, _ = get_markov_attribution(paths_pos,
+                                                                  paths_neg,
+                                                                  all_touches,
+                                                                  visualize=make_plots,
+                                                                  solver="sherman_morrison",
+                                                                  sparse=len(all_touches) > 200,
+                                                                  order=analysis_config.get("markov_order", 1))
+            span.rows_out = len(markov_attribution_values)
+        if make_plots:
+            import matplotlib.pyplot as plt
+            plt.savefig(os.path.join(output_directory, f"markov_transition_probabilities.{IMAGE_FORMAT}"))
+            plt.close("all")
+    except Exception as e:
+        logging.error(f"Markov attribution failed: {e}")
+        markov_attribution_values = None
+    metrics["markov_succeeded"] = markov_attribution_values is not None
+
+    # Uncompressed journeys, as time decay needs the touch timestamps
+    with profiler.span("rule_based", rows_in=journeys_pos) as span:
+        rule_based_results = get_rule_based_attribution(journeys_pos, position_weights=position_weights, half_life_days=half_life_days)
+        span.rows_out = len(journeys_pos.vocabulary)
+
+    mta_values = merge_dictionaries([touches_shapley_values, markov_attribution_values] + list(rule_based_results.values()),
+                                    ['shap', 'markov'] + list(rule_based_results.keys()))
+    metrics["total_conversions"] = paths_pos.total_weight
+
+    if run_stability:
+        from stability import bootstrap_attribution
+        bootstrap_config = analysis_config["bootstrap"]
+        with profiler.span("bootstrap", rows_in=len(journeys_pos) + len(journeys_neg)):
+            bootstrap_results = bootstrap_attribution(journeys_pos,
+                                                      journeys_neg,
+                                                      all_touches,
+                                                      n_iter=bootstrap_config["n_iter"],
+                                                      frac=bootstrap_config["frac"],
+                                                      n_jobs=bootstrap_config["n_jobs"])
+        for method, results in bootstrap_results.items():
+            results["intervals"].to_csv(os.path.join(output_directory, f"bootstrap_{method}_intervals.csv"))
+    return write_outputs(mta_values, state, metrics, profiler, output_directory, config, creds, run_id, make_plots, write_results)
+
+
+def write_outputs(mta_values: pd.DataFrame,
+                  state: Optional[AttributionState],
+                  metrics: dict,
+                  profiler: PipelineProfiler,
+                  output_directory: str,
+                  config: dict,
+                  creds: dict,
+                  run_id: str,
+                  make_plots: bool,
+                  write_results: bool) -> pd.DataFrame:
+    """Writes the values (to output_directory, and to the warehouse results table if write_results), the results summary plot,
+    the metrics, the profile and the state of a run. Returns mta_values."""
+    mta_values.to_parquet(os.path.join(output_directory, "mta_values.parquet"))
+    wh_config = creds.get("data_warehouse") or {}
+    results_table = wh_config.get("prediction_output_table_name")
+    if write_results and results_table:
+        results_df = mta_values.rename_axis(config["data"]["events_column_name"]).reset_index()
+        with profiler.span("write_results", rows_in=results_df):
+            get_pooled_connector(wh_config, creds.get("aws")).bulk_write(results_df, f"{wh_config.get('schema')}.{results_table}", run_id=run_id)
+        metrics["results_table"] = f"{wh_config.get('schema')}.{results_table}"
+
+    if make_plots:
+        import seaborn as sns
+        import matplotlib.pyplot as plt
+        mta_long = pd.melt(mta_values.reset_index(), 'index', list(mta_values))
+        mta_long.columns = ['touch', 'method', 'attribution']
+        plt.figure(figsize=(16, 6))
+        sns.barplot(data=mta_long, x='touch', y='attribution', hue='method')
+        plt.xticks(rotation=90)
+        plt.savefig(os.path.join(output_directory, f"results_summary.{IMAGE_FORMAT}"))
+        plt.close("all")
+
+    with open(os.path.join(output_directory, METRICS_FILE_NAME), "w") as f:
+        json.dump(metrics, f, indent=2)
+    profiler.save(output_directory)
+    # Written last, so that a failure here does not leave the run without its metrics and profile
+    if state is not None:
+        try:
+            state.save(os.path.join(output_directory, "attribution_state.npz"))
+        except Exception as e:
+            logging.error(f"Saving the attribution state failed: {e}")
+    logging.info(f"Attribution values written to {output_directory}")
+    return mta_values
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Runs the multi touch attribution analysis without the notebook")
+    arg_parser.add_argument("--mode", type=str, default="local", help="local or container")
+    arg_parser.add_argument("--config", type=str, default=None,
+                            help="Analysis config. Defaults to config/analysis_config.yaml locally, and to the processing job's config path in a container")
+    arg_parser.add_argument("--credentials", type=str, default=None, help="Warehouse credentials. Defaults to the path in the config for the mode")
+    arg_parser.add_argument("--run_id", type=str, default=None, help="Defaults to the current epoch time")
+    arg_parser.add_argument("--output_path", type=str, default="data")
+    arg_parser.add_argument("--plots", action="store_true", help="Saves the transition probabilities and results summary plots")
+    arg_parser.add_argument("--stability", action="store_true", help="Runs the bootstrap stability analysis")
+    arg_parser.add_argument("--no_write_back", action="store_true", help="Skips writing the values to the warehouse results table")
+    args = arg_parser.parse_args()
+
+    Path("logs").mkdir(exist_ok=True)
+    logging.basicConfig(filename=os.path.join("logs", "multi_touch_attribution.log"),
+                        level=logging.INFO,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    config_path = args.config or ("config/analysis_config.yaml" if args.mode == "local" else "/opt/ml/processing/code/config/analysis_config.yaml")
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+    with open(args.credentials or config["mode"][args.mode]["wh_credentials_path"], "r") as f:
+        creds = yaml.safe_load(f)
+    mta_values = run_attribution(config, creds, args.run_id, args.output_path, args.mode, args.plots, args.stability,
+                                 write_results=not args.no_write_back)
+    print(mta_values)
@@ -0,0 +1,535 @@
+"""
+Mergeable sufficient statistics of the attribution models, for incremental (ex: daily) updates.
+
+All the models depend on the journeys only through counts that add up across sets of journeys:
+- Markov: transition counts of converted and non converted journeys
+- Shapley: sum over the converted journeys of each touch of the journey's contribution split equally among its distinct touches
+  (see models.shapley_values_from_journeys)
+- Rule based methods (first/last touch, linear, position based, time decay): credits of the converted journeys summed up per touch
+  (see models.get_rule_based_totals)
+
+An AttributionState holds these counts for a set of journeys, tagged with the periods (ex: days) they came from. States of disjoint periods
+can be added, and a period can be subtracted again once it falls out of the analysis window. The attribution values are then solved from
+the state alone, without going back to the raw touches.
+
+The counts are additive only if each journey belongs to exactly one period. Journeys are assigned to the day in which they end
+(get_journey_periods: conversion date for converted journeys, date of the last touch otherwise), and a non converted journey that continues
+in a later day is subtracted from its old day before being added to the new one (AttributionStateStore.refresh).
+
+The same sums fold the touches of a query that is read in chunks (fold_states_by_period over journeys.iter_user_chunks), so the
+values of any no:of users can be solved with one chunk of touches in memory at a time.
+
+AttributionStateStore keeps one state file per day under a folder, along with the state of the analysis window (the last window_days days).
+A daily run then reads only the touches of the users active since the previous run, and solves the values from the refreshed window state.
+"""
+
+import os
+import json
+import shutil
+from glob import glob
+from typing import Dict, List, Optional, Tuple, Iterable
+
+import numpy as np
+import pandas as pd
+
+from journeys import JourneyStore
+from models import (RULE_BASED_METHODS, shapley_values_from_journeys, generate_transition_counts, drop_unvisited_touches,
+                    get_markov_attribution_from_counts, get_rule_based_totals, get_rule_based_attribution_from_totals)
+
+
+STATE_FORMAT_VERSION = 3
+DEFAULT_POSITION_WEIGHTS = (0.4, 0.2, 0.4)
+DEFAULT_HALF_LIFE_DAYS = 7.
+
+# Shapley shares below this are treated as zero (touches whose journeys were all subtracted, up to float round off)
+SHARE_TOLERANCE = 1e-9
+
+
+class AttributionState:
+    def __init__(self,
+                 vocabulary: List[str],
+                 pos_transitions: np.ndarray,
+                 neg_transitions: np.ndarray,
+                 shapley_shares: np.ndarray,
+                 rule_based_totals: np.ndarray,
+                 n_conversions: float,
+                 n_dropoffs: float,
+                 periods: Iterable[str] = (),
+                 rule_based_methods: Iterable[str] = RULE_BASED_METHODS,
+                 position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+                 half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> None:
+        """
+        Args:
+            vocabulary (List[str]): Sorted touch names. All the arrays are indexed in this order.
+            pos_transitions (np.ndarray): Transition counts of converted journeys, states ordered as (Start, vocabulary..., Dropoff, Converted)
+            neg_transitions (np.ndarray): Transition counts of non converted journeys, same order as pos_transitions
+            shapley_shares (np.ndarray): Shapley value of each touch over the converted journeys
+            rule_based_totals (np.ndarray): Attributed conversions of each touch under each of rule_based_methods, of shape
+             (len(rule_based_methods), len(vocabulary))
+            n_conversions (float): No:of converted journeys
+            n_dropoffs (float): No:of non converted journeys
+            periods (Iterable[str], optional): Labels of the periods included in the state. Defaults to ().
+            rule_based_methods (Iterable[str], optional): Methods of the rows of rule_based_totals. Defaults to RULE_BASED_METHODS.
+            position_weights (Tuple[float, float, float], optional): position_based weights the totals were computed with. Defaults to (0.4, 0.2, 0.4).
+            half_life_days (float, optional): time_decay half life the totals were computed with. Defaults to 7.
+        """
+        self.vocabulary = list(vocabulary)
+        self.pos_transitions = np.asarray(pos_transitions, dtype=np.float64)
+        self.neg_transitions = np.asarray(neg_transitions, dtype=np.float64)
+        self.shapley_shares = np.asarray(shapley_shares, dtype=np.float64)
+        self.rule_based_methods = list(rule_based_methods)
+        self.rule_based_totals = np.asarray(rule_based_totals, dtype=np.float64).reshape(len(self.rule_based_methods), len(self.vocabulary))
+        self.n_conversions = float(n_conversions)
+        self.n_dropoffs = float(n_dropoffs)
+        self.periods = sorted(set(periods))
+        self.position_weights = tuple(float(weight) for weight in position_weights)
+        self.half_life_days = float(half_life_days)
+
+    @classmethod
+    def from_journeys(cls,
+                      journeys_pos: JourneyStore,
+                      journeys_neg: JourneyStore,
+                      period: Optional[str] = None,
+                      position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+                      half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> "AttributionState":
+        """Computes the state of a set of converted and non converted journeys (plain or compressed stores).
+        Compressed stores do not have the touch timestamps, so their state has no time_decay totals.
+
+        Args:
+            journeys_pos (JourneyStore): Converted journeys
+            journeys_neg (JourneyStore): Non converted journeys
+            period (Optional[str], optional): Label of the period of these journeys, ex: '2022-07-14'. Defaults to None.
+            position_weights (Tuple[float, float, float], optional): See models.get_touch_credits. Defaults to (0.4, 0.2, 0.4).
+            half_life_days (float, optional): See models.get_touch_credits. Defaults to 7.
+
+        Returns:
+            AttributionState: State of the journeys
+        """
+        vocabulary = sorted(set(np.asarray(journeys_pos.vocabulary, dtype=object)[np.unique(journeys_pos.codes)])
+                            | set(np.asarray(journeys_neg.vocabulary, dtype=object)[np.unique(journeys_neg.codes)]))
+        # Before the compression, which drops the timestamps time_decay needs
+        rule_based_totals = get_rule_based_totals(journeys_pos, RULE_BASED_METHODS, position_weights, half_life_days)
+        rule_based_totals = rule_based_totals.reindex(columns=vocabulary, fill_value=0.)
+        journeys_pos, journeys_neg = journeys_pos.compress(), journeys_neg.compress()
+        pos_transitions, _ = generate_transition_counts(journeys_pos, vocabulary, is_positive=True)
+        neg_transitions, _ = generate_transition_counts(journeys_neg, vocabulary, is_positive=False)
+        pos_codes = journeys_pos.codes_for(vocabulary)
+        shapley_shares = shapley_values_from_journeys(pos_codes, journeys_pos.offsets, len(vocabulary), journeys_pos.weights)
+        return cls(vocabulary, pos_transitions, neg_transitions, shapley_shares, rule_based_totals.to_numpy(),
+                   journeys_pos.total_weight, journeys_neg.total_weight,
+                   periods=[] if period is None else [period],
+                   rule_based_methods=list(rule_based_totals.index),
+                   position_weights=position_weights,
+                   half_life_days=half_life_days)
+
+    @classmethod
+    def empty(cls,
+              vocabulary: Optional[List[str]] = None,
+              position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+              half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> "AttributionState":
+        vocabulary = sorted(vocabulary or [])
+        n_states = len(vocabulary) + 3
+        return cls(vocabulary, np.zeros((n_states, n_states)), np.zeros((n_states, n_states)), np.zeros(len(vocabulary)),
+                   np.zeros((len(RULE_BASED_METHODS), len(vocabulary))), 0, 0,
+                   position_weights=position_weights, half_life_days=half_life_days)
+
+    def __repr__(self) -> str:
+        return (f"AttributionState(vocabulary_size={len(self.vocabulary)}, conversions={self.n_conversions:g}, "
+                f"dropoffs={self.n_dropoffs:g}, periods={len(self.periods)})")
+
+    def with_vocabulary(self, vocabulary: List[str]) -> "AttributionState":
+        """Re-indexes the state on a larger (sorted) vocabulary. Touches not in the state get zero counts."""
+        vocabulary = sorted(vocabulary)
+        positions = pd.Index(vocabulary).get_indexer(self.vocabulary)
+        if (positions < 0).any():
+            raise ValueError("New vocabulary should contain all the touches of the state")
+        n_states = len(vocabulary) + 3
+        states = np.concatenate([[0], positions + 1, [n_states - 2, n_states - 1]])
+        pos_transitions = np.zeros((n_states, n_states))
+        neg_transitions = np.zeros((n_states, n_states))
+        pos_transitions[np.ix_(states, states)] = self.pos_transitions
+        neg_transitions[np.ix_(states, states)] = self.neg_transitions
+        shapley_shares = np.zeros(len(vocabulary))
+        shapley_shares[positions] = self.shapley_shares
+        rule_based_totals = np.zeros((len(self.rule_based_methods), len(vocabulary)))
+        rule_based_totals[:, positions] = self.rule_based_totals
+        return AttributionState(vocabulary, pos_transitions, neg_transitions, shapley_shares, rule_based_totals,
+                                self.n_conversions, self.n_dropoffs, self.periods, self.rule_based_methods,
+                                self.position_weights, self.half_life_days)
+
+    def _combine(self, other: "AttributionState", sign: int) -> "AttributionState":
+        if (self.position_weights, self.half_life_days) != (other.position_weights, other.half_life_days):
+            raise ValueError("States computed with different position_weights or half_life_days can not be combined")
+        vocabulary = sorted(set(self.vocabulary) | set(other.vocabulary))
+        left, right = self.with_vocabulary(vocabulary), other.with_vocabulary(vocabulary)
+        periods = set(self.periods) | set(other.periods) if sign > 0 else set(self.periods) - set(other.periods)
+        # A method missing on either side (time_decay of compressed journeys) can not be computed for the combined journeys
+        methods = [method for method in left.rule_based_methods if method in right.rule_based_methods]
+        rule_based_totals = (left.rule_based_totals[[left.rule_based_methods.index(method) for method in methods]]
+                             + sign * right.rule_based_totals[[right.rule_based_methods.index(method) for method in methods]])
+        return AttributionState(vocabulary,
+                                left.pos_transitions + sign * right.pos_transitions,
+                                left.neg_transitions + sign * right.neg_transitions,
+                                left.shapley_shares + sign * right.shapley_shares,
+                                rule_based_totals,
+                                left.n_conversions + sign * right.n_conversions,
+                                left.n_dropoffs + sign * right.n_dropoffs,
+                                periods,
+                                methods,
+                                self.position_weights,
+                                self.half_life_days)
+
+    def merge(self, other: "AttributionState") -> "AttributionState":
+        """State of the journeys of both states. Their periods should not overlap, as that would count the overlapping journeys twice."""
+        overlap = set(self.periods) & set(other.periods)
+        if overlap:
+            raise ValueError(f"Periods {sorted(overlap)} are already part of the state")
+        return self._combine(other, 1)
+
+    def subtract(self, other: "AttributionState") -> "AttributionState":
+        """State without the journeys of other (ex: a day that falls out of the analysis window). Periods of other should all be in the state."""
+        missing = set(other.periods) - set(self.periods)
+        if missing:
+            raise ValueError(f"Periods {sorted(missing)} are not part of the state")
+        return self._combine(other, -1)
+
+    def add_journeys(self, other: "AttributionState") -> "AttributionState":
+        """Same as merge, for journeys of periods that may already be part of the state (ex: the users of a day, read in chunks)"""
+        return self._combine(other, 1)
+
+    def remove_journeys(self, other: "AttributionState") -> "AttributionState":
+        """State without some of its journeys, keeping its periods (ex: a non converted journey that continues in a later period).
+        other should hold only journeys that are part of the state."""
+        state = self._combine(other, -1)
+        state.periods = list(self.periods)
+        return state
+
+    __add__ = merge
+    __sub__ = subtract
+
+    def get_shapley_values(self) -> Dict[str, float]:
+        """Same as models.get_shapley_values on the converted journeys of the state"""
+        # Touches without any converted journey left in the state are left out, as in models.get_shapley_values
+        return {touch: share for touch, share in zip(self.vocabulary, self.shapley_shares.tolist()) if abs(share) > SHARE_TOLERANCE}
+
+    def get_markov_attribution(self, solver: str = "sherman_morrison", visualize: bool = False) -> Tuple[Dict[str, float], np.ndarray]:
+        """Same as models.get_markov_attribution on the journeys of the state, over the touches that occur in the state"""
+        labels = ["Start"] + self.vocabulary + ["Dropoff", "Converted"]
+        transitions, labels = drop_unvisited_touches(self.pos_transitions + self.neg_transitions, labels)
+        return get_markov_attribution_from_counts(transitions, np.zeros_like(transitions), labels, self.n_conversions,
+                                                  visualize=visualize, solver=solver)
+
+    def get_rule_based_attribution(self, methods: Tuple[str] = RULE_BASED_METHODS, normalize: bool = False) -> Dict[str, Optional[dict]]:
+        """Same as models.get_rule_based_attribution on the converted journeys of the state. Methods the state has no totals for give None."""
+        # Totals of subtracted journeys cancel out up to float round off
+        totals = pd.DataFrame(np.where(np.abs(self.rule_based_totals) > SHARE_TOLERANCE, self.rule_based_totals, 0.),
+                              index=self.rule_based_methods, columns=self.vocabulary)
+        return get_rule_based_attribution_from_totals(totals, methods, is_count=self.n_conversions.is_integer(), normalize=normalize)
+
+    def get_single_touch_attribution(self, last_touch: bool, normalize: bool) -> Dict[str, float]:
+        """Same as models.get_single_touch_attribution on the converted journeys of the state"""
+        method = "last_touch" if last_touch else "first_touch"
+        return self.get_rule_based_attribution((method,), normalize)[method]
+
+    def save(self, path: str) -> None:
+        """Saves the state as a compressed npz file. The metadata (format version, vocabulary, periods) is stored as json."""
+        meta = {"format_version": STATE_FORMAT_VERSION,
+                "vocabulary": self.vocabulary,
+                "periods": self.periods,
+                "n_conversions": self.n_conversions,
+                "n_dropoffs": self.n_dropoffs,
+                "rule_based_methods": self.rule_based_methods,
+                "position_weights": self.position_weights,
+                "half_life_days": self.half_life_days}
+        with open(path, "wb") as f:
+            np.savez_compressed(f,
+                                meta=np.array(json.dumps(meta)),
+                                pos_transitions=self.pos_transitions,
+                                neg_transitions=self.neg_transitions,
+                                shapley_shares=self.shapley_shares,
+                                rule_based_totals=self.rule_based_totals)
+
+    @classmethod
+    def load(cls, path: str) -> "AttributionState":
+        with np.load(path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["format_version"] != STATE_FORMAT_VERSION:
+                raise ValueError(f"State file {path} has format version {meta['format_version']}, expected {STATE_FORMAT_VERSION}")
+            return cls(meta["vocabulary"],
+                       data["pos_transitions"],
+                       data["neg_transitions"],
+                       data["shapley_shares"],
+                       data["rule_based_totals"],
+                       meta["n_conversions"],
+                       meta["n_dropoffs"],
+                       meta["periods"],
+                       meta["rule_based_methods"],
+                       meta["position_weights"],
+                       meta["half_life_days"])
+
+
+def get_journey_periods(touches: pd.DataFrame, primary_key: str, timestamp: str, converted_ts_col: str) -> pd.Series:
+    """Day ('YYYY-MM-DD') in which the journey of each user ends: the conversion date for converted journeys, and the date of the last
+    touch otherwise. Indexed by primary key. Journeys without any timestamp have no period.
+
+    Args:
+        touches (pd.DataFrame): Touches with their conversion timestamps (preprocessing.label_conversions)
+        primary_key (str): Name of the column containing unique user identifier
+        timestamp (str): Name of the column containing the touch timestamp
+        converted_ts_col (str): Name of the column containing the conversion timestamp of the user (null if the user did not convert)
+
+    Returns:
+        pd.Series: Period of each journey
+    """
+    journey_ends = touches.groupby(primary_key).agg(last_touch=(timestamp, "max"), converted_ts=(converted_ts_col, "first"))
+    ends = journey_ends["converted_ts"].where(journey_ends["converted_ts"].notnull(), journey_ends["last_touch"])
+    return pd.to_datetime(ends).dt.strftime("%Y-%m-%d")
+
+
+def states_by_period(touches: pd.DataFrame,
+                     primary_key: str,
+                     timestamp: str,
+                     touchpoint: str,
+                     converted_ts_col: str,
+                     is_converted_col: str = "is_converted",
+                     position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+                     half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> Dict[str, AttributionState]:
+    """State of the journeys that end in each day (get_journey_periods), from the clean touches of the users (with the columns of
+    preprocessing.label_conversions). Each user's touches should all be in touches.
+
+    Returns:
+        Dict[str, AttributionState]: State of each day, by day
+    """
+    touch_periods = touches[primary_key].map(get_journey_periods(touches, primary_key, timestamp, converted_ts_col))
+    states = {}
+    for period, period_touches in touches.groupby(touch_periods.to_numpy(), sort=True):
+        is_converted = (period_touches[is_converted_col] == 1).to_numpy()
+        states[period] = AttributionState.from_journeys(
+            JourneyStore.from_dataframe(period_touches[is_converted], primary_key, timestamp, touchpoint),
+            JourneyStore.from_dataframe(period_touches[~is_converted], primary_key, timestamp, touchpoint),
+            period, position_weights, half_life_days)
+    return states
+
+
+def fold_states_by_period(touch_chunks: Iterable[pd.DataFrame],
+                          primary_key: str,
+                          timestamp: str,
+                          touchpoint: str,
+                          converted_ts_col: str,
+                          is_converted_col: str = "is_converted",
+                          position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+                          half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> Dict[str, AttributionState]:
+    """states_by_period over touches read in chunks, summed up by day. Only one chunk of touches is in memory at a time.
+    Chunks should hold whole users (journeys.iter_user_chunks), as a user split across chunks would count as two journeys.
+    """
+    states = {}
+    for chunk in touch_chunks:
+        for period, state in states_by_period(chunk, primary_key, timestamp, touchpoint, converted_ts_col, is_converted_col,
+                                              position_weights, half_life_days).items():
+            states[period] = states[period].add_journeys(state) if period in states else state
+    return states
+
+
+def get_window_state(states: Dict[str, AttributionState],
+                     window_start: Optional[str] = None,
+                     position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+                     half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> AttributionState:
+    """Merge of the states of the days from window_start on (all the days if None)"""
+    window_state = AttributionState.empty(position_weights=position_weights, half_life_days=half_life_days)
+    for period in sorted(states):
+        if window_start is None or period >= window_start:
+            window_state = window_state.merge(states[period])
+    return window_state
+
+
+class AttributionStateStore:
+    def __init__(self, state_dir: str = os.path.join("data", "attribution_state")) -> None:
+        """States of each day (days/<YYYY-MM-DD>.npz), the state of the analysis window (window_state.npz), and meta.json with what
+        the states were computed from (config fingerprint, vocabulary, max_date of the touches read), in state_dir.
+
+        Args:
+            state_dir (str, optional): Folder of the states. Defaults to data/attribution_state.
+        """
+        self.state_dir = state_dir
+
+    def _day_path(self, period: str) -> str:
+        return os.path.join(self.state_dir, "days", f"{period}.npz")
+
+    @property
+    def window_path(self) -> str:
+        return os.path.join(self.state_dir, "window_state.npz")
+
+    def read_meta(self) -> Optional[dict]:
+        """meta.json of the stored states, None if there are none"""
+        meta_path = os.path.join(self.state_dir, "meta.json")
+        if not os.path.exists(meta_path) or not os.path.exists(self.window_path):
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def _write_meta(self, meta: dict) -> None:
+        with open(os.path.join(self.state_dir, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def periods(self) -> List[str]:
+        return sorted(os.path.basename(path)[:-len(".npz")] for path in glob(self._day_path("*")))
+
+    def load_day(self, period: str) -> AttributionState:
+        return AttributionState.load(self._day_path(period))
+
+    def load_window(self) -> AttributionState:
+        return AttributionState.load(self.window_path)
+
+    def rebuild(self,
+                states: Dict[str, AttributionState],
+                window_start: Optional[str],
+                meta: dict,
+                position_weights: Tuple[float, float, float] = DEFAULT_POSITION_WEIGHTS,
+                half_life_days: float = DEFAULT_HALF_LIFE_DAYS) -> AttributionState:
+        """Replaces the stored states with the states of each day (states_by_period over all the touches), and returns the window state.
+
+        Args:
+            states (Dict[str, AttributionState]): State of each day
+            window_start (Optional[str]): First day of the analysis window. None takes all the days.
+            meta (dict): Written to meta.json. window_start is added to it.
+            position_weights (Tuple[float, float, float], optional): Rule based parameters of the states. Defaults to (0.4, 0.2, 0.4).
+            half_life_days (float, optional): Rule based parameters of the states. Defaults to 7.
+
+        Returns:
+            AttributionState: Window state
+        """
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+        os.makedirs(os.path.dirname(self._day_path("")), exist_ok=True)
+        for period, state in states.items():
+            state.save(self._day_path(period))
+        window_state = get_window_state(states, window_start, position_weights, half_life_days)
+        window_state.save(self.window_path)
+        self._write_meta({**meta, "window_start": window_start})
+        return window_state
+
+    def refresh(self,
+                old_states: Dict[str, AttributionState],
+                new_states: Dict[str, AttributionState],
+                window_start: Optional[str],
+                meta: dict) -> AttributionState:
+        """Updates the stored states with the users who have new touches since the states were computed, without the other users' touches:
+        1. The old journeys of the users (states_by_period over their touches as the stored states saw them) are removed from their days
+        2. Their journeys with the new touches are added to their days, which may be new days
+        3. Days before window_start are subtracted from the window state
+        Days of the window that did not change are not read. Gives the same states as rebuild over all the touches.
+
+        Args:
+            old_states (Dict[str, AttributionState]): State of each day, of the old journeys of the users with new touches
+            new_states (Dict[str, AttributionState]): State of each day, of the journeys of the same users with all their touches
+            window_start (Optional[str]): First day of the analysis window. None takes all the days.
+            meta (dict): Written to meta.json. window_start is added to it.
+
+        Returns:
+            AttributionState: Refreshed window state
+        """
+        window_state = self.load_window()
+        stored_periods = set(self.periods())
+        changed = {}
+        for period, state in old_states.items():
+            if period in stored_periods:
+                changed[period] = changed.get(period, None) or self.load_day(period)
+                changed[period] = changed[period].remove_journeys(state)
+            if period in window_state.periods:
+                window_state = window_state.remove_journeys(state)
+        for period, state in new_states.items():
+            day_state = changed.get(period) or (self.load_day(period) if period in stored_periods else None)
+            changed[period] = state if day_state is None else day_state.add_journeys(state)
+            # Days of the window that expire below are subtracted as changed here, so their new journeys go into the window first
+            if period in window_state.periods or window_start is None or period >= window_start:
+                window_state = window_state.add_journeys(state)
+        expired_periods = [period for period in window_state.periods if window_start is not None and period < window_start]
+        for period in expired_periods:
+            window_state = window_state.subtract(changed.get(period) or self.load_day(period))
+        for period, state in changed.items():
+            state.save(self._day_path(period))
+        window_state.save(self.window_path)
+        self._write_meta({**meta, "window_start": window_start})
+        return window_state
+
+
+if __name__ == "__main__":
+    # Test cases:
+    import tempfile
+    from journeys import iter_user_chunks
+    from models import get_shapley_values, get_markov_attribution, get_rule_based_attribution
+    from preprocessing import EventEncoder, separate_conversions, process_raw_data, label_conversions
+
+    def assert_states_equal(left: AttributionState, right: AttributionState) -> None:
+        vocabulary = sorted(set(left.vocabulary) | set(right.vocabulary))
+        left, right = left.with_vocabulary(vocabulary), right.with_vocabulary(vocabulary)
+        assert left.periods == right.periods and left.rule_based_methods == right.rule_based_methods, (left.periods, right.periods)
+        assert (left.n_conversions, left.n_dropoffs) == (right.n_conversions, right.n_dropoffs)
+        for name in ("pos_transitions", "neg_transitions", "shapley_shares", "rule_based_totals"):
+            assert np.allclose(getattr(left, name), getattr(right, name)), name
+
+    touches = pd.DataFrame.from_dict({"uid": [1, 1, 1, 2, 2, 3, 4, 4, 4, 5],
+                                      "event": ['a', 'b', 'c', 'b', 'b', 'c', 'a', 'c', 'a', 'd'],
+                                      "ts": pd.date_range('2022-01-01', periods=10, freq='D'),
+                                      "converted_ts": pd.to_datetime(['2022-01-04'] * 3 + [None] * 2 + ['2022-01-06'] + ['2022-01-10'] * 3 + [None]),
+                                      "is_converted": [1, 1, 1, 0, 0, 1, 1, 1, 1, 0]})
+    journeys_pos = JourneyStore.from_dataframe(touches[touches["is_converted"] == 1], "uid", "ts", "event")
+    journeys_neg = JourneyStore.from_dataframe(touches[touches["is_converted"] == 0], "uid", "ts", "event")
+    state = AttributionState.from_journeys(journeys_pos, journeys_neg)
+
+    # Case 1: Journeys are split by the day they end, and folding chunks that split users gives the same states as all the touches at once
+    assert get_journey_periods(touches, "uid", "ts", "converted_ts").to_dict() == {1: '2022-01-04', 2: '2022-01-05', 3: '2022-01-06',
+                                                                                   4: '2022-01-10', 5: '2022-01-10'}
+    daily_states = states_by_period(touches, "uid", "ts", "event", "converted_ts")
+    chunks = [touches.iloc[:2], touches.iloc[2:2], touches.iloc[2:7], touches.iloc[7:8], touches.iloc[8:]]
+    folded_states = fold_states_by_period(iter_user_chunks(chunks, "uid"), "uid", "ts", "event", "converted_ts")
+    assert sorted(folded_states) == sorted(daily_states) == ['2022-01-04', '2022-01-05', '2022-01-06', '2022-01-10']
+    for period in daily_states:
+        assert_states_equal(folded_states[period], daily_states[period])
+    window_state = get_window_state(folded_states)
+    assert window_state.n_conversions == 3 and window_state.n_dropoffs == 2
+    window_state.periods = []
+    assert_states_equal(window_state, state)
+
+    # Case 2: The values solved from the state are the same as the models' on the journeys
+    shapley_values = get_shapley_values(journeys_pos)
+    assert all(abs(window_state.get_shapley_values()[touch] - value) < 1e-9 for touch, value in shapley_values.items())
+    markov_values, _ = get_markov_attribution(journeys_pos, journeys_neg, state.vocabulary, solver="sherman_morrison")
+    assert all(abs(window_state.get_markov_attribution()[0][touch] - value) < 1e-9 for touch, value in markov_values.items())
+    rule_based_values = get_rule_based_attribution(journeys_pos)
+    for method, values in window_state.get_rule_based_attribution().items():
+        assert values.keys() == rule_based_values[method].keys() and all(abs(values[touch] - rule_based_values[method][touch]) < 1e-9 for touch in values)
+
+    # Case 3: An empty result gives no states
+    assert fold_states_by_period(iter_user_chunks([touches.iloc[:0]], "uid"), "uid", "ts", "event", "converted_ts") == {}
+
+    # Case 4: A state refreshed with the users who have new touches, over a window that moved by three days, is the same as the state
+    # computed from scratch on the same window. Users who continue their journey, convert later, or touch again after converting included.
+    raw_events = pd.DataFrame.from_dict({"uid": [1, 1, 1, 1, 2, 2, 2, 3, 4, 4, 5, 5, 6, 6],
+                                         "event": ['a', 'b', 'c', 'conv', 'a', 'conv', 'b', 'b', 'a', 'b', 'c', 'd', 'd', 'conv'],
+                                         "ts": pd.to_datetime(['2022-01-01 10:00', '2022-01-02 10:00', '2022-01-05 10:00', '2022-01-05 11:00',
+                                                               '2022-01-01 10:00', '2022-01-01 11:00', '2022-01-04 10:00', '2022-01-02 10:00',
+                                                               '2022-01-05 10:00', '2022-01-05 12:00', '2022-01-03 10:00', '2022-01-06 10:00',
+                                                               '2022-01-03 09:00', '2022-01-03 12:00'])})
+    event_encoder = EventEncoder().fit(raw_events.loc[raw_events["event"] != 'conv', "event"])
+
+    def get_daily_states(events: pd.DataFrame) -> Dict[str, AttributionState]:
+        event_data, conversion_timestamps = separate_conversions(events, "uid", "ts", "event", 'conv', "converted_ts")
+        event_data["event"] = event_encoder.transform(event_data["event"])
+        clean_touches = label_conversions(process_raw_data(event_data, "uid", "ts", "event", 300), "uid", conversion_timestamps, "converted_ts")
+        return states_by_period(clean_touches, "uid", "ts", "event", "converted_ts")
+
+    previous_max_date, max_date = pd.Timestamp('2022-01-03 23:59:59'), pd.Timestamp('2022-01-06 23:59:59')
+    store = AttributionStateStore(tempfile.mkdtemp())
+    store.rebuild(get_daily_states(raw_events[raw_events["ts"] <= previous_max_date]), '2022-01-01', {"max_date": str(previous_max_date)})
+    assert store.periods() == ['2022-01-01', '2022-01-02', '2022-01-03'] and store.read_meta()["window_start"] == '2022-01-01'
+    active_users = raw_events.loc[(raw_events["ts"] > previous_max_date) & (raw_events["ts"] <= max_date), "uid"].unique()
+    user_events = raw_events[raw_events["uid"].isin(active_users) & (raw_events["ts"] <= max_date)]
+    refreshed_state = store.refresh(get_daily_states(user_events[user_events["ts"] <= previous_max_date]), get_daily_states(user_events),
+                                    '2022-01-04', {"max_date": str(max_date)})
+    scratch_states = get_daily_states(raw_events[raw_events["ts"] <= max_date])
+    assert_states_equal(refreshed_state, get_window_state(scratch_states, '2022-01-04'))
+    assert_states_equal(store.load_window(), refreshed_state)
+    assert refreshed_state.periods == ['2022-01-05', '2022-01-06'] and (refreshed_state.n_conversions, refreshed_state.n_dropoffs) == (1, 2)
+    assert store.periods() == sorted(scratch_states)
+    for period, scratch_state in scratch_states.items():
+        assert_states_equal(store.load_day(period), scratch_state)
@@ -0,0 +1,302 @@
+"""
+Benchmarks of the attribution models and the data preparation steps, on seeded synthetic journeys.
+
+Each case is timed over a sweep of event volumes and channel counts (best of `--repeat` runs), and profiled separately for peak memory
+with tracemalloc (numpy and pandas buffers are traced too). Results are written as JSON, and compared against a baseline JSON of an
+earlier run if one is given: cases that got slower (or heavier) by more than the tolerance are reported, and the exit code is 1.
+
+Import time of the library modules is tracked too, each in a fresh interpreter, against IMPORT_TIME_BUDGET_SECONDS. An import over
+its budget, or one that loads a module listed in DEFERRED_MODULES, fails the run like a regression.
+
+Journey level cases (models, compress) run on journeys generated directly as a JourneyStore, so they scale to 1e8 events.
+The dataframe stages (dedup, top k grouping, collecting journeys) and the iterative Markov solver are skipped above --max-pipeline-events.
+
+Usage:
+    python benchmarks.py --events 1000 100000 1000000 --channels 5 15 30 --output data/benchmarks.json
+    python benchmarks.py --events 100000 --channels 15 --baseline data/benchmarks.json --tolerance 0.2
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from journeys import JourneyStore
+from preprocessing import EventEncoder, dedup_by_ts_delta, get_top_k_touches
+from models import (MARKOV_SOLVERS, RULE_BASED_METHODS, get_shapley_values, generate_transition_counts, get_transition_probabilities, converge,
+                    get_markov_attribution, get_single_touch_attribution, get_rule_based_attribution, merge_dictionaries)
+
+
+PRIMARY_KEY = "user_id"
+EVENT_COLUMN = "event"
+TIMESTAMP_COLUMN = "timestamp"
+CONVERSION_EVENT = "conversion"
+DEDUP_INTERVAL_IN_SEC = 300
+
+# Import time budgets, including numpy and pandas (about a second of it on a cold start)
+IMPORT_TIME_BUDGET_SECONDS = {"models": 2.0, "utils": 1.5, "journeys": 1.5, "preprocessing": 1.5, "instrumentation": 1.5}
+# Heavy dependencies that the above modules import only on first use
+DEFERRED_MODULES = ("seaborn", "matplotlib", "scipy.sparse.linalg", "sagemaker", "boto3", "sklearn", "sqlalchemy")
+
+
+def generate_journeys(n_events: int,
+                      n_channels: int,
+                      conversion_rate: float = 0.05,
+                      mean_journey_length: float = 4.,
+                      channel_skew: float = 1.2,
+                      random_state: Optional[int] = 0) -> Tuple[JourneyStore, JourneyStore]:
+    """Synthetic converted and non converted journeys, of about n_events touches in total.
+
+    Args:
+        n_events (int): Approximate no:of touches across all the journeys
+        n_channels (int): No:of distinct touches. Touches are named channel_0, channel_1, ...
+        conversion_rate (float, optional): Share of users that convert. Users who saw channel_0 convert twice as often, so that
+         the models have a signal to find. Defaults to 0.05.
+        mean_journey_length (float, optional): Mean no:of touches per user. Lengths are geometric. Defaults to 4.
+        channel_skew (float, optional): Exponent of the power law of channel volumes (channel i has weight 1 / (i + 1) ** channel_skew). Defaults to 1.2.
+        random_state (Optional[int], optional): Seed. Defaults to 0.
+
+    Returns:
+        Tuple[JourneyStore, JourneyStore]: Converted journeys and non converted journeys, with keys and timestamps
+    """
+    rng = np.random.default_rng(random_state)
+    n_users = max(1, int(round(n_events / mean_journey_length)))
+    lengths = rng.geometric(1 / mean_journey_length, n_users)
+    offsets = np.zeros(n_users + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    channel_weights = 1 / np.arange(1, n_channels + 1) ** channel_skew
+    codes = rng.choice(n_channels, offsets[-1], p=channel_weights / channel_weights.sum()).astype(np.int32)
+    # Exponential gaps between touches (mean of a day), starting at a random time within 2022
+    gaps = rng.exponential(86400, offsets[-1]).astype(np.int64)
+    gaps[offsets[:-1]] = 0
+    seconds = np.cumsum(gaps)
+    seconds -= np.repeat(seconds[offsets[:-1]], lengths)
+    starts = pd.Timestamp("2022-01-01").value + rng.integers(0, 365 * 86400, n_users) * 10**9
+    timestamps = np.repeat(starts, lengths) + seconds * 10**9
+
+    saw_lift_channel = np.bincount(np.repeat(np.arange(n_users), lengths), weights=(codes == 0), minlength=n_users) > 0
+    base_rate = conversion_rate / (1 + saw_lift_channel.mean())
+    is_converted = rng.random(n_users) < base_rate * (1 + saw_lift_channel)
+
+    journeys = JourneyStore(codes, offsets, [f"channel_{i}" for i in range(n_channels)], keys=np.arange(n_users), timestamps=timestamps)
+    return journeys[is_converted], journeys[~is_converted]
+
+
+def generate_touches(n_events: int, n_channels: int, random_state: Optional[int] = 0, **kwargs) -> pd.DataFrame:
+    """Same journeys as generate_journeys, as a dataframe with one row per touch (as fetched from the warehouse).
+    Converted users get a conversion event row one hour after their last touch. kwargs are passed to generate_journeys.
+    """
+    journeys_pos, journeys_neg = generate_journeys(n_events, n_channels, random_state=random_state, **kwargs)
+    frames = []
+    for journeys in (journeys_pos, journeys_neg):
+        frames.append(pd.DataFrame({PRIMARY_KEY: np.repeat(journeys.keys, journeys.lengths),
+                                    EVENT_COLUMN: np.asarray(journeys.vocabulary, dtype=object)[journeys.codes],
+                                    TIMESTAMP_COLUMN: pd.to_datetime(journeys.timestamps)}))
+    frames.append(pd.DataFrame({PRIMARY_KEY: journeys_pos.keys,
+                                EVENT_COLUMN: CONVERSION_EVENT,
+                                TIMESTAMP_COLUMN: pd.to_datetime(journeys_pos.timestamps[journeys_pos.offsets[1:] - 1] + 3600 * 10**9)}))
+    touches = pd.concat(frames, ignore_index=True)
+    # Rows come from the warehouse in no particular order
+    return touches.iloc[np.random.default_rng(random_state).permutation(len(touches))].reset_index(drop=True)
+
+
+def time_case(setup: Callable[[], tuple], run: Callable, repeat: int = 3, profile_memory: bool = True) -> dict:
+    """Best and mean wall time of run(*setup()) over repeat runs, and its peak traced memory in a separate run. Setup is not timed."""
+    timings = []
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        run(*args)
+        timings.append(time.perf_counter() - start)
+    result = {"seconds": min(timings), "mean_seconds": float(np.mean(timings))}
+    if profile_memory:
+        args = setup()
+        tracemalloc.start()
+        try:
+            run(*args)
+            result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def time_import(module: str, repeat: int = 3) -> dict:
+    """Best time to import module in a fresh interpreter, and the DEFERRED_MODULES it loaded"""
+    code = ("import sys, time, json; start = time.perf_counter(); import {module}; seconds = time.perf_counter() - start; "
+            "print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {deferred} if name in sys.modules]}}))").format(module=module, deferred=DEFERRED_MODULES)
+    runs = [json.loads(subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                      cwd=os.path.dirname(os.path.abspath(__file__))).stdout) for _ in range(repeat)]
+    return {"seconds": min(run["seconds"] for run in runs),
+            "mean_seconds": float(np.mean([run["seconds"] for run in runs])),
+            "deferred_modules_loaded": runs[0]["loaded"]}
+
+
+def run_import_benchmarks(repeat: int = 3) -> List[dict]:
+    """Import time records, one per module of IMPORT_TIME_BUDGET_SECONDS. over_budget flags the ones to fix."""
+    records = []
+    for module, budget in IMPORT_TIME_BUDGET_SECONDS.items():
+        record = {"case": f"import {module}", "n_events": 0, "n_channels": 0, "budget_seconds": budget}
+        record.update(time_import(module, repeat))
+        record["over_budget"] = record["seconds"] > budget or len(record["deferred_modules_loaded"]) > 0
+        print(f"{record['case']:<40} {record['seconds']:10.4f}s (budget {budget}s)"
+              + (f" loads {record['deferred_modules_loaded']}" if record["deferred_modules_loaded"] else ""), flush=True)
+        records.append(record)
+    return records
+
+
+def get_cases(n_events: int, n_channels: int, max_pipeline_events: int, random_state: Optional[int] = 0) -> Dict[str, Tuple[Callable, Callable]]:
+    """Benchmark cases for one point of the sweep, as {name: (setup, run)}"""
+    journeys_pos, journeys_neg = generate_journeys(n_events, n_channels, random_state=random_state)
+    channels = journeys_pos.vocabulary
+    paths_pos, paths_neg = journeys_pos.compress(), journeys_neg.compress()
+    no_args = lambda: ()
+    cases = {
+        "compress": (no_args, lambda: (journeys_pos.compress(), journeys_neg.compress())),
+        "get_shapley_values": (no_args, lambda: get_shapley_values(journeys_pos)),
+        "get_shapley_values[compressed]": (no_args, lambda: get_shapley_values(paths_pos)),
+        "generate_transition_counts": (no_args, lambda: (generate_transition_counts(journeys_pos, channels, is_positive=True),
+                                                         generate_transition_counts(journeys_neg, channels, is_positive=False))),
+        "generate_transition_counts[sparse]": (no_args, lambda: (generate_transition_counts(journeys_pos, channels, is_positive=True, sparse=True),
+                                                                 generate_transition_counts(journeys_neg, channels, is_positive=False, sparse=True))),
+        "get_single_touch_attribution": (no_args, lambda: (get_single_touch_attribution(journeys_pos, EVENT_COLUMN, last_touch=True, normalize=False),
+                                                           get_single_touch_attribution(journeys_pos, EVENT_COLUMN, last_touch=False, normalize=False))),
+        "get_rule_based_attribution": (no_args, lambda: get_rule_based_attribution(journeys_pos)),
+    }
+    for solver in MARKOV_SOLVERS:
+        if solver == "iterative" and n_events > max_pipeline_events:
+            continue
+        cases[f"get_markov_attribution[{solver}]"] = (no_args, lambda solver=solver: get_markov_attribution(paths_pos, paths_neg, channels, solver=solver))
+    cases["get_markov_attribution[order_2]"] = (no_args, lambda: get_markov_attribution(paths_pos, paths_neg, channels, order=2))
+
+    transition_probabilities, _ = get_transition_probabilities(paths_pos, paths_neg, channels)
+    cases["converge"] = (no_args, lambda: converge(transition_probabilities, verbose=False))
+
+    results = [get_shapley_values(paths_pos),
+               get_markov_attribution(paths_pos, paths_neg, channels, solver="sherman_morrison")[0]]
+    results += list(get_rule_based_attribution(journeys_pos).values())
+    cases["merge_dictionaries"] = (no_args, lambda: merge_dictionaries(results, ["shap", "markov"] + list(RULE_BASED_METHODS)))
+
+    if n_events <= max_pipeline_events:
+        touches = generate_touches(n_events, n_channels, random_state=random_state)
+        event_data = touches[touches[EVENT_COLUMN] != CONVERSION_EVENT]
+        cases["dedup_by_ts_delta"] = (no_args, lambda: dedup_by_ts_delta(event_data, PRIMARY_KEY, TIMESTAMP_COLUMN, EVENT_COLUMN, DEDUP_INTERVAL_IN_SEC))
+        # get_top_k_touches modifies the dataframe in place, so every run gets a fresh copy
+        cases["get_top_k_touches"] = (lambda: (event_data.copy(),), lambda df: get_top_k_touches(df, EVENT_COLUMN, max(1, n_channels // 2)))
+        cases["EventEncoder"] = (no_args, lambda: EventEncoder(top_k=max(1, n_channels // 2)).fit_transform(event_data[EVENT_COLUMN]))
+        cases["JourneyStore.from_dataframe"] = (no_args, lambda: JourneyStore.from_dataframe(event_data, PRIMARY_KEY, TIMESTAMP_COLUMN, EVENT_COLUMN))
+        encoded_data = event_data.assign(**{EVENT_COLUMN: EventEncoder().fit_transform(event_data[EVENT_COLUMN])})
+        cases["JourneyStore.from_dataframe[categorical]"] = (no_args, lambda: JourneyStore.from_dataframe(encoded_data, PRIMARY_KEY, TIMESTAMP_COLUMN, EVENT_COLUMN))
+    return cases
+
+
+def run_benchmarks(events: List[int],
+                   channels: List[int],
+                   repeat: int = 3,
+                   max_pipeline_events: int = 10**6,
+                   profile_memory: bool = True,
+                   cases_filter: Optional[List[str]] = None,
+                   random_state: Optional[int] = 0) -> dict:
+    """Runs all the cases over the sweep of events x channels. Returns {"meta": ..., "results": [one record per case and sweep point]}"""
+    records = []
+    if not cases_filter or any("import" in pattern for pattern in cases_filter):
+        records.extend(run_import_benchmarks(repeat))
+    for n_events in events:
+        for n_channels in channels:
+            cases = get_cases(n_events, n_channels, max_pipeline_events, random_state)
+            for name, (setup, run) in cases.items():
+                if cases_filter and not any(pattern in name for pattern in cases_filter):
+                    continue
+                record = {"case": name, "n_events": n_events, "n_channels": n_channels}
+                record.update(time_case(setup, run, repeat, profile_memory))
+                print(f"{name:<40} events={n_events:<10} channels={n_channels:<4} {record['seconds']:10.4f}s"
+                      + (f" {record['peak_memory_mb']:10.1f} MB" if profile_memory else ""), flush=True)
+                records.append(record)
+    return {"meta": get_meta(events, channels, repeat, random_state), "results": records}
+
+
+def get_meta(events: List[int], channels: List[int], repeat: int, random_state: Optional[int]) -> dict:
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        commit = None
+    import scipy
+    return {"created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "git_commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "scipy": scipy.__version__,
+            "events": events,
+            "channels": channels,
+            "repeat": repeat,
+            "random_state": random_state}
+
+
+def compare_to_baseline(results: dict, baseline: dict, tolerance: float = 0.2, min_seconds: float = 1e-3, min_memory_mb: float = 1.) -> pd.DataFrame:
+    """Ratios of time and peak memory against the baseline, for the cases present in both runs.
+    A case regressed if either ratio is above 1 + tolerance. Ratios of cases faster than min_seconds (or lighter than min_memory_mb) in
+    the baseline are mostly timer noise, and are not flagged.
+    """
+    key = ["case", "n_events", "n_channels"]
+    current = pd.DataFrame(results["results"])
+    previous = pd.DataFrame(baseline["results"])
+    comparison = current.merge(previous, on=key, suffixes=("", "_baseline"))
+    comparison["time_ratio"] = comparison["seconds"] / comparison["seconds_baseline"]
+    comparison["regressed"] = (comparison["time_ratio"] > 1 + tolerance) & (comparison["seconds_baseline"] >= min_seconds)
+    if "peak_memory_mb" in comparison and "peak_memory_mb_baseline" in comparison:
+        comparison["memory_ratio"] = comparison["peak_memory_mb"] / comparison["peak_memory_mb_baseline"]
+        comparison["regressed"] |= (comparison["memory_ratio"] > 1 + tolerance) & (comparison["peak_memory_mb_baseline"] >= min_memory_mb)
+    return comparison
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Benchmarks of the attribution models on synthetic journeys")
+    arg_parser.add_argument("--events", type=int, nargs="+", default=[10**3, 10**4, 10**5, 10**6], help="Event volumes of the sweep")
+    arg_parser.add_argument("--channels", type=int, nargs="+", default=[5, 15, 30], help="Channel counts of the sweep")
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Timed runs per case. The best one is reported")
+    arg_parser.add_argument("--max-pipeline-events", type=int, default=10**6,
+                            help="Dataframe stages and the iterative Markov solver are skipped above this no:of events")
+    arg_parser.add_argument("--cases", type=str, nargs="+", default=None, help="Runs only the cases whose name contains one of these")
+    arg_parser.add_argument("--no-memory", action="store_true", help="Skips the tracemalloc runs")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--output", type=str, default=os.path.join("data", "benchmarks.json"), help="Results JSON. Defaults to data/benchmarks.json")
+    arg_parser.add_argument("--baseline", type=str, default=None, help="Results JSON of an earlier run to compare against")
+    arg_parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown (and memory growth) as a fraction of the baseline")
+    arg_parser.add_argument("--min-seconds", type=float, default=1e-3, help="Cases faster than this in the baseline are not flagged as regressions")
+    args = arg_parser.parse_args()
+
+    benchmark_results = run_benchmarks(args.events, args.channels, args.repeat, args.max_pipeline_events,
+                                       not args.no_memory, args.cases, args.seed)
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(benchmark_results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    over_budget = [record["case"] for record in benchmark_results["results"] if record.get("over_budget")]
+    if over_budget:
+        print(f"Imports over their time budget, or loading deferred modules: {over_budget}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline_results = json.load(f)
+        comparison = compare_to_baseline(benchmark_results, baseline_results, args.tolerance, args.min_seconds)
+        columns = ["case", "n_events", "n_channels", "seconds", "seconds_baseline", "time_ratio"] + (["memory_ratio"] if "memory_ratio" in comparison else [])
+        with pd.option_context("display.max_rows", None, "display.width", 200):
+            print(comparison[columns].round(4).to_string(index=False))
+        regressions = comparison[comparison["regressed"]]
+        if len(regressions) > 0:
+            print(f"{len(regressions)} cases regressed by more than {args.tolerance:.0%}:")
+            print(regressions[columns].round(4).to_string(index=False))
+            sys.exit(1)
+        print("No regressions")
+    if over_budget:
+        sys.exit(1)
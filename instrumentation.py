@@ -0,0 +1,148 @@
+"""
+Per-stage timing and memory instrumentation of the attribution pipeline.
+
+Each stage runs inside a span (PipelineProfiler.span, or the PipelineProfiler.profiled decorator), which records its wall time, CPU time,
+the peak RSS of the process at the end of the stage, the rows going in and out, and optionally the peak memory the stage allocated on top of
+what was already in use (traced by tracemalloc).
+The spans of a run are saved as JSON and CSV in the run's output directory, next to mta_values.parquet.
+
+Peak RSS is the high water mark of the whole process so far (getrusage), so a stage that raises it is the stage that needed the memory.
+tracemalloc gives the peak of each stage on its own, at the cost of slower allocations, and is off by default.
+"""
+
+import os
+import sys
+import json
+import time
+import logging
+import tracemalloc
+from functools import wraps
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional
+
+import pandas as pd
+
+try:
+    import resource
+except ImportError: # Not available on Windows. Peak RSS is then not recorded.
+    resource = None
+
+
+PROFILE_FILE_NAME = "pipeline_profile"
+
+
+def get_peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of the current process so far, in MB"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KB, macOS reports bytes
+    return max_rss / 1024**2 if sys.platform == "darwin" else max_rss / 1024
+
+
+def count_rows(data: Any) -> Optional[int]:
+    """No:of rows of a dataframe, journeys in a JourneyStore, entries in a dict etc. None if data has no length."""
+    try:
+        return len(data)
+    except TypeError:
+        return None
+
+
+class Span:
+    def __init__(self, name: str, run_id: Optional[str] = None, rows_in: Optional[int] = None) -> None:
+        self.name = name
+        self.run_id = run_id
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.status = "ok"
+        self.started_at = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.peak_rss_mb = None
+        self.peak_traced_mb = None
+
+    def to_dict(self) -> dict:
+        return {"run_id": self.run_id,
+                "stage": self.name,
+                "status": self.status,
+                "started_at": self.started_at,
+                "wall_seconds": self.wall_seconds,
+                "cpu_seconds": self.cpu_seconds,
+                "peak_rss_mb": self.peak_rss_mb,
+                "peak_traced_mb": self.peak_traced_mb,
+                "rows_in": self.rows_in,
+                "rows_out": self.rows_out}
+
+
+class PipelineProfiler:
+    def __init__(self, run_id: Optional[str] = None, trace_memory: bool = False, log: bool = True) -> None:
+        """
+        Args:
+            run_id (Optional[str], optional): Run the spans belong to. Defaults to None.
+            trace_memory (bool, optional): Whether to record the peak tracemalloc memory of each span. Defaults to False.
+            log (bool, optional): Whether to log a summary line at the end of each span. Defaults to True.
+        """
+        self.run_id = run_id
+        self.trace_memory = trace_memory
+        self.log = log
+        self.spans: List[Span] = []
+
+    @contextmanager
+    def span(self, name: str, rows_in: Any = None) -> Iterator[Span]:
+        """Records the stage run inside the with block. rows_in can be a count or anything with a length.
+        Set rows_out on the yielded span to record the output size. Spans that raise are recorded with status "failed".
+
+        Ex:
+            with profiler.span("dedup", rows_in=event_data) as span:
+                touches = dedup_by_ts_delta(event_data, ...)
+                span.rows_out = len(touches)
+        """
+        span = Span(name, self.run_id, rows_in if rows_in is None or isinstance(rows_in, int) else count_rows(rows_in))
+        # Nested spans share the tracing started by the outermost one. An inner span can then over report, if the outer span peaked
+        # higher before the inner one started.
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        traced_at_start = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        span.started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            yield span
+        except BaseException:
+            span.status = "failed"
+            raise
+        finally:
+            span.wall_seconds = time.perf_counter() - wall_start
+            span.cpu_seconds = time.process_time() - cpu_start
+            span.peak_rss_mb = get_peak_rss_mb()
+            if self.trace_memory:
+                span.peak_traced_mb = max(0, tracemalloc.get_traced_memory()[1] - traced_at_start) / 1024**2
+                if started_tracing:
+                    tracemalloc.stop()
+            self.spans.append(span)
+            if self.log:
+                logging.info(f"Stage {name} ({span.status}): {span.wall_seconds:.2f}s wall, {span.cpu_seconds:.2f}s cpu, peak rss {span.peak_rss_mb} MB, "
+                             f"rows in {span.rows_in}, rows out {span.rows_out}")
+
+    def profiled(self, name: Optional[str] = None) -> Callable:
+        """Decorator version of span. Rows in is the length of the first argument, and rows out the length of the return value (if they have one)."""
+        def decorator(func: Callable) -> Callable:
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name or func.__name__, rows_in=count_rows(args[0]) if args else None) as span:
+                    result = func(*args, **kwargs)
+                    span.rows_out = count_rows(result)
+                return result
+            return wrapper
+        return decorator
+
+    def to_frame(self) -> pd.DataFrame:
+        return pd.DataFrame([span.to_dict() for span in self.spans], columns=list(Span("").to_dict().keys()))
+
+    def save(self, output_directory: str) -> str:
+        """Writes the spans recorded so far to pipeline_profile.json and pipeline_profile.csv in output_directory. Returns the json path."""
+        json_path = os.path.join(output_directory, f"{PROFILE_FILE_NAME}.json")
+        with open(json_path, "w") as f:
+            json.dump({"run_id": self.run_id, "trace_memory": self.trace_memory, "spans": [span.to_dict() for span in self.spans]}, f, indent=2)
+        self.to_frame().to_csv(os.path.join(output_directory, f"{PROFILE_FILE_NAME}.csv"), index=False)
+        return json_path
@@ -0,0 +1,289 @@
+"""
+Columnar container for user journeys.
+
+Instead of a python list of touches per user (groupby(...).apply(list)), all touches of all journeys are stored back to back in
+one contiguous int32 array of categorical codes, and journey i spans codes[offsets[i]:offsets[i+1]]. The touch names live only
+once, in the vocabulary. This is the layout the models in models.py work on internally, so they accept a JourneyStore directly.
+
+Journeys can also carry a weight, i.e. the no:of users that took that exact journey. compress() collapses identical journeys into one
+weighted journey each. Since most journeys repeat exactly once the touches are reduced to the top events, the models then work on the
+distinct paths instead of every user, and give the same results as on the uncompressed store.
+"""
+
+from typing import List, Optional, Union, Iterator, Iterable, Tuple
+import pandas as pd
+import numpy as np
+
+
+class JourneyStore:
+    def __init__(self,
+                 codes: np.ndarray,
+                 offsets: np.ndarray,
+                 vocabulary: List[str],
+                 keys: Optional[np.ndarray] = None,
+                 timestamps: Optional[np.ndarray] = None,
+                 weights: Optional[np.ndarray] = None) -> None:
+        """
+        Args:
+            codes (np.ndarray): Touch code of every touch of every journey, back to back. Code is the position in vocabulary.
+            offsets (np.ndarray): Journey boundaries, of length no:of journeys + 1. Journey i is codes[offsets[i]:offsets[i+1]]
+            vocabulary (List[str]): Touch names, indexed by code.
+            keys (Optional[np.ndarray], optional): Primary key (user id etc) of each journey. Defaults to None.
+            timestamps (Optional[np.ndarray], optional): Timestamp of every touch (int64, ns since epoch), aligned with codes. Defaults to None.
+            weights (Optional[np.ndarray], optional): No:of users represented by each journey. None means 1 for every journey. Defaults to None.
+        """
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.vocabulary = list(vocabulary)
+        self.keys = keys
+        self.timestamps = None if timestamps is None else np.asarray(timestamps, dtype=np.int64)
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)
+
+    @classmethod
+    def from_dataframe(cls,
+                       touchpoints_df: pd.DataFrame,
+                       primary_key: str,
+                       ts_column: str,
+                       touchpoint_column: str,
+                       vocabulary: Optional[List[str]] = None,
+                       keep_timestamps: bool = True) -> "JourneyStore":
+        """Builds the journeys from a dataframe with one row per touch, with a single sort on (primary_key, ts_column).
+        Same journeys as collect_touchpoints in the notebook, without building a python list per user.
+
+        Args:
+            touchpoints_df (pd.DataFrame): A dataframe with each row corresponding to a touch.
+            primary_key (str): Name of the column containing unique user identifier
+            ts_column (str): Name of column containing timestamp using which journeys are sorted chronologically
+            touchpoint_column (str): Name of column containing touch points.
+            vocabulary (Optional[List[str]], optional): Touch names to encode against. If None, it is the sorted distinct touches. Defaults to None.
+            keep_timestamps (bool, optional): Whether to store the touch timestamps. Defaults to True.
+
+        Returns:
+            JourneyStore: One journey per distinct primary key, in ascending order of the key
+        """
+        touchpoints_df = touchpoints_df[~touchpoints_df[primary_key].isnull()]
+        sorted_df = touchpoints_df.sort_values(by=[primary_key, ts_column], ascending=True)
+        keys = sorted_df[primary_key].to_numpy()
+        starts = np.flatnonzero(np.concatenate([[len(keys) > 0], keys[1:] != keys[:-1]]))
+        offsets = np.append(starts, len(keys)).astype(np.int64)
+        touches = sorted_df[touchpoint_column]
+        if isinstance(touches.dtype, pd.CategoricalDtype):
+            # Re-encodes the category codes (ex: from preprocessing.EventEncoder) without touching the strings. The vocabulary is then
+            # the categories that occur, in category order.
+            categories = touches.cat.categories
+            category_codes = touches.cat.codes.to_numpy()
+            if vocabulary is None:
+                observed = np.bincount(category_codes[category_codes >= 0], minlength=len(categories)) > 0
+                vocabulary = list(categories[observed])
+                lookup = np.where(observed, np.cumsum(observed) - 1, -1)
+            else:
+                lookup = pd.Index(vocabulary).get_indexer(categories)
+            codes = np.where(category_codes >= 0, lookup[category_codes], -1)
+        elif vocabulary is None:
+            codes, uniques = pd.factorize(touches, sort=True)
+            vocabulary = list(uniques)
+        else:
+            codes = pd.Index(vocabulary).get_indexer(touches)
+        if (codes < 0).any():
+            raise ValueError(f"Column {touchpoint_column} has touches that are null or not in the vocabulary")
+        timestamps = None
+        if keep_timestamps:
+            timestamps = pd.to_datetime(sorted_df[ts_column])
+            if timestamps.dt.tz is not None:
+                timestamps = timestamps.dt.tz_convert(None)
+            timestamps = timestamps.to_numpy(dtype="datetime64[ns]").view(np.int64)
+        return cls(codes, offsets, vocabulary, keys=keys[starts], timestamps=timestamps)
+
+    @classmethod
+    def from_lists(cls, journey_list: List[List[str]], vocabulary: Optional[List[str]] = None) -> "JourneyStore":
+        """Builds the store from a list of journeys, each a list of touches"""
+        lengths = np.fromiter((len(journey) for journey in journey_list), dtype=np.int64, count=len(journey_list))
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        touches = pd.Series([touch for journey in journey_list for touch in journey], dtype=object)
+        if vocabulary is None:
+            codes, uniques = pd.factorize(touches, sort=True)
+            vocabulary = list(uniques)
+        else:
+            codes = pd.Index(vocabulary).get_indexer(touches)
+        if (codes < 0).any():
+            raise ValueError("Journeys have touches that are not in the vocabulary")
+        return cls(codes, offsets, vocabulary)
+
+    @classmethod
+    def from_paths(cls,
+                   paths: List[str],
+                   separator: str = ">",
+                   counts: Optional[List[int]] = None,
+                   vocabulary: Optional[List[str]] = None) -> "JourneyStore":
+        """Builds the store from journeys given as paths, i.e. touches joined by separator (ex: output of sql_queries.prepare_journeys_query).
+        If counts is given, path i is a journey of weight counts[i].
+        """
+        store = cls.from_lists(pd.Series(list(paths), dtype=object).str.split(separator).tolist(), vocabulary)
+        if counts is not None:
+            store.weights = np.asarray(counts, dtype=np.float64)
+        return store
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __repr__(self) -> str:
+        weighted = "" if self.weights is None else f", total_weight={self.total_weight:g}"
+        return f"JourneyStore(journeys={len(self)}, touches={len(self.codes)}, vocabulary_size={len(self.vocabulary)}{weighted})"
+
+    @property
+    def journey_weights(self) -> np.ndarray:
+        """Weight of each journey (1 for all, if the store is not weighted)"""
+        return np.ones(len(self)) if self.weights is None else self.weights
+
+    @property
+    def total_weight(self) -> float:
+        """No:of users represented by the store. Same as len() for stores that are not weighted"""
+        return float(len(self)) if self.weights is None else float(self.weights.sum())
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @property
+    def journey_ids(self) -> np.ndarray:
+        """Journey index of every touch, aligned with codes"""
+        return np.repeat(np.arange(len(self)), self.lengths)
+
+    def __getitem__(self, idx: Union[slice, np.ndarray, List[int]]) -> "JourneyStore":
+        """Selects a subset of journeys (slice, integer indices or boolean mask) as a new store sharing the same vocabulary"""
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            if step == 1:
+                lo, hi = self.offsets[start], self.offsets[max(start, stop)]
+                return JourneyStore(self.codes[lo:hi],
+                                    self.offsets[start:max(start, stop) + 1] - lo,
+                                    self.vocabulary,
+                                    keys=None if self.keys is None else self.keys[start:stop],
+                                    timestamps=None if self.timestamps is None else self.timestamps[lo:hi],
+                                    weights=None if self.weights is None else self.weights[start:stop])
+            idx = np.arange(start, stop, step)
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+        lengths = self.lengths[idx]
+        offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        # Position of every selected touch in the original arrays
+        touch_idx = np.repeat(self.offsets[:-1][idx] - offsets[:-1], lengths) + np.arange(offsets[-1])
+        return JourneyStore(self.codes[touch_idx],
+                            offsets,
+                            self.vocabulary,
+                            keys=None if self.keys is None else self.keys[idx],
+                            timestamps=None if self.timestamps is None else self.timestamps[touch_idx],
+                            weights=None if self.weights is None else self.weights[idx])
+
+    def iter_batches(self, batch_size: int) -> Iterator["JourneyStore"]:
+        """Yields consecutive batches of at most batch_size journeys"""
+        for start in range(0, len(self), batch_size):
+            yield self[start:start + batch_size]
+
+    def split(self, train_size: float, random_state: Optional[int] = None) -> Tuple["JourneyStore", "JourneyStore"]:
+        """Random split of journeys into two non-overlapping stores, similar to sklearn's train_test_split.
+        On a compressed store, this splits the distinct paths and not the users.
+        """
+        rng = np.random.default_rng(random_state)
+        permutation = rng.permutation(len(self))
+        n_train = int(round(train_size * len(self)))
+        return self[np.sort(permutation[:n_train])], self[np.sort(permutation[n_train:])]
+
+    def path_ids(self) -> np.ndarray:
+        """Assigns the same id to journeys with identical touch sequences. Ids are in [0, no:of distinct journeys).
+        Journeys are refined one position at a time: at position p, journeys that still have a touch there are split by
+        (id so far, touch at p) into fresh ids, and journeys that already ended keep theirs. This is exact (no hash collisions),
+        and each touch is visited once.
+        """
+        lengths = self.lengths
+        ids = np.zeros(len(self), dtype=np.int64)
+        next_id = 1
+        active = np.flatnonzero(lengths > 0)
+        position = 0
+        while len(active) > 0:
+            keys = ids[active] * len(self.vocabulary) + self.codes[self.offsets[active] + position]
+            _, new_ids = np.unique(keys, return_inverse=True)
+            ids[active] = next_id + new_ids
+            next_id += new_ids.max() + 1
+            position += 1
+            active = active[lengths[active] > position]
+        return np.unique(ids, return_inverse=True)[1].reshape(-1)
+
+    def compress(self) -> "JourneyStore":
+        """Collapses identical journeys into one journey each, weighted by the total weight of the journeys it replaces.
+        Keys and timestamps are dropped, as they are per user.
+        """
+        ids = self.path_ids()
+        _, first_idx = np.unique(ids, return_index=True)
+        weights = np.bincount(ids, weights=self.journey_weights)
+        unique_store = self[first_idx]
+        return JourneyStore(unique_store.codes, unique_store.offsets, self.vocabulary, weights=weights)
+
+    def codes_for(self, vocabulary: List[str]) -> np.ndarray:
+        """Returns the codes re-encoded against another vocabulary"""
+        if list(vocabulary) == self.vocabulary:
+            return self.codes
+        lookup = pd.Index(vocabulary).get_indexer(self.vocabulary).astype(np.int32)
+        codes = lookup[self.codes]
+        if (codes < 0).any():
+            raise ValueError("Journeys have touches that are not in the vocabulary")
+        return codes
+
+    def first_codes(self) -> np.ndarray:
+        """Code of the first touch of each non-empty journey"""
+        return self.codes[self.offsets[:-1][self.lengths > 0]]
+
+    def last_codes(self) -> np.ndarray:
+        """Code of the last touch of each non-empty journey"""
+        return self.codes[self.offsets[1:][self.lengths > 0] - 1]
+
+    def to_lists(self) -> List[List[str]]:
+        vocabulary = np.asarray(self.vocabulary, dtype=object)
+        touches = vocabulary[self.codes].tolist()
+        return [touches[start:end] for start, end in zip(self.offsets[:-1], self.offsets[1:])]
+
+    def to_frame(self, primary_key: str = "key", touchpoint_column: str = "touches") -> pd.DataFrame:
+        """Journeys as a dataframe with a list of touches per row, same as the output of collect_touchpoints in the notebook.
+        Weighted stores have an additional weight column.
+        """
+        keys = self.keys if self.keys is not None else np.arange(len(self))
+        frame = pd.DataFrame({primary_key: keys, touchpoint_column: self.to_lists()})
+        if self.weights is not None:
+            frame["weight"] = self.weights
+        return frame
+
+
+def iter_user_chunks(chunks: Iterable[pd.DataFrame], primary_key: str) -> Iterator[pd.DataFrame]:
+    """Re-cuts chunks of touches (ex: ConnectorBase.run_query_iter) so that no user is split across chunks.
+    The chunks together should be ordered by primary_key (ex: query with `order by primary_key, timestamp`), so that the touches
+    of a user are contiguous. Touches of the last user of a chunk are carried over to the next chunk.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): Touches in chunks, one row per touch. pyarrow RecordBatches are converted to DataFrames.
+        primary_key (str): Name of the column containing unique user identifier
+
+    Yields:
+        Iterator[pd.DataFrame]: Touches of complete users, in the order of the input. Only the last chunk can be empty (empty input).
+    """
+    carry_over = None
+    for chunk in chunks:
+        if not isinstance(chunk, pd.DataFrame):
+            chunk = chunk.to_pandas()
+        if carry_over is not None:
+            chunk = pd.concat([carry_over, chunk], ignore_index=True)
+        if len(chunk) == 0:
+            carry_over = chunk
+            continue
+        keys = chunk[primary_key].to_numpy()
+        # Start of the last user's rows. Keys are contiguous, so the last user starts after the last change of key.
+        changes = np.flatnonzero(keys[1:] != keys[:-1])
+        last_user_start = changes[-1] + 1 if len(changes) > 0 else 0
+        carry_over = chunk.iloc[last_user_start:]
+        if last_user_start > 0:
+            yield chunk.iloc[:last_user_start]
+    if carry_over is not None:
+        yield carry_over
+
@@ -17,6 +17,7 @@ from multiprocessing.dummy import Array
 from sagemaker.session import Session
 from sagemaker.sklearn.processing import SKLearnProcessor
 from sagemaker.processing import ProcessingInput, ProcessingOutput
+from utils import download_s3_prefix
 
 def list_all_files_in_directory(directory: str) -> List[str]:
     files_list = []
@@ -25,12 +26,6 @@ def list_all_files_in_directory(directory: str) -> List[str]:
             files_list.append(os.path.join(path, name))
     return files_list
 
-def download_s3_directory_to_local(s3_resource, s3_bucket_name, s3_path, local_path):
-    Path(local_path).mkdir(parents=True, exist_ok=True)
-    for obj in s3_resource.Bucket(s3_bucket_name).objects.filter(Prefix=s3_path):
-        s3_resource.meta.client.download_file(
-            s3_bucket_name, obj.key, os.path.join(local_path, os.path.basename(obj.key)))
-
 config_files = {"multi_touch_attribution": "analysis_config.yaml"}
 
 # BUCKET='ml-usecases-poc'# rudder
@@ -54,6 +49,8 @@ if __name__ == "__main__":
                             help='One of [data_prep, train, predict]')
     arg_parser.add_argument('--instance', type=str, default="local",
                             help="If `local`, job runs locally with docker containers. Else pass a valid aws machine type. ex: ml.t3.xlarge")
+    arg_parser.add_argument('--headless', action="store_true",
+                            help="Runs attribution_runner.py instead of executing the notebook. No html report is generated")
     args = arg_parser.parse_args()
     job = args.job
     client_id = args.id
@@ -90,7 +87,7 @@ if __name__ == "__main__":
                                          base_job_name=job_name,
                                          sagemaker_session=sagemaker_session)
     # Add all dependency files here
-    files = ["load_data.py", "utils.py", "models.py", "wh_connectors.py"]
+    files = ["load_data.py", "utils.py", "models.py", "journeys.py", "preprocessing.py", "sql_queries.py", "query_cache.py", "wh_connectors.py", "stability.py", "attribution_state.py", "instrumentation.py", "attribution_runner.py", "staging.py"]
 
     with zipfile.ZipFile("utils.zip", "w") as zipobj:
         for file in files:
@@ -142,24 +139,26 @@ if __name__ == "__main__":
                                      '--output_path', output_path,
                                      '--utils_path', utils_path,
                                      '--utils_extract_to', utils_extract_to_path,
-                                     '--nb_parameters', json.dumps(params)])
+                                     '--nb_parameters', json.dumps(params)]
+                                    + (['--headless'] if args.headless else []))
 
     if INSTANCE != "local":
         # Downloading model output files into local
-        download_s3_directory_to_local(
-            boto_session.resource('s3'), 
+        download_s3_prefix(
+            boto_session.client('s3'), 
             BUCKET, 
             f"{sklearn_processor.latest_job.job_name}/output/output-1/{client_id}/{job}_", 
             f"{DATA_FOLDER}/{client_id}/{job}_"
         )
 
-        # Downloading notebook output file as a html report
-        download_s3_directory_to_local(
-            boto_session.resource('s3'), 
-            BUCKET, 
-            f"{sklearn_processor.latest_job.job_name}/output/output-1/{job}_output.html",
-            f"{DATA_FOLDER}/{client_id}/{job}_"
-        )
+        if not args.headless:
+            # Downloading notebook output file as a html report
+            download_s3_prefix(
+                boto_session.client('s3'), 
+                BUCKET, 
+                f"{sklearn_processor.latest_job.job_name}/output/output-1/{job}_output.html",
+                f"{DATA_FOLDER}/{client_id}/{job}_"
+            )
     else:
         print("Processor ran locally. Download files from docker container to data/ before moving ahead to the next step.")
         """ 
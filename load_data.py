@@ -5,8 +5,12 @@ This will be used in both feature_processing and predict notebooks to load the d
 Currently using sqlalchemy, but goingforward it will use wht
 """
 
-from wh_connectors import Connector
-from typing import List, Dict, Union, Tuple, Optional
+from wh_connectors import get_pooled_connector
+from query_cache import QueryCache
+from sql_queries import prepare_query, prepare_distinct_touches_query, prepare_journeys_query, prepare_touch_counts_query, prepare_conversions_query, prepare_max_timestamp_query
+from preprocessing import get_default_event, get_events_type_mapping, EventEncoder, process_raw_chunks
+from journeys import iter_user_chunks
+from typing import List, Dict, Union, Tuple, Optional, Iterator
 import pandas as pd
 import logging
 import numpy as np
@@ -31,8 +35,11 @@ class DataIO:
         self.str_value_column = str_value_column
         pass
 
-    def fetch_data_from_wh(self, query: str) -> pd.DataFrame:
-        wh_conn = Connector(self.config)
+    def fetch_data_from_wh(self, query: str, cache: Optional[QueryCache] = None, timestamp_column: Optional[str] = None) -> pd.DataFrame:
+        """Runs the query on the warehouse. If a cache is given, results are served from (and stored to) the local parquet cache"""
+        wh_conn = get_pooled_connector(self.config)
+        if cache is not None:
+            return cache.run_query(wh_conn, query, timestamp_column)
         df = wh_conn.run_query(query) 
         return df
     
@@ -96,11 +103,12 @@ class DataIO:
         """Returns list of materialized timestamps from warehouse feature store table, sorted by latest to oldest.
          Assumes that at a given timestamp, all features are computed."""
         timestamp_condition = self.__get_timestamp_where_condition(timestamp_column, features_start_date, features_end_date)
-        query = f"select distinct {timestamp_column} from {table_name} order by 1 desc"
+        query = f"select distinct {timestamp_column} from {table_name}"
         if timestamp_condition:
             query = f"{query} where {timestamp_condition}"
+        query = f"{query} order by 1 desc"
 
-        df = self.fetch_data_from_wh(config, query)
+        df = self.fetch_data_from_wh(query)
         return df.values.flatten().tolist()
     
     @staticmethod
@@ -123,7 +131,7 @@ class DataIO:
                 replace: If the table already exists, the table is dropped and the write is executed.
                 append: If the table already exists, the write is executed with new rows appended to existing table
         """
-        wh_connector = Connector(config, aws_config)
+        wh_connector = get_pooled_connector(config, aws_config)
         wh_connector.write_to_table(df, table_name, schema, if_exists)
     
     def get_feature_data_from_wh(self, 
@@ -145,6 +153,179 @@ class DataIO:
 
         return numeric_data.merge(non_numeric_data, left_index=True, right_index=True, how="left")
 
+def get_touches_table_name(wh_config: dict) -> str:
+    """Fully qualified name of the touches table (feature_registry_table) in the warehouse credentials"""
+    return f"{wh_config.get('database')}.{wh_config.get('schema')}.{wh_config.get('feature_registry_table')}"
+
+def get_touches_query(config: dict, creds: dict, order_by: Optional[List[str]] = None, active_since: Optional[str] = None) -> str:
+    """Query that reads the touches of all users (of the users with touches after active_since, if given), from the data section of the
+    analysis config (analysis_config.yaml)"""
+    data_config = config["data"]
+    return prepare_query(data_config["primary_key_column"],
+                         data_config["events_column_name"],
+                         data_config["timestamp_column_name"],
+                         get_touches_table_name(creds["data_warehouse"]),
+                         data_config["ignore_events"],
+                         data_config["min_date"],
+                         order_by=order_by,
+                         end_date=data_config.get("max_date"),
+                         active_since=active_since)
+
+def fetch_max_timestamp(config: dict, creds: dict) -> Optional[str]:
+    """Timestamp of the latest touch in the warehouse (from data.min_date on), as a string. None if there are no touches."""
+    data_config = config["data"]
+    query = prepare_max_timestamp_query(data_config["timestamp_column_name"], get_touches_table_name(creds["data_warehouse"]), data_config["min_date"])
+    max_ts = get_pooled_connector(creds["data_warehouse"], creds.get("aws")).run_query(query)["max_ts"].iloc[0]
+    return None if pd.isnull(max_ts) else str(pd.Timestamp(max_ts))
+
+def get_query_cache(config: dict, mode: str) -> Optional[QueryCache]:
+    """Local parquet cache of the warehouse extracts (data.query_cache in the config). It is used only when running locally."""
+    query_cache_config = config["data"].get("query_cache") or {}
+    if mode != "local" or not query_cache_config.get("enabled"):
+        return None
+    return QueryCache(query_cache_config["cache_dir"],
+                      ttl_seconds=query_cache_config["ttl_hours"] * 3600,
+                      max_size_bytes=int(query_cache_config["max_size_gb"] * 1024**3),
+                      lookback_seconds=query_cache_config.get("lookback_hours", 0) * 3600)
+
+def fetch_touches(config: dict, creds: dict, mode: str = "local") -> pd.DataFrame:
+    """Reads the touches of all users (get_touches_query) from the warehouse in the credentials, through the query cache if it is enabled.
+    Used by both multi_touch_attribution.ipynb and attribution_runner.py.
+    """
+    query = get_touches_query(config, creds)
+    logging.info(f"Reading the touches with the query: {query}")
+    wh_conn = get_pooled_connector(creds["data_warehouse"], creds.get("aws"))
+    query_cache = get_query_cache(config, mode)
+    if query_cache is not None:
+        return query_cache.run_query(wh_conn, query, timestamp_column=config["data"]["timestamp_column_name"])
+    return wh_conn.run_query(query)
+
+def fetch_active_user_touches(config: dict, creds: dict, active_since: str) -> pd.DataFrame:
+    """All the touches (till data.max_date) of the users with touches after active_since, ex: the users who came back since the previous run.
+    Used to refresh the daily attribution states (attribution_runner.refresh_attribution_state). The query cache is not used here."""
+    query = get_touches_query(config, creds, active_since=active_since)
+    logging.info(f"Reading the touches of the users active since {active_since} with the query: {query}")
+    return get_pooled_connector(creds["data_warehouse"], creds.get("aws")).run_query(query)
+
+def get_query_args(config: dict, creds: dict) -> tuple:
+    """Arguments of the group by queries (sql_queries.prepare_touch_counts_query and prepare_conversions_query) over the touches"""
+    data_config = config["data"]
+    return (data_config["primary_key_column"], data_config["events_column_name"], data_config["timestamp_column_name"],
+            get_touches_table_name(creds["data_warehouse"]), data_config["conversion_event_name"], data_config["ignore_events"],
+            data_config["min_date"], data_config.get("max_date"))
+
+def fit_event_encoder(config: dict, creds: dict) -> EventEncoder:
+    """EventEncoder (top k and event grouping of the config) fit on the no:of touches of each event, read with a group by query that returns
+    one row per event. Same vocabulary as EventEncoder.fit on all the touches."""
+    data_config = config["data"]
+    touch_counts = get_pooled_connector(creds["data_warehouse"], creds.get("aws")).run_query(prepare_touch_counts_query(*get_query_args(config, creds)))
+    event_encoder = EventEncoder(top_k=data_config["n_top_events"],
+                                 mapping=get_events_type_mapping(data_config["group_events_mapping"]) if data_config["group_events"] else None)
+    return event_encoder.fit_counts(touch_counts.set_index(data_config["events_column_name"])["n_touches"])
+
+def fetch_touch_chunks(config: dict, creds: dict, event_encoder: Optional[EventEncoder] = None) -> Iterator[pd.DataFrame]:
+    """Same touches as fetch_touches followed by the cleanup steps of attribution_runner.py (separate_conversions, EventEncoder, process_raw_data
+    and label_conversions), with the raw touches read through the warehouse's server side cursor, data.chunksize rows at a time, and cleaned
+    up chunk by chunk (preprocessing.process_raw_chunks). The top k counts (fit_event_encoder) and the conversion timestamps are read first,
+    with group by queries that return one row per event and per converted user. Yields chunks of whole users (journeys.iter_user_chunks),
+    with the columns of preprocessing.label_conversions. The query cache is not used here.
+    event_encoder, if given, should be fit_event_encoder's for the same config.
+    """
+    data_config = config["data"]
+    if data_config.get("multi_conversion", False):
+        raise ValueError("data.chunksize does not support multi_conversion")
+    primary_key_column = data_config["primary_key_column"]
+    events_column_name = data_config["events_column_name"]
+    timestamp_column_name = data_config["timestamp_column_name"]
+    event_encoder = event_encoder or fit_event_encoder(config, creds)
+    wh_conn = get_pooled_connector(creds["data_warehouse"], creds.get("aws"))
+    conversion_timestamps = wh_conn.run_query(prepare_conversions_query(*get_query_args(config, creds))).set_index(primary_key_column)[timestamp_column_name]
+    # Exact duplicates next to each other, for the dedup across chunks
+    query = get_touches_query(config, creds, order_by=[primary_key_column, timestamp_column_name, events_column_name])
+    logging.info(f"Reading the touches in chunks of {data_config['chunksize']} rows with the query: {query}")
+    touches = process_raw_chunks(wh_conn.run_query_iter(query, chunksize=data_config["chunksize"]),
+                                 primary_key_column,
+                                 timestamp_column_name,
+                                 events_column_name,
+                                 data_config["conversion_event_name"],
+                                 f"converted_{timestamp_column_name}",
+                                 conversion_timestamps,
+                                 event_encoder,
+                                 config["analysis"]["min_event_interval_in_sec"],
+                                 data_config["filter_columns"],
+                                 data_config["ignore_events"])
+    return iter_user_chunks(touches, primary_key_column)
+
+def get_clean_touches_query(config: dict, creds: dict, wh_conn, default_event: Optional[str] = None) -> str:
+    """Query that reads the clean touches of all users, one row per touch ordered by user and timestamp (sql_queries.prepare_journeys_query
+    with aggregate_paths=False). With n_top_events, the distinct touches are read first for the default event name, unless it is given
+    (ex: EventEncoder.default_event of fit_event_encoder, so that the touches get the same names as in the stored attribution states).
+    """
+    data_config = config["data"]
+    if data_config.get("multi_conversion", False):
+        raise ValueError("data.pushdown does not support multi_conversion")
+    wh_config = creds["data_warehouse"]
+    events_column_name = data_config["events_column_name"]
+    query_args = (data_config["primary_key_column"], events_column_name, data_config["timestamp_column_name"],
+                  get_touches_table_name(wh_config), data_config["conversion_event_name"])
+    if data_config["n_top_events"] is not None and default_event is None:
+        # Same default event name as EventEncoder, which needs the distinct touches
+        distinct_touches = wh_conn.run_query(prepare_distinct_touches_query(*query_args, data_config["ignore_events"], data_config["min_date"],
+                                                                             data_config.get("max_date")))
+        default_event = get_default_event(distinct_touches[events_column_name] if len(distinct_touches) > 0 else [])
+    return prepare_journeys_query(*query_args,
+                                  warehouse=wh_config.get("name", "").lower(),
+                                  ignore_events_list=data_config["ignore_events"],
+                                  start_date=data_config["min_date"],
+                                  top_k=data_config["n_top_events"],
+                                  default_event=default_event,
+                                  events_mapping=get_events_type_mapping(data_config["group_events_mapping"]) if data_config["group_events"] else None,
+                                  min_event_interval_in_sec=config["analysis"]["min_event_interval_in_sec"],
+                                  aggregate_paths=False,
+                                  end_date=data_config.get("max_date"))
+
+def fetch_clean_touches(config: dict, creds: dict, mode: str = "local", default_event: Optional[str] = None) -> Tuple[pd.DataFrame, pd.Series]:
+    """Used instead of fetch_touches when data.pushdown is set in the config. All the cleanup of the touches (conversion separation,
+    top k, event grouping, dedup and ignore_events) runs in the warehouse (get_clean_touches_query), so only the clean touches
+    come over the wire. Used by both multi_touch_attribution.ipynb and attribution_runner.py.
+    All the touches are read at once. To keep the memory bounded with data.chunksize, see fetch_clean_touch_chunks.
+
+    Args:
+        config (dict): Analysis config (analysis_config.yaml)
+        creds (dict): Warehouse credentials (credentials.yaml)
+        mode (str, optional): "local" or "container". The query cache is used only locally. Defaults to "local".
+        default_event (Optional[str], optional): Name of the touches outside the top k. Defaults to None, which picks it from the distinct touches.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.Series]: Touches with the filter_columns (same as preprocessing.process_raw_data on the fetched touches),
+         and the conversion timestamp of each user who converted, indexed by primary key
+    """
+    data_config = config["data"]
+    wh_conn = get_pooled_connector(creds["data_warehouse"], creds.get("aws"))
+    query = get_clean_touches_query(config, creds, wh_conn, default_event)
+    logging.info(f"Reading the clean touches with the query: {query}")
+    query_cache = get_query_cache(config, mode)
+    # No incremental refresh here: new rows can change the top k, dedup and conversions of the cached rows
+    touches = query_cache.run_query(wh_conn, query) if query_cache is not None else wh_conn.run_query(query)
+    conversion_timestamps = touches.loc[touches["is_converted"] == 1].groupby(data_config["primary_key_column"])["converted_ts"].first()
+    return touches.filter(data_config["filter_columns"]), conversion_timestamps
+
+def fetch_clean_touch_chunks(config: dict, creds: dict, default_event: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """Streams the clean touches (get_clean_touches_query) through the warehouse's server side cursor, data.chunksize rows at a time, and
+    yields chunks of whole users (journeys.iter_user_chunks): a user split across two fetched chunks is carried over to the next one.
+    The chunks have the same columns as fetch_touch_chunks, so only one chunk of touches is in memory at a time when they are folded
+    with attribution_state.fold_states_by_period. default_event is passed on to get_clean_touches_query. The query cache is not used here.
+    """
+    data_config = config["data"]
+    timestamp_column_name = data_config["timestamp_column_name"]
+    wh_conn = get_pooled_connector(creds["data_warehouse"], creds.get("aws"))
+    query = get_clean_touches_query(config, creds, wh_conn, default_event)
+    logging.info(f"Reading the clean touches in chunks of {data_config['chunksize']} rows with the query: {query}")
+    columns = data_config["filter_columns"] + [f"converted_{timestamp_column_name}", "is_converted"]
+    chunks = (chunk.rename(columns={"converted_ts": f"converted_{timestamp_column_name}"}).filter(columns)
+              for chunk in wh_conn.run_query_iter(query, chunksize=data_config["chunksize"]))
+    return iter_user_chunks(chunks, data_config["primary_key_column"])
+
 def pipe(table_name: str, 
          config: dict, 
          entity_column: str,
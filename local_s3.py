@@ -0,0 +1,185 @@
+"""
+Filesystem backed stand-in for the boto3 s3 client, to run the s3 helpers of utils.py locally (ex: to test them without aws).
+
+Buckets are folders under root and keys are file paths within them. Only the client methods used in this repo are implemented,
+with the same arguments and response fields as boto3: get_object (with Range), head_object, put_object, the multipart upload calls,
+list_objects_v2 (with Delimiter and pagination), get_paginator("list_objects_v2"), upload_file, download_file and delete_objects.
+ETags follow s3: md5 of the content for single uploads, and md5 of the part md5s with a -<no:of parts> suffix for multipart uploads.
+"""
+
+import io
+import os
+import json
+import uuid
+import shutil
+import hashlib
+from typing import Dict, Iterator, List, Optional
+
+
+MAX_LIST_KEYS = 1000
+
+
+class LocalS3Client:
+    def __init__(self, root: str) -> None:
+        """
+        Args:
+            root (str): Folder under which buckets are stored
+        """
+        self.root = root
+        self._uploads: Dict[str, Dict[int, bytes]] = {}
+
+    def _path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, bucket, *key.split("/"))
+
+    def _etag_path(self, bucket: str, key: str) -> str:
+        return os.path.join(self.root, ".etags", bucket, hashlib.md5(key.encode("utf-8")).hexdigest())
+
+    def _write(self, bucket: str, key: str, chunks: List[bytes], etag: str) -> str:
+        path = self._path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+        os.makedirs(os.path.dirname(self._etag_path(bucket, key)), exist_ok=True)
+        with open(self._etag_path(bucket, key), "w") as f:
+            json.dump({"key": key, "etag": etag}, f)
+        return etag
+
+    def _etag(self, bucket: str, key: str) -> str:
+        with open(self._etag_path(bucket, key), "r") as f:
+            return json.load(f)["etag"]
+
+    def _check_exists(self, bucket: str, key: str) -> None:
+        if not os.path.isfile(self._path(bucket, key)):
+            raise KeyError(f"s3://{bucket}/{key} does not exist")
+
+    def put_object(self, Bucket: str, Key: str, Body=b"", **kwargs) -> dict:
+        body = Body.read() if hasattr(Body, "read") else Body
+        body = body.encode("utf-8") if isinstance(body, str) else bytes(body)
+        return {"ETag": self._write(Bucket, Key, [body], f'"{hashlib.md5(body).hexdigest()}"')}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs) -> dict:
+        self._check_exists(Bucket, Key)
+        return {"ContentLength": os.path.getsize(self._path(Bucket, Key)), "ETag": self._etag(Bucket, Key)}
+
+    def get_object(self, Bucket: str, Key: str, Range: Optional[str] = None, **kwargs) -> dict:
+        self._check_exists(Bucket, Key)
+        path = self._path(Bucket, Key)
+        if Range is None:
+            body = open(path, "rb")
+            length = os.path.getsize(path)
+        else:
+            # Range: "bytes=start-end", end inclusive
+            start, end = (int(value) for value in Range.split("=")[1].split("-"))
+            with open(path, "rb") as f:
+                f.seek(start)
+                content = f.read(end - start + 1)
+            body, length = io.BytesIO(content), len(content)
+        return {"Body": body, "ContentLength": length, "ETag": self._etag(Bucket, Key)}
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs) -> dict:
+        upload_id = uuid.uuid4().hex
+        self._uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, UploadId: str, PartNumber: int, Body, **kwargs) -> dict:
+        body = Body.read() if hasattr(Body, "read") else bytes(Body)
+        self._uploads[UploadId][PartNumber] = body
+        return {"ETag": f'"{hashlib.md5(body).hexdigest()}"'}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict, **kwargs) -> dict:
+        parts = self._uploads.pop(UploadId)
+        part_numbers = [part["PartNumber"] for part in MultipartUpload["Parts"]]
+        digests = b"".join(hashlib.md5(parts[number]).digest() for number in part_numbers)
+        etag = f'"{hashlib.md5(digests).hexdigest()}-{len(part_numbers)}"'
+        return {"ETag": self._write(Bucket, Key, [parts[number] for number in part_numbers], etag)}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs) -> dict:
+        self._uploads.pop(UploadId, None)
+        return {}
+
+    def upload_file(self, Filename: str, Bucket: str, Key: str, **kwargs) -> None:
+        with open(Filename, "rb") as f:
+            self.put_object(Bucket=Bucket, Key=Key, Body=f.read())
+
+    def download_file(self, Bucket: str, Key: str, Filename: str, **kwargs) -> None:
+        self._check_exists(Bucket, Key)
+        shutil.copyfile(self._path(Bucket, Key), Filename)
+
+    def delete_objects(self, Bucket: str, Delete: dict, **kwargs) -> dict:
+        for obj in Delete["Objects"]:
+            for path in (self._path(Bucket, obj["Key"]), self._etag_path(Bucket, obj["Key"])):
+                if os.path.isfile(path):
+                    os.remove(path)
+        return {"Deleted": Delete["Objects"]}
+
+    def _all_keys(self, bucket: str) -> List[str]:
+        bucket_path = os.path.join(self.root, bucket)
+        keys = []
+        for folder, _, files in os.walk(bucket_path):
+            for name in files:
+                keys.append(os.path.relpath(os.path.join(folder, name), bucket_path).replace(os.sep, "/"))
+        return sorted(keys)
+
+    def list_objects_v2(self,
+                        Bucket: str,
+                        Prefix: str = "",
+                        Delimiter: Optional[str] = None,
+                        ContinuationToken: Optional[str] = None,
+                        StartAfter: Optional[str] = None,
+                        MaxKeys: int = MAX_LIST_KEYS,
+                        **kwargs) -> dict:
+        """Keys (and common prefixes, with a Delimiter) in lexicographic order, MaxKeys at a time. ContinuationToken is the last key returned."""
+        after = ContinuationToken or StartAfter or ""
+        contents, common_prefixes = [], []
+        is_truncated, last = False, None
+        for key in self._all_keys(Bucket):
+            if not key.startswith(Prefix) or key <= after:
+                continue
+            if Delimiter and Delimiter in key[len(Prefix):]:
+                common_prefix = key[:len(Prefix) + key[len(Prefix):].index(Delimiter) + len(Delimiter)]
+                if common_prefixes and common_prefixes[-1] == common_prefix:
+                    continue
+                if common_prefix <= after:
+                    continue
+                entry = common_prefix
+            else:
+                entry = key
+            if len(contents) + len(common_prefixes) == MaxKeys:
+                is_truncated = True
+                break
+            if entry == key:
+                path = self._path(Bucket, key)
+                contents.append({"Key": key, "Size": os.path.getsize(path), "ETag": self._etag(Bucket, key)})
+            else:
+                common_prefixes.append(entry)
+            # A common prefix is returned once. Continuing after its last possible key skips the rest of it.
+            last = key if entry == key else entry + "￿"
+        response = {"KeyCount": len(contents) + len(common_prefixes), "IsTruncated": is_truncated, "Prefix": Prefix}
+        if contents:
+            response["Contents"] = contents
+        if common_prefixes:
+            response["CommonPrefixes"] = [{"Prefix": prefix} for prefix in common_prefixes]
+        if is_truncated:
+            response["NextContinuationToken"] = last
+        return response
+
+    def get_paginator(self, operation_name: str) -> "LocalPaginator":
+        if operation_name != "list_objects_v2":
+            raise NotImplementedError(operation_name)
+        return LocalPaginator(self)
+
+
+class LocalPaginator:
+    def __init__(self, client: LocalS3Client) -> None:
+        self.client = client
+
+    def paginate(self, **kwargs) -> Iterator[dict]:
+        page_size = kwargs.pop("PaginationConfig", {}).get("PageSize", MAX_LIST_KEYS)
+        token = None
+        while True:
+            page = self.client.list_objects_v2(MaxKeys=page_size, ContinuationToken=token, **kwargs)
+            yield page
+            if not page["IsTruncated"]:
+                break
+            token = page["NextContinuationToken"]
@@ -1,114 +1,200 @@
-from math import factorial
+import inspect
 from typing import List, Optional, Union, Dict, Tuple
 import itertools
 import pandas as pd
-import seaborn as sns
-import matplotlib.pyplot as plt
 import numpy as np
+import scipy.sparse as sp
 from collections import defaultdict
 
+from journeys import JourneyStore
 
-# Shapley values calculation: 
-
-# Computing normalizing factor for marginal contribution
-shapley_weight = lambda p, s: (factorial(s)*factorial(p-s-1)/factorial(p))
-
-# Getting shapley value of a given channel and values mapping for channel subsets.
-def compute_shapley_values(v_values_map: dict, 
-                            channel: str,
-                            n_channels: int) -> float:
-    # Initiating shap with marginal contribution from S = null subset
-    shap = 1/n_channels * v_values_map.get(channel, 0) 
-    for subset_str, subset_contrib in v_values_map.items():
-        subset = subset_str.split(",")
-        if channel not in subset:
-            subset_union_channel = ','.join(sorted(subset + [channel]))
-            marginal_contrib = (v_values_map.get(subset_union_channel,0) -
-                                v_values_map.get(subset_str,0))
-            shap += shapley_weight(n_channels, len(subset)) * marginal_contrib
-    
-    return shap
 
-# Helper function to generate subsets for a given set of channels
-def generate_subsets(touchpoints: List[str]) -> List[List[str]]:
-    subset_list = []
-    for subset_size in range(len(touchpoints)):
-        for subset in itertools.combinations(touchpoints, subset_size + 1):
-            subset_list.append(list(sorted(subset)))
-    return subset_list
+# Shapley values calculation:
+
+# The utility used here, v(S) = total contribution of the journeys whose channels are all in S, is a sum of unanimity games: one per journey,
+# worth the journey's contribution whenever S contains all of its distinct channels. Shapley values are additive over games, and the
+# Shapley value of a unanimity game splits its worth equally among its members. So the Shapley value of a channel is the sum, over the
+# journeys it occurs in, of the journey's contribution divided by its no:of distinct channels. This is exact, linear in the no:of touches,
+# and has no limit on the no:of channels.
 
-# Computes the utility function value v(s) for given subset S, using contribution values for all subsets.
-def utility_function(touchpoint_set: List[str], 
-                     contributions_mapping: dict) -> Union[int, float]:
-    subset_list = generate_subsets(touchpoint_set)
-    return sum([contributions_mapping.get(','.join(subset),0) for subset in subset_list])
+def shapley_values_from_journeys(codes: np.ndarray, 
+                                 offsets: np.ndarray, 
+                                 n_channels: int, 
+                                 contributions: np.ndarray) -> np.ndarray:
+    """Shapley values of all channels from encoded journeys (see encode_journeys), in code order.
 
+    Args:
+        codes (np.ndarray): Channel code of every touch, back to back
+        offsets (np.ndarray): Journey boundaries
+        n_channels (int): No:of channels (codes are in [0, n_channels))
+        contributions (np.ndarray): Contribution of each journey
 
-# Master function combining all the above functions to compute shapley values for each touchpoint from a list of journeys. 
-def get_shapley_values(journeys_list: List[List[str]], 
-                       contribs_list: List[Union[int, float]])->Optional[Dict[str, float]]:
+    Returns:
+        np.ndarray: Shapley value of each channel
+    """
+    n_journeys = len(offsets) - 1
+    journey_ids = np.repeat(np.arange(n_journeys, dtype=np.int64), np.diff(offsets))
+    # (journey, channel) pairs, with repeated touches of a channel within a journey collapsed
+    pairs = np.sort(journey_ids * n_channels + codes)
+    distinct_pairs = pairs[np.concatenate([[True], pairs[1:] != pairs[:-1]])] if len(pairs) > 0 else pairs
+    pair_journeys, pair_channels = distinct_pairs // n_channels, distinct_pairs % n_channels
+    n_distinct_channels = np.bincount(pair_journeys, minlength=n_journeys)
+    contributions = np.asarray(contributions, dtype=np.float64)
+    shares = contributions[pair_journeys] / n_distinct_channels[pair_journeys]
+    return np.bincount(pair_channels, weights=shares, minlength=n_channels)
+
+# Master function combining all the above functions to compute shapley values for each touchpoint from a list of journeys.
+def get_shapley_values(journeys_list: Union[List[List[str]], JourneyStore],
+                       contribs_list: Optional[List[Union[int, float]]]=None)->Optional[Dict[str, float]]:
     """
 
     Args:
-        journeys_list (List[List[str]]): List of journeys.
+        journeys_list (Union[List[List[str]], JourneyStore]): List of journeys, or a JourneyStore.
          Each journey is a list of touchpoints..
-        contribs_list (List[Union[int, float]]): List of contributions corresponding to each journey in journeys_list.
-         Should have same length as journeys_list
+        contribs_list (Optional[List[Union[int, float]]]): List of contributions corresponding to each journey in journeys_list.
+         Should have same length as journeys_list. Defaults to 1 for each journey. For a weighted JourneyStore, contributions are multiplied by the journey weights.
 
     Returns:
-        Dict[str, float]: A dictionary with key as channel/touchpoint, and Shapley value as its value 
+        Dict[str, float]: A dictionary with key as channel/touchpoint, and Shapley value as its value
     """
     try:
-        flattened_journeys = [channel for journey in journeys_list for channel in set(journey)]
-        unique_channels = sorted(list(set(flattened_journeys)))
-        all_subsets = generate_subsets(unique_channels)
-        contrib_map = {}
-        for n, journey in enumerate(journeys_list):
-            journey_ = ",".join(sorted(set(journey))) # Ensures deduplication and sorting of journeys
-            contrib_map[journey_] = contrib_map.get(journey_,0) + contribs_list[n]
-        v_values = {}
-        for subset in all_subsets:
-            v_values[",".join(subset)] = utility_function(subset, contrib_map)
-
-        shapley_values = {}
-        for channel in unique_channels:
-            shapley_values[channel] = compute_shapley_values(v_values, 
-                                                              channel, 
-                                                              len(unique_channels))
-        return shapley_values
+        if isinstance(journeys_list, JourneyStore):
+            unique_channels = sorted(journeys_list.vocabulary[code] for code in np.unique(journeys_list.codes))
+        else:
+            flattened_journeys = [channel for journey in journeys_list for channel in set(journey)]
+            unique_channels = sorted(list(set(flattened_journeys)))
+        if contribs_list is None:
+            contribs_list = np.ones(len(journeys_list))
+        if isinstance(journeys_list, JourneyStore) and journeys_list.weights is not None:
+            contribs_list = np.asarray(contribs_list, dtype=np.float64) * journeys_list.weights
+        codes, offsets = encode_journeys(journeys_list, unique_channels)
+        shapley_values = shapley_values_from_journeys(codes, offsets, len(unique_channels), contribs_list)
+        return dict(zip(unique_channels, shapley_values.tolist()))
     except Exception as e:
         print(e)
         return None
+
     
 #  Markov chain values
 
+# Journeys are encoded once into flat integer arrays (CSR style): codes holds the touch index of every touch of every journey,
+# back to back, and journey i spans codes[offsets[i]:offsets[i+1]].
+
+def encode_journeys(journey_list: Union[List[List[str]], JourneyStore], distinct_touches_list: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """Encodes journeys as flat int32 touch codes and int64 journey offsets.
+
+    Args:
+        journey_list (Union[List[List[str]], JourneyStore]): List of journeys, each a list of touchpoints, or a JourneyStore (already encoded).
+        distinct_touches_list (List[str]): All the touches. Code of a touch is its position in this list.
 
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: codes (length = total touches) and offsets (length = no:of journeys + 1)
+    """
+    if isinstance(journey_list, JourneyStore):
+        return journey_list.codes_for(distinct_touches_list), journey_list.offsets
+    lengths = np.fromiter((len(journey) for journey in journey_list), dtype=np.int64, count=len(journey_list))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    flat_touches = list(itertools.chain.from_iterable(journey_list))
+    codes = pd.Index(distinct_touches_list).get_indexer(flat_touches).astype(np.int32)
+    if (codes < 0).any():
+        raise ValueError("Journeys contain touchpoints that are not in the list of distinct touches")
+    return codes, offsets
 
-def generate_transition_counts(journey_list: List[List[str]], 
+def count_transitions(codes: np.ndarray, 
+                      offsets: np.ndarray, 
+                      n_touches: int, 
+                      is_positive: bool, 
+                      journey_weights: Optional[np.ndarray]=None,
+                      sparse: bool=False) -> Union[np.array, sp.csr_matrix]:
+    """Counts transitions of encoded journeys with a single bincount over (from, to) state pairs.
+    States are ordered as (Start, touches..., Dropoff, Converted). Empty journeys are ignored.
+    If journey_weights is given, transitions of journey i are counted journey_weights[i] times.
+    If sparse is True, returns a CSR matrix holding only the observed transitions, instead of a dense (n_touches+3)^2 array.
+    """
+    n_states = n_touches + 3
+    destination_state = n_states - 1 if is_positive else n_states - 2
+    states = codes.astype(np.int64) + 1
+    lengths = np.diff(offsets)
+    first_idx = offsets[:-1][lengths > 0]
+    last_idx = offsets[1:][lengths > 0] - 1
+    is_last = np.zeros(len(states), dtype=bool)
+    is_last[last_idx] = True
+    within_journey = ~is_last[:-1] # Consecutive touches that belong to the same journey
+    from_states = np.concatenate([np.zeros(len(first_idx), dtype=np.int64), 
+                                  states[:-1][within_journey], 
+                                  states[last_idx]])
+    to_states = np.concatenate([states[first_idx], 
+                                states[1:][within_journey], 
+                                np.full(len(last_idx), destination_state, dtype=np.int64)])
+    pair_weights = None
+    n_absorbed = len(last_idx)
+    if journey_weights is not None:
+        journey_weights = np.asarray(journey_weights, dtype=np.float64)
+        touch_weights = np.repeat(journey_weights, lengths)
+        nonempty_weights = journey_weights[lengths > 0]
+        pair_weights = np.concatenate([nonempty_weights, touch_weights[:-1][within_journey], nonempty_weights])
+        n_absorbed = nonempty_weights.sum()
+    if sparse:
+        from_states = np.append(from_states, destination_state)
+        to_states = np.append(to_states, destination_state)
+        pair_weights = np.append(np.ones(len(from_states) - 1) if pair_weights is None else pair_weights, n_absorbed)
+        # Duplicate (from, to) pairs are summed while converting to CSR
+        return sp.coo_matrix((pair_weights, (from_states, to_states)), shape=(n_states, n_states)).tocsr()
+    transition_counts = np.bincount(from_states * n_states + to_states, weights=pair_weights, minlength=n_states * n_states).reshape(n_states, n_states).astype(np.float64)
+    transition_counts[destination_state, destination_state] += n_absorbed
+    return transition_counts
+
+def generate_transition_counts(journey_list: Union[List[List[str]], JourneyStore], 
                                distinct_touches_list: List[str], 
-                               is_positive: bool):
-    if is_positive:
-        destination_idx = -1
-    else:
-        destination_idx = -2
-    transition_counts = np.zeros(((len(distinct_touches_list)+3), (len(distinct_touches_list)+3)))
-    for journey in journey_list:
-        transition_counts[0, (distinct_touches_list.index(journey[0])+1)] += 1 # First point in the path
-        for n, touch_point in enumerate(journey):
-            if n == len(journey) - 1:
-                # Reached last point
-                transition_counts[(distinct_touches_list.index(touch_point)+1), destination_idx] += 1
-                transition_counts[destination_idx, destination_idx]+=1
-            else:
-                transition_counts[(distinct_touches_list.index(touch_point)+1), (distinct_touches_list.index(journey[n+1]) + 1)] +=1
-    transition_labels = distinct_touches_list.copy()
+                               is_positive: bool,
+                               sparse: bool=False):
+    codes, offsets = encode_journeys(journey_list, distinct_touches_list)
+    journey_weights = journey_list.weights if isinstance(journey_list, JourneyStore) else None
+    transition_counts = count_transitions(codes, offsets, len(distinct_touches_list), is_positive, journey_weights, sparse)
+    transition_labels = list(distinct_touches_list).copy()
     transition_labels.insert(0, "Start")
     transition_labels.extend(["Dropoff", "Converted"])
     return transition_counts, transition_labels
 
-row_normalize_np_array = lambda transition_counts: transition_counts / transition_counts.sum(axis=1)[:, np.newaxis]
+def row_normalize_np_array(transition_counts: Union[np.array, sp.spmatrix]) -> Union[np.array, sp.csr_matrix]:
+    # Rows without any transition (absorbing states, touches never left) stay all zeros instead of becoming nan
+    if sp.issparse(transition_counts):
+        row_sums = np.asarray(transition_counts.sum(axis=1)).ravel()
+        inverse_sums = np.divide(1., row_sums, out=np.zeros_like(row_sums), where=row_sums > 0)
+        return sp.diags(inverse_sums) @ sp.csr_matrix(transition_counts)
+    row_sums = transition_counts.sum(axis=1)[:, np.newaxis]
+    return np.divide(transition_counts, row_sums, out=np.zeros(transition_counts.shape), where=row_sums > 0)
 
-def plot_transitions(transition_probabilities: np.array, labels: List[str], title="Transition Probabilities", show_annotations=True):
+def top_states(transition_probabilities: Union[np.array, sp.spmatrix], 
+               labels: List[str], 
+               top_n: int, 
+               state_weights: Optional[np.array]=None) -> Tuple[np.array, List[str]]:
+    """Dense view of the transitions among Start, the top_n touches by state_weights (total transitions into each state by default)
+    and the absorbing states. This keeps the heatmap readable (and small) for large vocabularies.
+    """
+    if state_weights is None:
+        state_weights = np.asarray(transition_probabilities.sum(axis=0)).ravel()
+    touch_states = np.arange(1, len(labels) - 2)
+    top_touch_states = np.sort(touch_states[np.argsort(-state_weights[touch_states], kind="stable")[:top_n]])
+    states = np.concatenate([[0], top_touch_states, [len(labels) - 2, len(labels) - 1]])
+    view = transition_probabilities[states][:, states]
+    view = view.toarray() if sp.issparse(view) else view
+    return view, [labels[i] for i in states]
+
+def plot_transitions(transition_probabilities: Union[np.array, sp.spmatrix], 
+                     labels: List[str], 
+                     title="Transition Probabilities", 
+                     show_annotations=True, 
+                     top_n: Optional[int]=None):
+    """Heatmap of the transition probabilities. If top_n is given (or the matrix is sparse, with top_n defaulting to 30),
+    only the transitions among the top_n touches (along with Start, Dropoff and Converted) are shown.
+    """
+    if top_n is None and sp.issparse(transition_probabilities):
+        top_n = 30
+    if top_n is not None:
+        transition_probabilities, labels = top_states(transition_probabilities, labels, top_n)
+    import seaborn as sns
     ax = sns.heatmap(transition_probabilities,
                      linewidths=0.5,
                      robust=True, 
@@ -125,12 +211,13 @@ def plot_transitions(transition_probabilities: np.array, labels: List[str], titl
     ax.set_title(title);
 
 
-def get_transition_probabilities(converted_touchpoints_list: List[List[int]], 
-                                 dropoff_touchpoints_list: List[List[int]], 
+def get_transition_probabilities(converted_touchpoints_list: Union[List[List[int]], JourneyStore], 
+                                 dropoff_touchpoints_list: Union[List[List[int]], JourneyStore], 
                                  distinct_touches_list: List[str], 
-                                 visualize=False) -> Tuple[np.array, List[str]]:
-    pos_transitions, _ = generate_transition_counts(converted_touchpoints_list, distinct_touches_list, is_positive=True)
-    neg_transitions, labels = generate_transition_counts(dropoff_touchpoints_list, distinct_touches_list, is_positive=False)
+                                 visualize=False,
+                                 sparse: bool=False) -> Tuple[Union[np.array, sp.csr_matrix], List[str]]:
+    pos_transitions, _ = generate_transition_counts(converted_touchpoints_list, distinct_touches_list, is_positive=True, sparse=sparse)
+    neg_transitions, labels = generate_transition_counts(dropoff_touchpoints_list, distinct_touches_list, is_positive=False, sparse=sparse)
     all_transitions = pos_transitions + neg_transitions
     transition_probabilities = row_normalize_np_array(all_transitions)
     if visualize:
@@ -152,6 +239,118 @@ def converge(transition_matrix, max_iters=200, verbose=True):
     return T_upd
 
 
+# Closed form solution of the absorbing chain.
+# States are ordered as (Start, touches..., Dropoff, Converted), where Dropoff and Converted are absorbing. With Q being the
+# transitions among the transient states (Start and touches) and r the one step conversion probabilities, the probability of
+# eventually converting from each transient state is x = (I - Q)^-1 r, where N = (I - Q)^-1 is the fundamental matrix.
+# This replaces the repeated matrix multiplications in converge with one linear solve.
+# For sparse (CSR) transition matrices, I - Q is factorized once with a sparse LU (splu), and the solves reuse the factors.
+# scipy.sparse.linalg (and seaborn/matplotlib for plot_transitions) are imported on first use, as they make up most of the import time of this module.
+
+MARKOV_SOLVERS = ("iterative", "linear_solve", "sherman_morrison")
+
+def get_conversion_probabilities(transition_probs: Union[np.array, sp.spmatrix]) -> np.array:
+    """Returns the probability of eventually converting from each transient state. Index 0 is the Start state."""
+    n_transient = transition_probs.shape[0] - 2
+    if sp.issparse(transition_probs):
+        transition_probs = sp.csr_matrix(transition_probs)
+        i_minus_q = sp.identity(n_transient, format="csc") - transition_probs[:n_transient, :n_transient].tocsc()
+        from scipy.sparse.linalg import splu
+        return splu(i_minus_q, permc_spec=SPARSE_LU_ORDERING).solve(transition_probs[:n_transient, -1].toarray().ravel())
+    i_minus_q = np.eye(n_transient) - transition_probs[:n_transient, :n_transient]
+    return np.linalg.solve(i_minus_q, transition_probs[:n_transient, -1])
+
+# Fill reducing ordering for splu. Transitions between touches tend to go both ways, so I - Q is close to structurally symmetric,
+# and the minimum degree ordering on A^T + A gives much sparser factors than the default (COLAMD).
+SPARSE_LU_ORDERING = "MMD_AT_PLUS_A"
+
+# No:of columns of the inverse computed per batch of sparse solves, when only its diagonal is needed
+FUNDAMENTAL_MATRIX_BATCH_SIZE = 256
+
+def get_removal_affects_sparse(transition_probs: sp.spmatrix,
+                               labels: List[str],
+                               ignore_labels: List[str]=["Start", "Dropoff","Converted"],
+                               use_rank_one_updates: bool=True) -> Tuple[Dict[str, float], float]:
+    """Sparse version of get_removal_affects_closed_form. The fundamental matrix N is never formed:
+    x comes from one solve, row 0 of N from one transposed solve, and diag(N) from batches of solves against unit vectors,
+    all with the same LU factors. Memory is O(nnz of the factors + n * FUNDAMENTAL_MATRIX_BATCH_SIZE).
+    """
+    from scipy.sparse.linalg import splu
+    transition_probs = sp.csr_matrix(transition_probs)
+    n_transient = transition_probs.shape[0] - 2
+    i_minus_q = (sp.identity(n_transient, format="csr") - transition_probs[:n_transient, :n_transient]).tocsc()
+    to_conversion = transition_probs[:n_transient, -1].toarray().ravel()
+    lu = splu(i_minus_q, permc_spec=SPARSE_LU_ORDERING)
+    conversion_probs = lu.solve(to_conversion)
+    removal_affect = {}
+    removable = [n for n, label in enumerate(labels[:n_transient]) if label not in ignore_labels]
+    if use_rank_one_updates:
+        unit_row = np.zeros(n_transient)
+        unit_row[0] = 1.
+        first_row = lu.solve(unit_row, trans="T") # N[0, :]
+        diagonal = np.zeros(n_transient)
+        for start in range(0, len(removable), FUNDAMENTAL_MATRIX_BATCH_SIZE):
+            columns = np.array(removable[start:start + FUNDAMENTAL_MATRIX_BATCH_SIZE])
+            unit_vectors = np.zeros((n_transient, len(columns)))
+            unit_vectors[columns, np.arange(len(columns))] = 1.
+            diagonal[columns] = lu.solve(unit_vectors)[columns, np.arange(len(columns))]
+        for n in removable:
+            removal_affect[labels[n]] = first_row[n] * conversion_probs[n] / diagonal[n]
+    else:
+        i_minus_q = i_minus_q.tolil()
+        for n in removable:
+            drop_i_minus_q = i_minus_q.copy()
+            drop_i_minus_q[n, :] = 0.
+            drop_i_minus_q[n, n] = 1.
+            drop_to_conversion = to_conversion.copy()
+            drop_to_conversion[n] = 0.
+            removal_affect[labels[n]] = conversion_probs[0] - splu(drop_i_minus_q.tocsc(), permc_spec=SPARSE_LU_ORDERING).solve(drop_to_conversion)[0]
+    return removal_affect, conversion_probs[0]
+
+def get_removal_affects_closed_form(transition_probs: Union[np.array, sp.spmatrix], 
+                                    labels: List[str], 
+                                    ignore_labels: List[str]=["Start", "Dropoff","Converted"],
+                                    use_rank_one_updates: bool=True) -> Tuple[Dict[str, float], float]:
+    """Computes the drop in conversion probability when each touch is removed (all its transitions redirected to Dropoff).
+
+    Args:
+        transition_probs (np.array): Row normalized transition matrix, with states in the order (Start, touches..., Dropoff, Converted)
+        labels (List[str]): Label of each state
+        ignore_labels (List[str], optional): States which are not touches, and hence not removed.
+        use_rank_one_updates (bool, optional): If True, all removals are computed at once from the fundamental matrix.
+         Removing touch n replaces row n of (I - Q) with the unit row e_n, which is a rank one update. By Sherman-Morrison,
+         the conversion probability from Start then becomes x[0] - N[0,n] * x[n] / N[n,n].
+         If False, one linear solve is done per removal. Defaults to True.
+
+    Returns:
+        Tuple[Dict[str, float], float]: Removal affect of each touch, and the conversion probability with all touches present.
+    """
+    if sp.issparse(transition_probs):
+        return get_removal_affects_sparse(transition_probs, labels, ignore_labels, use_rank_one_updates)
+    n_transient = transition_probs.shape[0] - 2
+    i_minus_q = np.eye(n_transient) - transition_probs[:n_transient, :n_transient]
+    to_conversion = transition_probs[:n_transient, -1]
+    removal_affect = {}
+    if use_rank_one_updates:
+        fundamental_matrix = np.linalg.inv(i_minus_q)
+        conversion_probs = fundamental_matrix @ to_conversion
+        removal_drops = fundamental_matrix[0, :] * conversion_probs / np.diag(fundamental_matrix)
+        for n, label in enumerate(labels[:n_transient]):
+            if label not in ignore_labels:
+                removal_affect[label] = removal_drops[n]
+    else:
+        conversion_probs = np.linalg.solve(i_minus_q, to_conversion)
+        for n, label in enumerate(labels[:n_transient]):
+            if label in ignore_labels:
+                continue
+            drop_i_minus_q = i_minus_q.copy()
+            drop_i_minus_q[n, :] = 0.
+            drop_i_minus_q[n, n] = 1.
+            drop_to_conversion = to_conversion.copy()
+            drop_to_conversion[n] = 0.
+            removal_affect[label] = conversion_probs[0] - np.linalg.solve(drop_i_minus_q, drop_to_conversion)[0]
+    return removal_affect, conversion_probs[0]
+
 def get_removal_affects(transition_probs, labels, ignore_labels=["Start", "Dropoff","Converted"], default_conversion=1.):
     removal_affect = {}
     for n, label in enumerate(labels):
@@ -165,29 +364,333 @@ def get_removal_affects(transition_probs, labels, ignore_labels=["Start", "Dropo
             removal_affect[label] = default_conversion - drop_transition_converged[0,-1]
     return removal_affect
 
-def get_markov_attribution(tp_list_positive: List[List[int]],
-                           tp_list_negative: List[List[int]], 
+def get_markov_attribution(tp_list_positive: Union[List[List[int]], JourneyStore],
+                           tp_list_negative: Union[List[List[int]], JourneyStore], 
                            distinct_touches_list: List[str], 
-                           visualize=False) -> Tuple[Dict[str, float], np.array]:
-    transition_probabilities, labels = get_transition_probabilities(tp_list_positive, tp_list_negative, distinct_touches_list, visualize=visualize)
-    transition_probabilities_converged = converge(transition_probabilities, max_iters=500, verbose=False)
-    removal_affects = get_removal_affects(transition_probabilities, labels, default_conversion=transition_probabilities_converged[0,-1])
-    total_conversions = len(tp_list_positive)
+                           visualize=False,
+                           solver: str="iterative",
+                           sparse: bool=False,
+                           order: int=1) -> Tuple[Dict[str, float], Union[np.array, sp.csr_matrix]]:
+    """
+    Args:
+        tp_list_positive (Union[List[List[int]], JourneyStore]): Converted journeys
+        tp_list_negative (Union[List[List[int]], JourneyStore]): Journeys that did not convert
+        distinct_touches_list (List[str]): All the touches
+        visualize (bool, optional): If True, plots the transition probabilities. Defaults to False.
+        solver (str, optional): One of MARKOV_SOLVERS. Defaults to "iterative".
+            iterative: Matrix powers until convergence (tolerance 1e-5), repeated for each removal.
+            linear_solve: Exact absorption probabilities, with one linear solve per removal.
+            sherman_morrison: Exact absorption probabilities, with all removals from a single inverse via rank one updates.
+        sparse (bool, optional): If True, transitions are kept in scipy.sparse CSR matrices end to end, for large vocabularies
+         (ex: n_top_events null). Needs one of the closed form solvers. The heatmap then shows only the top touches. Defaults to False.
+        order (int, optional): Order of the chain, i.e. no:of previous touches that make up a state. Orders above 1 use
+         get_markov_attribution_order_k, which is always sparse and exact, irrespective of solver and sparse. Defaults to 1.
+
+    Returns:
+        Tuple[Dict[str, float], Union[np.array, sp.csr_matrix]]: Conversions attributed to each touch, and the transition probabilities
+    """
+    if order > 1:
+        attributable_conversions, transition_probabilities, labels = get_markov_attribution_order_k(tp_list_positive, tp_list_negative, distinct_touches_list, order)
+        if visualize:
+            plot_transitions(transition_probabilities, labels, show_annotations=True)
+        return attributable_conversions, transition_probabilities
+    pos_transitions, _ = generate_transition_counts(tp_list_positive, distinct_touches_list, is_positive=True, sparse=sparse)
+    neg_transitions, labels = generate_transition_counts(tp_list_negative, distinct_touches_list, is_positive=False, sparse=sparse)
+    total_conversions = tp_list_positive.total_weight if isinstance(tp_list_positive, JourneyStore) else len(tp_list_positive)
+    return get_markov_attribution_from_counts(pos_transitions, neg_transitions, labels, total_conversions, visualize=visualize, solver=solver)
+
+def drop_unvisited_touches(transition_counts: np.array, labels: List[str]) -> Tuple[np.array, List[str]]:
+    """Removes the touches that have no outgoing transitions (ex: touches absent from a subsample), which would otherwise
+    be rows of nan after normalization. Start and the absorbing states are always kept.
+    """
+    visited = np.flatnonzero(np.asarray(transition_counts[1:-2].sum(axis=1)).ravel() > 0) + 1
+    states = np.concatenate([[0], visited, [len(labels) - 2, len(labels) - 1]])
+    return transition_counts[states][:, states], [labels[i] for i in states]
+
+def get_markov_attribution_from_counts(pos_transitions: Union[np.array, sp.spmatrix],
+                                       neg_transitions: Union[np.array, sp.spmatrix],
+                                       labels: List[str],
+                                       total_conversions: Union[int, float],
+                                       visualize=False,
+                                       solver: str="iterative") -> Tuple[Dict[str, float], Union[np.array, sp.csr_matrix]]:
+    """Markov attribution from transition counts of converted and non converted journeys (generate_transition_counts).
+    See get_markov_attribution for the arguments.
+    """
+    if solver not in MARKOV_SOLVERS:
+        raise ValueError(f"Unknown solver {solver}. Should be one of {MARKOV_SOLVERS}")
+    if solver == "iterative" and (sp.issparse(pos_transitions) or sp.issparse(neg_transitions)):
+        raise ValueError("Sparse transition counts need one of the closed form solvers (linear_solve, sherman_morrison)")
+    all_transitions = pos_transitions + neg_transitions
+    transition_probabilities = row_normalize_np_array(all_transitions)
+    if visualize:
+        plot_transitions(transition_probabilities, labels, show_annotations=True)
+    # Touches without outgoing transitions (ex: in distinct_touches_list, but absent from the journeys) are never reached. Their rows
+    # would be nan (dense), which makes I - Q singular, so they are left out of the chain and get 0 attribution.
+    chain_transitions, chain_labels = drop_unvisited_touches(all_transitions, labels)
+    chain_probabilities = transition_probabilities if len(chain_labels) == len(labels) else row_normalize_np_array(chain_transitions)
+    if solver == "iterative":
+        transition_probabilities_converged = converge(chain_probabilities, max_iters=500, verbose=False)
+        removal_affects = get_removal_affects(chain_probabilities, chain_labels, default_conversion=transition_probabilities_converged[0,-1])
+    else:
+        removal_affects, _ = get_removal_affects_closed_form(chain_probabilities, chain_labels, use_rank_one_updates=(solver == "sherman_morrison"))
+    removal_affects = {label: removal_affects.get(label, 0.) for label in labels[1:-2]}
     attributable_conversions = {}
     total_weight = sum(removal_affects.values())
     for tp, weight in removal_affects.items():
         attributable_conversions[tp] = weight/total_weight * total_conversions
     return attributable_conversions, transition_probabilities
 
-# First touch and last touch
+# Higher order Markov chains.
+# In an order k chain, a state is the tuple of the last k touches (fewer, at the start of a journey), so a journey a > b > c has
+# the states (a), (a, b), (a, b, c) for k = 3, and (a), (a, b), (b, c) for k = 2. Each tuple is packed into one int64, with one digit of
+# base n_touches + 1 per position (the extra digit value pads the positions before the start of the journey). Only the states that
+# occur in the journeys are built, and they are then numbered 0..n-1 and counted with count_transitions as if they were touches.
+# Removing a touch removes every state that contains it: those states are made to drop off, which is the same as solving the
+# absorbing chain restricted to the remaining states.
 
-def get_single_touch_attribution(df: pd.DataFrame, col_events: str, last_touch: bool, normalize: bool) -> Optional[dict]:
-    try:
-        if last_touch:
-            idx = -1
+def pack_order_k_states(codes: np.ndarray, offsets: np.ndarray, n_touches: int, order: int) -> np.ndarray:
+    """Packed state (last `order` touches, most recent in the lowest digit) at every touch of the encoded journeys"""
+    base = n_touches + 1
+    if base ** order >= 2 ** 62:
+        raise ValueError(f"{n_touches} touches with order {order} do not fit in int64 states")
+    journey_starts = np.repeat(offsets[:-1], np.diff(offsets))
+    positions = np.arange(len(codes))
+    states = np.zeros(len(codes), dtype=np.int64)
+    for lag in range(order):
+        lagged_codes = np.full(len(codes), n_touches, dtype=np.int64)
+        valid = positions - lag >= journey_starts
+        lagged_codes[valid] = codes[positions[valid] - lag]
+        states += lagged_codes * base ** lag
+    return states
+
+def unpack_order_k_states(packed_states: np.ndarray, n_touches: int, order: int) -> np.ndarray:
+    """Touch codes of packed states, as an array of shape (n_states, order) with the oldest touch first. Padding is n_touches."""
+    base = n_touches + 1
+    digits = np.stack([(packed_states // base ** lag) % base for lag in range(order)], axis=1)
+    return digits[:, ::-1]
+
+# Absorption probabilities of the order k chains come from GMRES, which only needs sparse matrix vector products. The LU factors of
+# I - Q fill in heavily once states have many successors, while GMRES converges in a few dozen iterations, as Q is substochastic.
+KRYLOV_TOLERANCE = 1e-12
+
+def solve_absorption(i_minus_q: sp.spmatrix, rhs: np.ndarray) -> np.ndarray:
+    """Solves (I - Q) x = rhs with GMRES, falling back to a sparse LU if it does not converge"""
+    from scipy.sparse.linalg import splu, gmres
+    tolerance_arg = "rtol" if "rtol" in inspect.signature(gmres).parameters else "tol" # Renamed in scipy 1.12
+    solution, info = gmres(i_minus_q, rhs, atol=0., restart=50, maxiter=1000, **{tolerance_arg: KRYLOV_TOLERANCE})
+    if info != 0:
+        solution = splu(sp.csc_matrix(i_minus_q), permc_spec=SPARSE_LU_ORDERING).solve(rhs)
+    return solution
+
+def get_removal_affects_order_k(transition_probs: sp.spmatrix, 
+                                state_touches: np.ndarray, 
+                                distinct_touches_list: List[str]) -> Tuple[Dict[str, float], float]:
+    """Drop in conversion probability when all the states containing a touch are removed (redirected to Dropoff).
+
+    Args:
+        transition_probs (sp.spmatrix): Row normalized transitions, with states in the order (Start, states..., Dropoff, Converted)
+        state_touches (np.ndarray): Output of unpack_order_k_states for the states, in the same order
+        distinct_touches_list (List[str]): All the touches
+
+    Returns:
+        Tuple[Dict[str, float], float]: Removal affect of each touch, and the conversion probability with all touches present.
+    """
+    transition_probs = sp.csr_matrix(transition_probs)
+    n_transient = transition_probs.shape[0] - 2
+    i_minus_q = (sp.identity(n_transient, format="csr") - transition_probs[:n_transient, :n_transient]).tocsr()
+    to_conversion = transition_probs[:n_transient, -1].toarray().ravel()
+    base_conversion = solve_absorption(i_minus_q, to_conversion)[0]
+    removal_affect = {}
+    for code, touch in enumerate(distinct_touches_list):
+        contains_touch = (state_touches == code).any(axis=1)
+        if not contains_touch.any():
+            continue
+        remaining = np.concatenate([[0], np.flatnonzero(~contains_touch) + 1])
+        removal_affect[touch] = base_conversion - solve_absorption(i_minus_q[remaining][:, remaining], to_conversion[remaining])[0]
+    return removal_affect, base_conversion
+
+def get_markov_attribution_order_k(tp_list_positive: Union[List[List[int]], JourneyStore],
+                                   tp_list_negative: Union[List[List[int]], JourneyStore], 
+                                   distinct_touches_list: List[str],
+                                   order: int=2,
+                                   path_separator: str=">") -> Tuple[Dict[str, float], sp.csr_matrix, List[str]]:
+    """Markov attribution with an order k chain. Transitions are always sparse, and the absorption probabilities exact.
+
+    Args:
+        tp_list_positive (Union[List[List[int]], JourneyStore]): Converted journeys
+        tp_list_negative (Union[List[List[int]], JourneyStore]): Journeys that did not convert
+        distinct_touches_list (List[str]): All the touches
+        order (int, optional): No:of previous touches that make up a state. Defaults to 2.
+        path_separator (str, optional): Separator of the touches in the state labels. Defaults to ">".
+
+    Returns:
+        Tuple[Dict[str, float], sp.csr_matrix, List[str]]: Conversions attributed to each touch, the transition probabilities and their state labels
+    """
+    n_touches = len(distinct_touches_list)
+    pos_codes, pos_offsets = encode_journeys(tp_list_positive, distinct_touches_list)
+    neg_codes, neg_offsets = encode_journeys(tp_list_negative, distinct_touches_list)
+    pos_states = pack_order_k_states(pos_codes, pos_offsets, n_touches, order)
+    neg_states = pack_order_k_states(neg_codes, neg_offsets, n_touches, order)
+    observed_states, state_idx = np.unique(np.concatenate([pos_states, neg_states]), return_inverse=True)
+    state_idx = state_idx.reshape(-1)
+    pos_weights = tp_list_positive.weights if isinstance(tp_list_positive, JourneyStore) else None
+    neg_weights = tp_list_negative.weights if isinstance(tp_list_negative, JourneyStore) else None
+    transitions = (count_transitions(state_idx[:len(pos_states)], pos_offsets, len(observed_states), True, pos_weights, sparse=True)
+                   + count_transitions(state_idx[len(pos_states):], neg_offsets, len(observed_states), False, neg_weights, sparse=True))
+    transition_probabilities = row_normalize_np_array(transitions)
+    state_touches = unpack_order_k_states(observed_states, n_touches, order)
+    touch_names = np.asarray(list(distinct_touches_list) + [None], dtype=object)
+    labels = ["Start"] + [path_separator.join(touch_names[digits[digits < n_touches]]) for digits in state_touches] + ["Dropoff", "Converted"]
+    removal_affects, _ = get_removal_affects_order_k(transition_probabilities, state_touches, distinct_touches_list)
+    total_conversions = tp_list_positive.total_weight if isinstance(tp_list_positive, JourneyStore) else len(tp_list_positive)
+    total_weight = sum(removal_affects.values())
+    attributable_conversions = {touch: weight/total_weight * total_conversions for touch, weight in removal_affects.items()}
+    return attributable_conversions, transition_probabilities, labels
+
+# Rule based attribution: first touch, last touch, linear, position based (U shaped) and time decay
+
+RULE_BASED_METHODS = ("first_touch", "last_touch", "linear", "position_based", "time_decay")
+NS_PER_DAY = 24 * 3600 * 10**9
+
+def get_touch_credits(journeys: JourneyStore,
+                      methods: Tuple[str] = RULE_BASED_METHODS,
+                      position_weights: Tuple[float, float, float] = (0.4, 0.2, 0.4),
+                      half_life_days: float = 7.) -> np.ndarray:
+    """Credit of every touch of every journey under each method, as an array of shape (len(methods), no:of touches).
+    Credits of each journey sum to 1 under every method. All methods are computed from the position of each touch in its journey,
+    so a new rule is one more vectorized expression over the same arrays.
+
+    Args:
+        journeys (JourneyStore): Journeys. time_decay needs their timestamps.
+        methods (Tuple[str], optional): Any of RULE_BASED_METHODS. Defaults to RULE_BASED_METHODS.
+        position_weights (Tuple[float, float, float], optional): Share of the first touch, the middle touches together, and the last touch
+            in position_based. Journeys of two touches split first + last between them in the same ratio. Defaults to (0.4, 0.2, 0.4).
+        half_life_days (float, optional): In time_decay, a touch gets half the credit of a touch half_life_days later. Defaults to 7.
+
+    Returns:
+        np.ndarray: Credits, in the order of methods
+    """
+    lengths = journeys.lengths
+    journey_ids = journeys.journey_ids
+    journey_lengths = lengths[journey_ids].astype(np.float64)
+    positions = np.arange(len(journeys.codes)) - np.repeat(journeys.offsets[:-1], lengths)
+    is_first = positions == 0
+    is_last = positions == journey_lengths - 1
+    first_weight, middle_weight, last_weight = position_weights
+    credits = np.empty((len(methods), len(journeys.codes)))
+    for n, method in enumerate(methods):
+        if method == "first_touch":
+            credits[n] = is_first
+        elif method == "last_touch":
+            credits[n] = is_last
+        elif method == "linear":
+            credits[n] = 1 / journey_lengths
+        elif method == "position_based":
+            ends = np.where(is_first, first_weight, last_weight)
+            credits[n] = np.where(journey_lengths <= 2,
+                                  ends / np.where(journey_lengths == 1, ends, first_weight + last_weight),
+                                  np.where(is_first | is_last, ends, middle_weight / np.maximum(journey_lengths - 2, 1)))
+        elif method == "time_decay":
+            if journeys.timestamps is None:
+                raise ValueError("time_decay needs the journey timestamps. Compressed journeys do not have them.")
+            # Decay is measured back from the last touch of each journey. Measuring from the conversion instead scales all the touches
+            # of a journey by the same factor, which the normalization cancels out.
+            last_timestamps = journeys.timestamps[journeys.offsets[1:][lengths > 0] - 1]
+            age_days = (last_timestamps[np.cumsum(lengths > 0)[journey_ids] - 1] - journeys.timestamps) / NS_PER_DAY
+            decay = np.exp2(-age_days / half_life_days)
+            credits[n] = decay / np.bincount(journey_ids, weights=decay, minlength=len(journeys))[journey_ids]
         else:
-            idx = 0
-        return df[col_events].apply(lambda event_list: event_list[idx]).value_counts(normalize=normalize).to_dict()
+            raise ValueError(f"Unknown method {method}. Expected one of {RULE_BASED_METHODS}")
+    return credits
+
+
+def get_rule_based_totals(journeys: JourneyStore,
+                          methods: Tuple[str] = RULE_BASED_METHODS,
+                          position_weights: Tuple[float, float, float] = (0.4, 0.2, 0.4),
+                          half_life_days: float = 7.) -> pd.DataFrame:
+    """Credits of the journeys summed up per touch under each method, weighted by the journey weights, with a single bincount.
+    The totals add up across disjoint sets of journeys, so the totals of batches of journeys can be summed (DataFrame.add with fill_value=0).
+    time_decay is left out if the journeys have no timestamps.
+
+    Returns:
+        pd.DataFrame: Attributed conversions, with the methods as rows and the vocabulary of the journeys as columns
+    """
+    valid_methods = [method for method in methods if method != "time_decay" or journeys.timestamps is not None]
+    n_touches = len(journeys.vocabulary)
+    if not valid_methods:
+        return pd.DataFrame(np.zeros((0, n_touches)), columns=journeys.vocabulary)
+    credits = get_touch_credits(journeys, tuple(valid_methods), position_weights, half_life_days)
+    credits *= journeys.journey_weights[journeys.journey_ids]
+    # Method n, touch c goes to bin n * n_touches + c
+    bins = (np.arange(len(valid_methods))[:, None] * n_touches + journeys.codes).reshape(-1)
+    totals = np.bincount(bins, weights=credits.reshape(-1), minlength=len(valid_methods) * n_touches).reshape(len(valid_methods), n_touches)
+    return pd.DataFrame(totals, index=valid_methods, columns=journeys.vocabulary)
+
+
+def get_rule_based_attribution_from_totals(totals: pd.DataFrame,
+                                           methods: Tuple[str] = RULE_BASED_METHODS,
+                                           is_count: bool = True,
+                                           normalize: bool = False) -> Dict[str, Optional[dict]]:
+    """Attribution of each method from its totals (get_rule_based_totals). Methods without totals give None.
+
+    Args:
+        totals (pd.DataFrame): Attributed conversions, methods as rows and touches as columns
+        methods (Tuple[str], optional): Methods to return. Defaults to RULE_BASED_METHODS.
+        is_count (bool, optional): Whether the journey weights are user counts, in which case first and last touch values are rounded to ints.
+            Defaults to True.
+        normalize (bool, optional): If True, values of each method sum to 1 instead of the no:of conversions. Defaults to False.
+
+    Returns:
+        Dict[str, Optional[dict]]: Attribution of each method
+    """
+    results = {method: None for method in methods}
+    for method in methods:
+        if method not in totals.index:
+            continue
+        values = totals.loc[method]
+        values = values[values > 0].sort_values(ascending=False)
+        if is_count and method in ("first_touch", "last_touch"):
+            values = values.round().astype(np.int64)
+        if normalize:
+            values = values / values.sum()
+        results[method] = values.to_dict()
+    return results
+
+
+def get_rule_based_attribution(journeys: Union[pd.DataFrame, JourneyStore],
+                               col_events: Optional[str] = None,
+                               methods: Tuple[str] = RULE_BASED_METHODS,
+                               position_weights: Tuple[float, float, float] = (0.4, 0.2, 0.4),
+                               half_life_days: float = 7.,
+                               normalize: bool = False) -> Dict[str, Optional[dict]]:
+    """Attribution of the converted journeys under each rule based method, all at once: the credits of all the methods are summed up per touch
+    with a single bincount (get_rule_based_totals). Each method gives a dict of touch: attributed conversions, same as get_single_touch_attribution,
+    so the results can be passed to merge_dictionaries as they are. A method that fails gives None instead.
+
+    Args:
+        journeys (Union[pd.DataFrame, JourneyStore]): Converted journeys. A dataframe has a list of touches per row in col_events.
+        col_events (Optional[str], optional): Column with the touches, if journeys is a dataframe. Defaults to None.
+        methods (Tuple[str], optional): Any of RULE_BASED_METHODS. Defaults to RULE_BASED_METHODS.
+        position_weights (Tuple[float, float, float], optional): See get_touch_credits. Defaults to (0.4, 0.2, 0.4).
+        half_life_days (float, optional): See get_touch_credits. Defaults to 7.
+        normalize (bool, optional): If True, values of each method sum to 1 instead of the no:of conversions. Defaults to False.
+
+    Returns:
+        Dict[str, Optional[dict]]: Attribution of each method
+    """
+    if isinstance(journeys, pd.DataFrame):
+        journeys = JourneyStore.from_lists(journeys[col_events].tolist())
+    if "time_decay" in methods and journeys.timestamps is None:
+        print("time_decay needs the journey timestamps. Compressed journeys do not have them.")
+    totals = get_rule_based_totals(journeys, methods, position_weights, half_life_days)
+    is_count = (np.mod(journeys.journey_weights, 1) == 0).all() # User counts, as in the unweighted case
+    return get_rule_based_attribution_from_totals(totals, methods, is_count, normalize)
+
+
+def get_single_touch_attribution(df: Union[pd.DataFrame, JourneyStore], col_events: str, last_touch: bool, normalize: bool) -> Optional[dict]:
+    method = "last_touch" if last_touch else "first_touch"
+    try:
+        return get_rule_based_attribution(df, col_events, methods=(method,), normalize=normalize)[method]
     except Exception as e:
         print(e)
         return None
@@ -203,11 +706,16 @@ def merge_dictionaries(dictionaries:Tuple[Optional[dict]], labels:Tuple[str]) ->
     return pd.DataFrame.from_dict(merged_dict, orient='index')
 
 
-# Test cases: 
-# Case 1: When one of the dicts is empty
-assert (merge_dictionaries([None, {"a":1,"b":2}, {"a":4, "b":5}] , ['c1', 'c2', 'c3']) == 
-        pd.DataFrame.from_dict({"a":[1,4],"b":[2,5]}, orient='index',columns=['c2','c3'])).all().all()
+if __name__ == "__main__":
+    # Test cases: 
+    # Case 1: When one of the dicts is empty
+    assert (merge_dictionaries([None, {"a":1,"b":2}, {"a":4, "b":5}] , ['c1', 'c2', 'c3']) == 
+            pd.DataFrame.from_dict({"a":[1,4],"b":[2,5]}, orient='index',columns=['c2','c3'])).all().all()
 
-# Case 2: Mismatching in touch points. Some touchpoints are missing in one of the dictionaries
-assert (merge_dictionaries([{"a":1,"b":2}, {"a":1}, {"a":4, "b":5}] , ['c1', 'c2', 'c3']).fillna(-1) == 
-        pd.DataFrame.from_dict({"a":[1,1,4],"b":[2,None,5]}, orient='index',columns=['c1','c2','c3']).fillna(-1)).all().all()
\ No newline at end of file
+    # Case 2: Mismatching in touch points. Some touchpoints are missing in one of the dictionaries
+    assert (merge_dictionaries([{"a":1,"b":2}, {"a":1}, {"a":4, "b":5}] , ['c1', 'c2', 'c3']).fillna(-1) == 
+            pd.DataFrame.from_dict({"a":[1,1,4],"b":[2,None,5]}, orient='index',columns=['c1','c2','c3']).fillna(-1)).all().all()
+    # Case 3: Touches in distinct_touches_list but absent from the journeys get 0 attribution, with every solver
+    for solver in MARKOV_SOLVERS:
+        markov_values, _ = get_markov_attribution([["a", "b"], ["b"]], [["a"], ["b", "a"]], ["a", "b", "c"], solver=solver)
+        assert markov_values["c"] == 0 and abs(markov_values["a"] + markov_values["b"] - 2) < 1e-6
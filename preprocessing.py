@@ -0,0 +1,523 @@
+"""
+Cleanup steps applied on the raw touches data before journeys are built.
+Each step works on whole columns at once (no row wise apply), so it scales with the event volumes of the warehouse tables.
+"""
+
+import time
+from functools import reduce
+from typing import Iterable, Iterator, List, Optional, Tuple
+import pandas as pd
+import numpy as np
+
+
+def timestamps_to_ns(timestamps: pd.Series) -> np.ndarray:
+    """Converts a datetime column to int64 nanoseconds since epoch (UTC for tz aware columns). NaT values map to the min int64."""
+    timestamps = pd.to_datetime(timestamps)
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert(None)
+    return timestamps.to_numpy(dtype="datetime64[ns]").view(np.int64)
+
+
+def get_duplicate_mask(df: pd.DataFrame,
+                       primary_key: str,
+                       timestamp: str,
+                       event_type: str,
+                       max_lag: int,
+                       previous_row: Optional[pd.Series] = None) -> np.ndarray:
+    """Flags rows that repeat the previous row's primary key and event within max_lag seconds. df is expected to be sorted by (primary_key, timestamp).
+
+    Args:
+        df (pd.DataFrame): User touches, sorted by primary key and timestamp
+        primary_key (str): column name of the column that contains user_id.
+        timestamp (str): column name of the column that contains event timestamp
+        event_type (str): column name of the column that contains event/touch data
+        max_lag (int): max time (in sec) between consecutive events to be considered as duplicates.
+        previous_row (Optional[pd.Series], optional): Row preceding the first row of df (when df is a chunk of a larger sorted table). Defaults to None.
+
+    Returns:
+        np.ndarray: Boolean array, True for the rows that are duplicates.
+    """
+    keys = df[primary_key].to_numpy()
+    # Categorical events (ex: from EventEncoder) are compared by their int codes instead of the strings
+    is_categorical = isinstance(df[event_type].dtype, pd.CategoricalDtype)
+    events = df[event_type].cat.codes.to_numpy() if is_categorical else df[event_type].to_numpy()
+    timestamps = df[timestamp]
+    ts_valid = timestamps.notnull().to_numpy()
+    ts_ns = timestamps_to_ns(timestamps)
+    # Python float nan never equals itself, but None does. A null previous value is never a duplicate, as in the original row wise logic
+    valid_key = pd.notnull(keys)
+    valid_event = events >= 0 if is_categorical else pd.notnull(events)
+    max_lag_ns = max_lag * 1_000_000_000
+
+    is_duplicate = np.zeros(len(df), dtype=bool)
+    if len(df) > 1:
+        is_duplicate[1:] = ((keys[1:] == keys[:-1]) & valid_key[:-1]
+                            & (events[1:] == events[:-1]) & valid_event[:-1]
+                            & ts_valid[1:] & ts_valid[:-1]
+                            & ((ts_ns[1:] - ts_ns[:-1]) <= max_lag_ns))
+    if previous_row is not None and len(df) > 0:
+        prev_ts = previous_row[timestamp]
+        if not (pd.isnull(previous_row[primary_key]) or pd.isnull(previous_row[event_type]) or pd.isnull(prev_ts) or not ts_valid[0]):
+            is_duplicate[0] = bool(keys[0] == previous_row[primary_key]
+                                   and df[event_type].iloc[0] == previous_row[event_type]
+                                   and (timestamps.iloc[0] - prev_ts).total_seconds() <= max_lag)
+    return is_duplicate
+
+
+def dedup_by_ts_delta(df: pd.DataFrame, primary_key: str, timestamp: str, event_type: str, max_lag: int) -> pd.DataFrame:
+    """
+    ### Parameters
+    1. df : pd.DataFrame
+        - User touches dataframe.
+    2. primary_key : str
+        - column name of the column that contains user_id.
+    3. timestamp: str
+        - column name of the column that contains event timestamp
+    4. event_type: str
+        - column name of the column that contains event/touch data
+    5. max_lag: int
+        - max time (in sec) between consecutive events to be considered as duplicates.
+
+    ### Returns
+    - DataFrame after doing following steps
+    Based on primary key and event_type, it checks if two consecutive events occur within the max_lag time window. If so, they are considered same event and the latter event is dropped.
+    """
+    if max_lag <= 0:
+        return df
+    # Stable sort: touches of a user with the same timestamp keep their order, so the result does not depend on how the rows are chunked
+    df = df.sort_values(by=[primary_key, timestamp], ascending=True, kind="mergesort").reset_index(drop=True)
+    is_duplicate = get_duplicate_mask(df, primary_key, timestamp, event_type, max_lag)
+    return df[~is_duplicate].reset_index(drop=True)
+
+
+def dedup_by_ts_delta_chunked(chunks: Iterable[pd.DataFrame],
+                              primary_key: str,
+                              timestamp: str,
+                              event_type: str,
+                              max_lag: int) -> Iterator[pd.DataFrame]:
+    """Same as dedup_by_ts_delta, for data that does not fit in memory at once.
+    The chunks together should be sorted by (primary_key, timestamp), ex: consecutive batches of a query with `order by primary_key, timestamp`.
+    The last row of each chunk is carried over to the next one, so duplicates across chunk boundaries are dropped too.
+    Concatenating the yielded chunks gives the same rows as dedup_by_ts_delta on the full data.
+
+    Args:
+        chunks (Iterable[pd.DataFrame]): User touches, in chunks
+        primary_key (str): column name of the column that contains user_id.
+        timestamp (str): column name of the column that contains event timestamp
+        event_type (str): column name of the column that contains event/touch data
+        max_lag (int): max time (in sec) between consecutive events to be considered as duplicates.
+
+    Yields:
+        Iterator[pd.DataFrame]: Deduplicated chunks
+    """
+    previous_row = None
+    for chunk in chunks:
+        if max_lag <= 0 or len(chunk) == 0:
+            yield chunk
+            continue
+        chunk = chunk.sort_values(by=[primary_key, timestamp], ascending=True, kind="mergesort").reset_index(drop=True)
+        is_duplicate = get_duplicate_mask(chunk, primary_key, timestamp, event_type, max_lag, previous_row)
+        previous_row = chunk.iloc[-1]
+        yield chunk[~is_duplicate].reset_index(drop=True)
+
+
+def get_conversion_timestamps(df: pd.DataFrame, primary_key: str, timestamp: str, event_type: str, conversion_event: str) -> pd.Series:
+    """Timestamp of the first conversion of each user who converted, indexed by primary key"""
+    return df.loc[df[event_type] == conversion_event].groupby(primary_key)[timestamp].min()
+
+
+def separate_conversions(df: pd.DataFrame,
+                         primary_key: str,
+                         timestamp: str,
+                         event_type: str,
+                         conversion_event: str,
+                         converted_ts_col: str,
+                         multi_conversion: bool = False,
+                         conversion_timestamps: Optional[pd.Series] = None) -> Tuple[pd.DataFrame, pd.Series]:
+    """Splits the raw events into touches and conversions. Touches after a user's first conversion are dropped, and the conversion
+    timestamp of each touch is added as converted_ts_col (null for users who did not convert).
+    With multi_conversion, no touches are dropped. Instead, every conversion of a user gets the touches since the previous one,
+    as a journey of its own (see sessionize_conversions).
+
+    Args:
+        df (pd.DataFrame): Raw events, conversions included
+        primary_key (str): column name of the column that contains user_id.
+        timestamp (str): column name of the column that contains event timestamp
+        event_type (str): column name of the column that contains event/touch data
+        conversion_event (str): Event that marks a conversion
+        converted_ts_col (str): Name of the column the conversion timestamps are written to
+        multi_conversion (bool, optional): Whether to sessionize the touches by conversion. Defaults to False.
+        conversion_timestamps (Optional[pd.Series], optional): First conversion timestamp of each user who converted, indexed by primary key,
+         if already known (ex: df is a chunk of the events, and the user's conversion is in another chunk). Not supported with multi_conversion.
+         Defaults to None, which reads them from df.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.Series]: Deduplicated touches, and the conversion timestamp of each converted journey, indexed by its key
+    """
+    if multi_conversion:
+        if conversion_timestamps is not None:
+            raise ValueError("conversion_timestamps can not be given with multi_conversion")
+        return sessionize_conversions(df, primary_key, timestamp, event_type, conversion_event, converted_ts_col)
+    if conversion_timestamps is None:
+        conversion_timestamps = get_conversion_timestamps(df, primary_key, timestamp, event_type, conversion_event)
+    touches = df.loc[df[event_type] != conversion_event]
+    converted_ts = touches[primary_key].map(conversion_timestamps)
+    is_before_conversion = (converted_ts.isnull() | (touches[timestamp] <= converted_ts)).to_numpy()
+    touches = touches.loc[is_before_conversion].assign(**{converted_ts_col: converted_ts.loc[is_before_conversion]})
+    return touches.drop_duplicates(), conversion_timestamps
+
+
+def get_journey_keys(primary_keys: pd.Series, journey_numbers: np.ndarray) -> pd.Series:
+    """<primary key>_<journey number>, null where the primary key is null"""
+    return (primary_keys.astype(str) + "_" + pd.Series(journey_numbers, index=primary_keys.index).astype(str)).where(primary_keys.notnull())
+
+
+def sessionize_conversions(df: pd.DataFrame,
+                           primary_key: str,
+                           timestamp: str,
+                           event_type: str,
+                           conversion_event: str,
+                           converted_ts_col: str) -> Tuple[pd.DataFrame, pd.Series]:
+    """Splits the events of each user at every conversion. Touches up to (and including the timestamp of) a user's n-th conversion and after
+    the previous one make up journey n, and the touches after the last conversion make up a journey that did not convert.
+    The primary key column of the touches is replaced by the journey key, <primary key>_<n>, so the rest of the pipeline treats each journey
+    as a user of its own.
+
+    Every touch is matched to its conversion with a binary search over the conversions sorted by (user, timestamp). Users and timestamps of the
+    touches and conversions are encoded together as ints first, so the search compares single int64 keys.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.Series]: Deduplicated touches, and the conversion timestamp of each converted journey, indexed by the journey key
+    """
+    is_conversion = (df[event_type] == conversion_event).to_numpy()
+    conversions = df.loc[is_conversion & df[primary_key].notnull().to_numpy() & df[timestamp].notnull().to_numpy()]
+    touches = df.loc[~is_conversion]
+    n_touches = len(touches)
+    user_codes, _ = pd.factorize(pd.concat([touches[primary_key], conversions[primary_key]], ignore_index=True))
+    _, ts_ranks = np.unique(np.concatenate([timestamps_to_ns(touches[timestamp]), timestamps_to_ns(conversions[timestamp])]), return_inverse=True)
+    n_ranks = int(ts_ranks.max()) + 1 if len(ts_ranks) > 0 else 1
+    keys = user_codes.astype(np.int64) * n_ranks + ts_ranks.reshape(-1)
+    touch_keys, conversion_keys = keys[:n_touches], keys[n_touches:]
+    order = np.argsort(conversion_keys, kind="stable")
+    conversion_keys = conversion_keys[order]
+
+    touch_users = user_codes[:n_touches].astype(np.int64)
+    user_start = np.searchsorted(conversion_keys, touch_users * n_ranks, side="left")
+    user_end = np.searchsorted(conversion_keys, (touch_users + 1) * n_ranks, side="left")
+    next_conversion = np.searchsorted(conversion_keys, touch_keys, side="left") # First conversion at or after the touch
+    is_converted = (next_conversion < user_end) & (touch_users >= 0)
+    conversion_number = next_conversion - user_start
+
+    conversion_ts = conversions[timestamp].iloc[order]
+    converted_ts = conversion_ts.iloc[np.minimum(next_conversion, len(conversion_ts) - 1)] if len(conversion_ts) else pd.Series(pd.NaT, index=range(n_touches))
+    converted_ts = pd.Series(converted_ts.to_numpy(), index=touches.index).where(is_converted)
+    touches = touches.assign(**{primary_key: get_journey_keys(touches[primary_key], conversion_number), converted_ts_col: converted_ts})
+    # As with a single conversion, touches without a timestamp are kept only for users who never converted
+    touches = touches.loc[touches[timestamp].notnull().to_numpy() | (user_end == user_start)]
+
+    conversion_users = user_codes[n_touches:][order].astype(np.int64)
+    conversion_numbers = np.arange(len(order)) - np.searchsorted(conversion_keys, conversion_users * n_ranks, side="left")
+    conversion_timestamps = pd.Series(conversion_ts.to_numpy(),
+                                      index=pd.Index(get_journey_keys(conversions[primary_key].iloc[order], conversion_numbers), name=primary_key),
+                                      name=timestamp)
+    return touches.drop_duplicates(), conversion_timestamps
+
+
+def label_conversions(touches: pd.DataFrame,
+                      primary_key: str,
+                      conversion_timestamps: pd.Series,
+                      converted_ts_col: str,
+                      is_converted_col: str = "is_converted") -> pd.DataFrame:
+    """Adds the conversion timestamp of each touch's user (converted_ts_col) and whether the user converted (is_converted_col, 1 or 0)"""
+    touches[converted_ts_col] = touches[primary_key].map(conversion_timestamps)
+    touches[is_converted_col] = touches[primary_key].isin(conversion_timestamps.index).astype(int)
+    return touches
+
+
+def get_conversion_summary(converted_touches: pd.DataFrame,
+                           primary_key: str,
+                           timestamp: str,
+                           event_type: str,
+                           conversion_timestamps: pd.Series) -> pd.DataFrame:
+    """One row per converted user, with the first touch timestamp, the no:of touches (n_<event_type>), the no:of distinct touches
+    (n_distinct_<event_type>), and the no:of whole days from the first touch to the conversion (days_to_convert)"""
+    summary = (converted_touches
+               .groupby(primary_key)
+               .agg(**{timestamp: (timestamp, "min"), f"n_{event_type}": (event_type, "size"), f"n_distinct_{event_type}": (event_type, "nunique")})
+               .reset_index())
+    summary["days_to_convert"] = (summary[primary_key].map(conversion_timestamps) - summary[timestamp]).dt.days
+    return summary
+
+
+def get_default_event(all_events: Iterable[str]) -> str:
+    """'others', or 'others_<epoch time>' if 'others' is one of the events already"""
+    all_events = set(all_events)
+    default_event = 'others'
+    if default_event in all_events:
+        curr_time = int(time.time())
+        while f"{default_event}_{curr_time}" in all_events:
+            curr_time+=1
+        default_event = f"{default_event}_{curr_time}"
+    return default_event
+
+
+def get_top_k_touches(df: pd.DataFrame, event_col: str, top_k: Optional[int]=None) -> pd.DataFrame:
+    """
+    Picks only the top k touches and groups rest all as 'others'. If 'others' is one of the events, it appends that with current epoch time
+    """
+    if top_k is None:
+        return df
+    else:
+        event_counts = df[event_col].value_counts()
+        top_k_events = event_counts.index[:top_k]
+        default_event = get_default_event(event_counts.index)
+        df[event_col] = df[event_col].where(df[event_col].isin(top_k_events), default_event)
+    return df
+
+
+class EventEncoder:
+    def __init__(self, top_k: Optional[int] = None, mapping: Optional[dict] = None) -> None:
+        """Encodes the event column as a pandas Categorical, with the top k folding and the event grouping applied to the categories.
+        The events are hashed once, in fit. Top k and the grouping are then worked out per distinct event, into a lookup table from
+        the raw event codes to the codes of the final vocabulary, so only the lookup touches every row.
+        Same events as get_top_k_touches followed by the mapping (events_type_mapping in the notebook), with the vocabulary sorted.
+
+        Args:
+            top_k (Optional[int], optional): Keeps the top_k events by volume, and folds the rest, including null events, into one
+                default event (see get_default_event). None keeps all events. Defaults to None.
+            mapping (Optional[dict], optional): {event: group} applied after the top k folding. Events not in it are kept as is,
+                and events mapped to None are set to null. Defaults to None.
+        """
+        self.top_k = top_k
+        self.mapping = mapping or {}
+        self.default_event = None
+        self.event_counts = None
+        self.n_null_events = 0
+        self.raw_events = None
+        self.vocabulary = None
+        self.lookup = None
+        self._fit_codes = None
+
+    def fit(self, events: pd.Series) -> "EventEncoder":
+        codes, raw_events = pd.factorize(events)
+        counts = np.bincount(codes[codes >= 0], minlength=len(raw_events))
+        self._fit_vocabulary(raw_events, counts, int((codes < 0).sum()))
+        self._fit_codes = codes
+        return self
+
+    def fit_counts(self, event_counts: pd.Series) -> "EventEncoder":
+        """Same as fit, from the no:of occurrences of each event instead of the events themselves (ex: a group by count in the warehouse,
+        sql_queries.prepare_touch_counts_query), so that the events can then be transformed chunk by chunk. Null events are counted
+        under a null index entry. Events with the same count are ranked by name, where fit ranks them by first occurrence.
+        """
+        is_null = pd.isnull(event_counts.index)
+        counts = event_counts[~is_null].sort_index(kind="mergesort")
+        self._fit_vocabulary(counts.index, counts.to_numpy().astype(np.int64), int(event_counts[is_null].sum()))
+        return self
+
+    def _fit_vocabulary(self, raw_events: pd.Index, counts: np.ndarray, n_null_events: int) -> None:
+        self.raw_events = pd.Index(raw_events)
+        self.event_counts = pd.Series(counts, index=raw_events).sort_values(ascending=False, kind="mergesort")
+        self.n_null_events = n_null_events
+        # The last entry of the lookup is for null events (raw code -1). They stay null, or are folded into the default event with top k.
+        null_event = None
+        if self.top_k is not None:
+            self.default_event = get_default_event(raw_events)
+            null_event = self.default_event if self.n_null_events > 0 else None
+        names = pd.Series(np.append(np.asarray(raw_events, dtype=object), null_event), dtype=object)
+        if self.top_k is not None:
+            names = names.where(names.isin(self.event_counts.index[:self.top_k]) | names.isnull(), self.default_event)
+        names = names.map(lambda event: self.mapping.get(event, event))
+        self.vocabulary = sorted(names.dropna().unique())
+        self.lookup = pd.Index(self.vocabulary).get_indexer(names).astype(np.int32) # -1 for events mapped to None
+
+    def transform(self, events: pd.Series, codes: Optional[np.ndarray] = None) -> pd.Series:
+        """Returns events as a categorical series over the vocabulary. Null events, and events mapped to None, are null.
+        Raises ValueError for events that were not seen in fit."""
+        if codes is None:
+            codes = self.raw_events.get_indexer(events)
+            unseen = (codes < 0) & pd.notnull(events).to_numpy()
+            if unseen.any():
+                raise ValueError(f"Events not seen in fit: {list(pd.unique(events[unseen]))[:10]}")
+        vocabulary_codes = self.lookup[codes] # Null events (-1) pick the last entry of the lookup
+        return pd.Series(pd.Categorical.from_codes(vocabulary_codes, categories=self.vocabulary), index=events.index, name=events.name)
+
+    def fit_transform(self, events: pd.Series) -> pd.Series:
+        self.fit(events)
+        encoded = self.transform(events, codes=self._fit_codes)
+        self._fit_codes = None
+        return encoded
+
+    @property
+    def folded_fraction(self) -> float:
+        """Fraction of the events in fit that were outside the top k, or null"""
+        n_events = self.event_counts.sum() + self.n_null_events
+        if self.top_k is None or n_events == 0:
+            return 0.
+        return float((self.event_counts.iloc[self.top_k:].sum() + self.n_null_events) / n_events)
+
+    def observed(self, encoded_events: pd.Series) -> List[str]:
+        """Vocabulary entries that occur in encoded_events (ex: after rows are filtered out), in vocabulary order"""
+        codes = encoded_events.cat.codes.to_numpy()
+        present = np.bincount(codes[codes >= 0], minlength=len(self.vocabulary)) > 0
+        return [event for event, is_present in zip(self.vocabulary, present) if is_present]
+
+
+def get_events_type_mapping(group_events_mapping: Optional[dict]) -> Optional[dict]:
+    """Inverts the {group: [touches]} mapping of the config (group_events_mapping) into {touch: group}, as used by EventEncoder"""
+    if not group_events_mapping:
+        return None
+    return reduce(lambda x, y: {**x, **y}, [{val: key for val in list_vals} for key, list_vals in group_events_mapping.items()])
+
+
+def process_raw_data(raw_data_df: pd.DataFrame,
+                     primary_key: str,
+                     timestamp: str,
+                     event_type: str,
+                     dedup_min_time: int,
+                     filter_columns: Optional[List[str]] = None,
+                     ignore_events: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    ### Parameters
+    1. raw_data_df : Touches, after the conversion events are separated and the touches are grouped (EventEncoder)
+    2. primary_key, timestamp, event_type: Column names of the user id, event timestamp and event/touch
+    3. dedup_min_time: Time (in sec) between two events of same type. Events that repeat within this interval are combined as one (earlier timestamp is considered)
+    4. filter_columns: Columns to keep. Defaults to all.
+    5. ignore_events: Touches to drop. Defaults to none.
+
+    ### Returns
+    - DataFrame after doing following steps
+    1. Drops null touches and exact duplicate rows
+    2. Deduplicates repeated touches within dedup_min_time (dedup_by_ts_delta)
+    3. Ignores touches based on ignore_events list
+    """
+    dedup_data_df = dedup_by_ts_delta(raw_data_df[raw_data_df[event_type].notnull()].drop_duplicates(),
+                                      primary_key,
+                                      timestamp,
+                                      event_type,
+                                      dedup_min_time)
+    if filter_columns is not None:
+        dedup_data_df = dedup_data_df.filter(filter_columns)
+    return dedup_data_df[~dedup_data_df[event_type].isin(ignore_events or [])]
+
+
+def process_raw_chunks(chunks: Iterable[pd.DataFrame],
+                       primary_key: str,
+                       timestamp: str,
+                       event_type: str,
+                       conversion_event: str,
+                       converted_ts_col: str,
+                       conversion_timestamps: pd.Series,
+                       event_encoder: EventEncoder,
+                       dedup_min_time: int,
+                       filter_columns: Optional[List[str]] = None,
+                       ignore_events: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+    """The steps of separate_conversions, EventEncoder.transform, process_raw_data and label_conversions, for raw events read in chunks
+    (ex: ConnectorBase.run_query_iter). Steps that need all the events are worked out beforehand, from queries that return one row per user
+    or per event: the conversion timestamps (sql_queries.prepare_conversions_query) and the encoder (EventEncoder.fit_counts over
+    sql_queries.prepare_touch_counts_query). The dedup carries the last row of each chunk over to the next (dedup_by_ts_delta_chunked).
+
+    The chunks together should be sorted by (primary_key, timestamp, event_type), so that exact duplicate rows are next to each other.
+    Exact duplicates split across two chunks are dropped by the dedup, for dedup_min_time > 0.
+
+    Yields:
+        Iterator[pd.DataFrame]: Touches of each chunk, with the filter_columns and the converted_ts_col and is_converted columns
+    """
+    def clean_chunks():
+        for chunk in chunks:
+            touches, _ = separate_conversions(chunk, primary_key, timestamp, event_type, conversion_event, converted_ts_col,
+                                              conversion_timestamps=conversion_timestamps)
+            touches[event_type] = event_encoder.transform(touches[event_type])
+            yield touches[touches[event_type].notnull()].drop_duplicates()
+
+    for touches in dedup_by_ts_delta_chunked(clean_chunks(), primary_key, timestamp, event_type, dedup_min_time):
+        if filter_columns is not None:
+            touches = touches.filter(filter_columns)
+        touches = touches[~touches[event_type].isin(ignore_events or [])]
+        yield label_conversions(touches.copy(), primary_key, conversion_timestamps, converted_ts_col)
+
+
+if __name__ == "__main__":
+    # Test cases:
+    test_df = pd.DataFrame.from_dict({"uid":[1,2,3],"event":['e1','e1','e2']})
+    assert (get_top_k_touches(test_df, 'event') == test_df ).all().all()
+    assert (get_top_k_touches(test_df, 'event',1) ==  pd.DataFrame.from_dict({"uid":[1,2,3],"event":['e1','e1','others']})).all().all()
+
+    test_df = pd.DataFrame.from_dict({"uid":[1,2,3],"event":['e1','e1','others']})
+    assert (get_top_k_touches(test_df, 'event',1) ==  pd.DataFrame.from_dict({"uid":[1,2,3],"event":['e1','e1',f'others_{int(time.time())}']})).all().all()
+
+    curr_time = int(time.time())
+    test_df = pd.DataFrame.from_dict({"uid":[1,2,3,4],"event":['e1','e1','others',f'others_{curr_time}']})
+    assert (get_top_k_touches(test_df, 'event',1) ==  pd.DataFrame.from_dict({"uid":[1,2,3,4],"event":['e1','e1',f'others_{curr_time+1}',f'others_{curr_time+1}']})).all().all()
+
+    # EventEncoder gives the same events as top k followed by the grouping
+    test_events = pd.Series(['e1', 'e1', 'e2', 'e3', 'e3', 'e3', None, 'e4'])
+    encoder = EventEncoder(top_k=2, mapping={'e1': 'g1', 'others': None})
+    encoded = encoder.fit_transform(test_events)
+    assert encoder.vocabulary == ['e3', 'g1']
+    assert encoded.astype(object).where(encoded.notnull(), None).tolist() == ['g1', 'g1', None, 'e3', 'e3', 'e3', None, None]
+    assert (encoder.transform(test_events).cat.codes == encoded.cat.codes).all()
+    assert encoder.observed(encoded[:2]) == ['g1']
+
+    # Null events are folded into the default event with top k, as in get_top_k_touches
+    test_df = pd.DataFrame.from_dict({"uid": [1, 2, 3, 4, 5, 6], "event": ['e1', 'e1', 'e2', None, np.nan, 'e1']})
+    encoder = EventEncoder(top_k=1)
+    encoded = encoder.fit_transform(test_df['event'])
+    assert encoded.astype(object).tolist() == get_top_k_touches(test_df.copy(), 'event', 1)['event'].tolist()
+    assert encoder.vocabulary == ['e1', 'others'] and encoder.folded_fraction == 0.5
+    assert EventEncoder().fit_transform(test_df['event']).isnull().sum() == 2
+
+    assert get_events_type_mapping({'g1': ['e1', 'e2'], 'g2': ['e3']}) == {'e1': 'g1', 'e2': 'g1', 'e3': 'g2'}
+    assert get_events_type_mapping(None) is None
+    test_df = pd.DataFrame.from_dict({"uid": [1, 1, 1, 2, 2],
+                                      "event": ['e1', 'e1', None, 'e2', 'e3'],
+                                      "ts": pd.to_datetime(['2022-01-01 00:00', '2022-01-01 00:01', '2022-01-01 00:02', '2022-01-01 00:00', '2022-01-02 00:00'])})
+    processed = process_raw_data(test_df, 'uid', 'ts', 'event', 300, ['uid', 'event'], ignore_events=['e2'])
+    assert processed.values.tolist() == [[1, 'e1'], [2, 'e3']]
+
+    # Conversions: touches after the first conversion are dropped, or split into one journey per conversion with multi_conversion
+    test_df = pd.DataFrame.from_dict({"uid": [1, 1, 1, 1, 1, 2],
+                                      "event": ['e1', 'conv', 'e2', 'conv', 'e3', 'e1'],
+                                      "ts": pd.to_datetime(['2022-01-01', '2022-01-02', '2022-01-03', '2022-01-05', '2022-01-06', '2022-01-01'])})
+    touches, conversion_ts = separate_conversions(test_df, 'uid', 'ts', 'event', 'conv', 'converted_ts')
+    assert touches['event'].tolist() == ['e1', 'e1'] and conversion_ts.to_dict() == {1: pd.Timestamp('2022-01-02')}
+    assert get_conversion_summary(touches[touches['uid'] == 1], 'uid', 'ts', 'event', conversion_ts)['days_to_convert'].tolist() == [1]
+    touches, conversion_ts = separate_conversions(test_df, 'uid', 'ts', 'event', 'conv', 'converted_ts', multi_conversion=True)
+    assert touches['uid'].tolist() == ['1_0', '1_1', '1_2', '2_0']
+    assert conversion_ts.to_dict() == {'1_0': pd.Timestamp('2022-01-02'), '1_1': pd.Timestamp('2022-01-05')}
+    assert label_conversions(touches, 'uid', conversion_ts, 'converted_ts')['is_converted'].tolist() == [1, 1, 0, 0]
+
+    # Chunked dedup gives the same rows as dedup_by_ts_delta on all the rows, when chunk boundaries split a user's touches
+    test_df = pd.DataFrame.from_dict({"uid": [1, 1, 1, 1, 2, 2, 2, 3],
+                                      "event": ['e1', 'e1', 'e1', 'e2', 'e1', 'e1', 'e2', 'e2'],
+                                      "ts": pd.to_datetime(['2022-01-01 00:00', '2022-01-01 00:04', '2022-01-01 00:08', '2022-01-01 00:09',
+                                                            '2022-01-01 00:00', '2022-01-01 00:01', '2022-01-01 00:01', '2022-01-01 00:00'])})
+    split_rows = lambda df, boundaries: [df.iloc[start:end] for start, end in zip([0] + boundaries, boundaries + [len(df)])]
+    expected = dedup_by_ts_delta(test_df, 'uid', 'ts', 'event', 300)
+    for boundaries in ([1], [2], [1, 2, 3], [5], [6, 7], [0, 4, 4]):
+        chunks = split_rows(test_df, boundaries)
+        deduped = pd.concat(list(dedup_by_ts_delta_chunked(chunks, 'uid', 'ts', 'event', 300)), ignore_index=True)
+        pd.testing.assert_frame_equal(deduped, expected)
+    assert expected['event'].tolist() == ['e1', 'e2', 'e1', 'e2', 'e2']
+
+    # Encoder fitted from event counts is the same as one fitted on the events, up to ties in the counts
+    test_events = pd.Series(['e1', 'e1', 'e2', 'e3', 'e3', 'e3', None, 'e4', 'e4'])
+    encoder = EventEncoder(top_k=2, mapping={'e1': 'g1'}).fit(test_events)
+    counts_encoder = EventEncoder(top_k=2, mapping={'e1': 'g1'}).fit_counts(test_events.value_counts(dropna=False))
+    assert counts_encoder.vocabulary == encoder.vocabulary == ['e3', 'g1', 'others'] and counts_encoder.default_event == 'others'
+    assert counts_encoder.transform(test_events).tolist() == encoder.transform(test_events).tolist()
+
+    # Raw events in chunks give the same touches as the steps on all the events, with the conversions known beforehand
+    test_df = pd.DataFrame.from_dict({"uid": [1, 1, 1, 1, 1, 2, 2, 2, 3],
+                                      "event": ['e1', 'e1', 'e2', 'conv', 'e1', 'e1', 'e1', 'e3', 'e1'],
+                                      "ts": pd.to_datetime(['2022-01-01 00:00', '2022-01-01 00:00', '2022-01-01 00:03', '2022-01-01 00:04',
+                                                            '2022-01-01 00:05', '2022-01-01 00:00', '2022-01-01 00:10', '2022-01-01 00:11',
+                                                            '2022-01-01 00:00'])})
+    event_data, conversion_ts = separate_conversions(test_df, 'uid', 'ts', 'event', 'conv', 'converted_ts')
+    encoder = EventEncoder(top_k=2)
+    event_data['event'] = encoder.fit_transform(event_data['event'])
+    expected = label_conversions(process_raw_data(event_data, 'uid', 'ts', 'event', 300, ['uid', 'event', 'ts']), 'uid', conversion_ts, 'converted_ts')
+    for boundaries in ([1], [3, 4], [6]):
+        chunked = pd.concat(list(process_raw_chunks(split_rows(test_df, boundaries), 'uid', 'ts', 'event', 'conv', 'converted_ts', conversion_ts,
+                                                    encoder, 300, ['uid', 'event', 'ts'])), ignore_index=True)
+        pd.testing.assert_frame_equal(chunked, expected.reset_index(drop=True))
@@ -0,0 +1,231 @@
+"""
+Local Parquet cache of warehouse extracts.
+
+Results are keyed by a fingerprint of the normalized query and the connector identity (warehouse, account/host, database, schema, user).
+Each entry is a folder under cache_dir with one or more parquet parts and a meta.json. Entries expire after ttl_seconds, and the least
+recently used entries are evicted once the cache grows beyond max_size_bytes.
+
+For queries with a timestamp column, a cache hit fetches only the rows at or after the cached high water mark (minus lookback_seconds),
+and appends the ones that are not cached yet as a new part. Rows are matched against the cached rows of that window as a multiset, so rows
+tied with the high water mark are neither skipped nor duplicated. Rows that land in the warehouse late, with a timestamp older than the
+lookback window, are picked up only when the entry expires.
+"""
+
+import os
+import re
+import json
+import time
+import shutil
+import hashlib
+import logging
+from glob import glob
+from typing import Optional
+
+import pandas as pd
+
+
+class QueryCache:
+    def __init__(self,
+                 cache_dir: str = os.path.join("data", "query_cache"),
+                 ttl_seconds: Optional[float] = None,
+                 max_size_bytes: Optional[int] = None,
+                 lookback_seconds: float = 0) -> None:
+        """
+        Args:
+            cache_dir (str, optional): Folder where the cached extracts are stored. Defaults to data/query_cache.
+            ttl_seconds (Optional[float], optional): Entries older than this are fetched again in full. None means no expiry. Defaults to None.
+            max_size_bytes (Optional[int], optional): Max total size of the cache. None means no limit. Defaults to None.
+            lookback_seconds (float, optional): Cache hits fetch again the rows up to this long before the high water mark, to pick up
+                rows that landed late. Defaults to 0.
+        """
+        self.cache_dir = cache_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_size_bytes = max_size_bytes
+        self.lookback_seconds = lookback_seconds
+
+    @staticmethod
+    def normalize_query(query: str) -> str:
+        """Collapses whitespace and drops the trailing semicolon, so that formatting changes do not change the fingerprint"""
+        return re.sub(r"\s+", " ", query).strip().rstrip(";").strip()
+
+    @staticmethod
+    def connector_identity(connector) -> str:
+        """Identity of the warehouse a connector points to. Passwords are not part of it."""
+        creds = connector.creds or {}
+        db_config = connector.db_config or {}
+        identity = {"connector": type(connector).__name__}
+        for key in ("account_identifier", "host", "port", "user", "warehouse", "role"):
+            if key in creds:
+                identity[key] = str(creds[key])
+        for key in ("database", "schema"):
+            if key in db_config:
+                identity[key] = str(db_config[key])
+        return json.dumps(identity, sort_keys=True)
+
+    def fingerprint(self, query: str, connector_identity: str) -> str:
+        return hashlib.sha256(f"{connector_identity}\n{self.normalize_query(query)}".encode("utf-8")).hexdigest()[:32]
+
+    def _entry_dir(self, fingerprint: str) -> str:
+        return os.path.join(self.cache_dir, fingerprint)
+
+    def _read_meta(self, fingerprint: str) -> Optional[dict]:
+        meta_path = os.path.join(self._entry_dir(fingerprint), "meta.json")
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, "r") as f:
+            return json.load(f)
+
+    def _write_meta(self, fingerprint: str, meta: dict) -> None:
+        with open(os.path.join(self._entry_dir(fingerprint), "meta.json"), "w") as f:
+            json.dump(meta, f, indent=2)
+
+    def _write_part(self, fingerprint: str, df: pd.DataFrame, part_no: int) -> None:
+        df.to_parquet(os.path.join(self._entry_dir(fingerprint), f"part-{part_no:05d}.parquet"), index=False)
+
+    def _read_parts(self, fingerprint: str) -> pd.DataFrame:
+        parts = sorted(glob(os.path.join(self._entry_dir(fingerprint), "part-*.parquet")))
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+
+    @staticmethod
+    def _high_water_mark(df: pd.DataFrame, timestamp_column: Optional[str]) -> Optional[str]:
+        if timestamp_column is None or len(df) == 0 or df[timestamp_column].isnull().all():
+            return None
+        return str(pd.Timestamp(df[timestamp_column].max()))
+
+    @staticmethod
+    def _uncached_rows(fetched: pd.DataFrame, cached: pd.DataFrame) -> pd.DataFrame:
+        """Rows of fetched that are not in cached. A row that occurs n times in cached and m times in fetched is kept m - n times."""
+        columns = list(fetched.columns)
+        if len(fetched) == 0 or len(cached) == 0:
+            return fetched
+        occurrence_column = "__occurrence"
+        fetched = fetched.assign(**{occurrence_column: fetched.groupby(columns, dropna=False, sort=False).cumcount().values})
+        cached = cached[columns]
+        cached = cached.assign(**{occurrence_column: cached.groupby(columns, dropna=False, sort=False).cumcount().values})
+        is_cached = fetched.merge(cached, on=columns + [occurrence_column], how="left", indicator=True)["_merge"].to_numpy() == "both"
+        return fetched.loc[~is_cached, columns].reset_index(drop=True)
+
+    def is_expired(self, meta: dict) -> bool:
+        return self.ttl_seconds is not None and time.time() - meta["created_at"] > self.ttl_seconds
+
+    def run_query(self, connector, query: str, timestamp_column: Optional[str] = None) -> pd.DataFrame:
+        """Returns the result of the query from the cache, fetching from the warehouse only what is missing.
+
+        Args:
+            connector (ConnectorBase): Warehouse connector (wh_connectors.Connector)
+            query (str): Query to run
+            timestamp_column (Optional[str], optional): If given, cache hits fetch only the rows with this column at or after the cached max
+                (minus lookback_seconds). Defaults to None.
+
+        Returns:
+            pd.DataFrame: Query result
+        """
+        fingerprint = self.fingerprint(query, self.connector_identity(connector))
+        meta = self._read_meta(fingerprint)
+        if meta is not None and (self.is_expired(meta) or meta.get("timestamp_column") != timestamp_column):
+            logging.info(f"Query cache entry {fingerprint} is stale. Fetching the full extract again")
+            shutil.rmtree(self._entry_dir(fingerprint), ignore_errors=True)
+            meta = None
+
+        if meta is None:
+            df = connector.run_query(query)
+            os.makedirs(self._entry_dir(fingerprint), exist_ok=True)
+            self._write_part(fingerprint, df, 0)
+            meta = {"query": self.normalize_query(query),
+                    "timestamp_column": timestamp_column,
+                    "created_at": time.time(),
+                    "n_parts": 1,
+                    "high_water_mark": self._high_water_mark(df, timestamp_column)}
+        else:
+            df = self._read_parts(fingerprint)
+            if meta["high_water_mark"] is not None:
+                since = pd.Timestamp(meta["high_water_mark"]) - pd.Timedelta(seconds=self.lookback_seconds)
+                incremental_query = f"select * from ({self.normalize_query(query)}) as cached_query where {timestamp_column} >= '{since}'"
+                fetched = connector.run_query(incremental_query)
+                # The fetched rows include the cached rows of the window (at least those tied with the high water mark)
+                new_rows = self._uncached_rows(fetched, df.loc[pd.to_datetime(df[timestamp_column]) >= since])
+                logging.info(f"Query cache hit for {fingerprint}. Fetched {len(new_rows)} new rows at or after {since}")
+                if len(new_rows) > 0:
+                    self._write_part(fingerprint, new_rows, meta["n_parts"])
+                    meta["n_parts"] += 1
+                    df = pd.concat([df, new_rows], ignore_index=True)
+                    # Late rows are older than the high water mark, so it never moves back
+                    high_water_mark = self._high_water_mark(new_rows, timestamp_column)
+                    if high_water_mark is not None and pd.Timestamp(high_water_mark) > pd.Timestamp(meta["high_water_mark"]):
+                        meta["high_water_mark"] = high_water_mark
+            else:
+                logging.info(f"Query cache hit for {fingerprint}")
+        meta["last_accessed"] = time.time()
+        self._write_meta(fingerprint, meta)
+        self.evict(keep=fingerprint)
+        return df
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """Removes expired entries, and then least recently used entries until the cache is within max_size_bytes.
+        The entry with the fingerprint keep (ex: the one just written) is never evicted, though its size counts.
+        """
+        entries = []
+        for entry_dir in glob(os.path.join(self.cache_dir, "*")):
+            fingerprint = os.path.basename(entry_dir)
+            meta = self._read_meta(fingerprint)
+            if meta is None or self.is_expired(meta):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+                continue
+            size = sum(os.path.getsize(path) for path in glob(os.path.join(entry_dir, "*")))
+            entries.append((meta.get("last_accessed", meta["created_at"]), size, entry_dir, fingerprint))
+        if self.max_size_bytes is None:
+            return
+        total_size = sum(size for _, size, _, _ in entries)
+        for _, size, entry_dir, fingerprint in sorted(entries):
+            if fingerprint == keep:
+                continue
+            if total_size <= self.max_size_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= size
+
+    def clear(self) -> None:
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import sqlite3
+
+    class SqliteConnector:
+        creds, db_config = {}, {"database": "test"}
+
+        def __init__(self) -> None:
+            self.connection = sqlite3.connect(":memory:")
+            self.connection.execute("create table touches (user_id int, touch text, ts text)")
+
+        def insert(self, *rows) -> None:
+            self.connection.executemany("insert into touches values (?, ?, ?)", rows)
+
+        def run_query(self, query: str) -> pd.DataFrame:
+            return pd.read_sql(query, self.connection)
+
+    query = "select user_id, touch, ts from touches"
+    connector = SqliteConnector()
+    connector.insert((1, "email", "2022-01-01 00:00:01"), (2, "ads", "2022-01-01 00:00:02"), (2, "ads", "2022-01-01 00:00:02"))
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = QueryCache(cache_dir)
+        assert len(cache.run_query(connector, query, "ts")) == 3
+        # A row tied with the high water mark (same values as the cached ones too), a newer row, and a late row
+        connector.insert((2, "ads", "2022-01-01 00:00:02"), (3, "email", "2022-01-01 00:00:03"), (4, "ads", "2022-01-01 00:00:01"))
+        df = cache.run_query(connector, query, "ts")
+        assert len(df) == 5 and (df["user_id"] == 2).sum() == 3 and 4 not in df["user_id"].values
+        assert cache._read_meta(cache.fingerprint(query, cache.connector_identity(connector)))["high_water_mark"] == "2022-01-01 00:00:03"
+        assert len(cache.run_query(connector, query, "ts")) == 5
+
+        # Late rows within the lookback window are picked up, without duplicating the cached rows of the window
+        cache = QueryCache(cache_dir, lookback_seconds=2)
+        df = cache.run_query(connector, query, "ts")
+        assert len(df) == 6 and sorted(df["user_id"]) == sorted(pd.read_sql(query, connector.connection)["user_id"])
+        assert cache._read_meta(cache.fingerprint(query, cache.connector_identity(connector)))["high_water_mark"] == "2022-01-01 00:00:03"
+
+        # The entry just written is kept even if it alone is over max_size_bytes. The other entries are evicted.
+        cache = QueryCache(cache_dir, max_size_bytes=1)
+        assert len(cache.run_query(connector, query + " where user_id = 1")) == 1
+        assert len(glob(os.path.join(cache_dir, "*"))) == 1
+        assert len(cache.run_query(connector, query + " where user_id = 1")) == 1
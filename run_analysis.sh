@@ -6,6 +6,7 @@ ENVIRONMENT=python3
 # Reading input parameters
 instance_type="${1:-$"ml.t3.xlarge"}" # takes one of valid aws sagemaker instance types; defaults to ml.t3.xlarge
 job_id="${2:-$(date +%s)}" # takes a string or int. Usually, epoch time; defaults to current epoch time
+run_type="${3:-notebook}" # notebook (default) or headless. headless skips the notebook execution and the html report
 
 echo "job id: ${job_id}, instance type: ${instance_type}"
 jobs_list=("multi_touch_attribution")
@@ -26,7 +27,11 @@ yes | pip install -r requirements.txt --quiet
 
 for job in ${jobs_list[@]}; do
     echo "$(date): Running ${job}"
-    python launch_sagemaker_job.py --job ${job} --instance ${instance_type} --id ${job_id}
+    if [ "${run_type}" = "headless" ]; then
+        python launch_sagemaker_job.py --job ${job} --instance ${instance_type} --id ${job_id} --headless
+    else
+        python launch_sagemaker_job.py --job ${job} --instance ${instance_type} --id ${job_id}
+    fi
 done
 
 conda deactivate
@@ -7,6 +7,9 @@ import zipfile
 from typing import Optional
 import json
 
+# Analysis config inside the sagemaker processing container
+CONTAINER_CONFIG_PATH = "/opt/ml/processing/code/config/analysis_config.yaml"
+
 def extract_util_files(zipfile_location: str, extract_folder: str) -> None:
     with zipfile.ZipFile(zipfile_location, "r") as myzip:
         myzip.extractall(extract_folder)
@@ -44,6 +47,22 @@ def get_html_from_notebook(notebook_path: str) -> str:
     return html_path
 
 
+def run_headless(utils_folder: str, params: Optional[dict]=None, config_path: str=CONTAINER_CONFIG_PATH) -> None:
+    """
+    Runs the attribution analysis with attribution_runner (extracted from utils.zip) in this process, instead of executing the notebook.
+    Only run_id and local_output_path are used from the notebook params. The analysis config is read from config_path.
+    """
+    sys.path.append(utils_folder)
+    from attribution_runner import run_attribution
+    import yaml
+    params = params or {}
+    with open(config_path, "r") as f:
+        config = yaml.safe_load(f)
+    with open(config["mode"]["container"]["wh_credentials_path"], "r") as f:
+        creds = yaml.safe_load(f)
+    run_attribution(config, creds, params.get("run_id"), params.get("local_output_path", "data"), mode="container")
+
+
 def list_files(startpath):
     for root, dirs, files in os.walk(startpath):
         level = root.replace(startpath, '').count(os.sep)
@@ -61,6 +80,8 @@ if __name__ == '__main__':
     arg_parser.add_argument('--utils_path', type=str)
     arg_parser.add_argument("--utils_extract_to", type=str)
     arg_parser.add_argument("--nb_parameters", type=json.loads)
+    arg_parser.add_argument("--headless", action="store_true", help="Runs attribution_runner directly, without papermill and the html report")
+    arg_parser.add_argument("--config_path", type=str, default=CONTAINER_CONFIG_PATH, help="Analysis config used by the headless run")
     print(list_files('/opt/ml/processing/'))
     args = arg_parser.parse_args()
     # Install requirements
@@ -68,6 +89,9 @@ if __name__ == '__main__':
     if args.utils_path:
         extract_util_files(os.path.join(args.utils_path, "utils.zip"), args.utils_extract_to)
     print(list_files('/opt/ml/processing/'))
+    if args.headless:
+        run_headless(args.utils_extract_to, args.nb_parameters, args.config_path)
+        sys.exit(0)
     output_notebook_path = run_notebook(args.notebooks_path, args.nb_parameters)
     # Generate html file
     html_path = get_html_from_notebook(output_notebook_path)
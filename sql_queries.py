@@ -0,0 +1,275 @@
+"""
+Queries to read the user touches from the warehouse.
+
+prepare_query only selects the columns and applies the ignore_events / min_date filters, and the rest of the cleanup happens in pandas.
+prepare_journeys_query pushes the whole cleanup down to the warehouse as window function queries, so that only the final
+journeys (or, by default, the distinct journey paths with their counts) come over the wire. It is used when data.pushdown is set in the config.
+"""
+
+from typing import List, Optional, Dict
+
+
+# Warehouse specific sql snippets
+SQL_DIALECTS = {
+    "snowflake": {
+        "seconds_between": "datediff(millisecond, {start}, {end}) / 1000.0",
+        "path_agg": "listagg({col}, '{separator}') within group (order by {order_col})",
+    },
+    "redshift": {
+        "seconds_between": "datediff(millisecond, {start}, {end}) / 1000.0",
+        # Redshift caps listagg output at 65535 bytes. Very long journeys need aggregate_paths=False
+        "path_agg": "listagg({col}, '{separator}') within group (order by {order_col})",
+    },
+}
+
+
+def quote_literal(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def prepare_query(entity_key_col: str,
+                  event_col: str,
+                  ts_col: str,
+                  table_name: str,
+                  ignore_events_list: Optional[List[str]]=None,
+                  start_date: Optional[str]=None,
+                  extra_cols_list: Optional[List[str]]=None,
+                  order_by: Optional[List[str]]=None,
+                  end_date: Optional[str]=None,
+                  active_since: Optional[str]=None) -> str:
+    """Touches of the users, with the ignore_events_list, start_date and end_date (inclusive) filters. With active_since, only the touches
+    of the users who have a touch after active_since (and till end_date) are read, ex: users with new touches since the previous run."""
+    all_columns = [entity_key_col, event_col, ts_col]
+    if extra_cols_list is not None:
+        all_columns = all_columns + extra_cols_list
+    all_columns_str = ', '.join(all_columns)
+    query = f"select {all_columns_str} from {table_name}"
+    conditions = []
+    if ignore_events_list is not None and len(ignore_events_list) > 0:
+        ignore_events_substr = ", ".join([quote_literal(e) for e in ignore_events_list])
+        ignore_events_cond = f"{event_col} not in ({ignore_events_substr})"
+        conditions.append(ignore_events_cond)
+
+    if start_date is not None:
+        min_date_cond = f"{ts_col} >= '{start_date}'"
+        conditions.append(min_date_cond)
+
+    if end_date is not None:
+        conditions.append(f"{ts_col} <= '{end_date}'")
+
+    if active_since is not None:
+        active_cond = f"{ts_col} > '{active_since}'" + (f" and {ts_col} <= '{end_date}'" if end_date is not None else "")
+        conditions.append(f"{entity_key_col} in (select {entity_key_col} from {table_name} where {active_cond})")
+
+    conditions_str = ' and '.join(conditions)
+    if conditions_str:
+        query = f"{query} where {conditions_str}"
+    if order_by:
+        query = f"{query} order by {', '.join(order_by)}"
+    return query
+
+
+def prepare_max_timestamp_query(ts_col: str, table_name: str, start_date: Optional[str]=None) -> str:
+    """Timestamp of the latest touch (max_ts), to read all the touches of a run up to the same timestamp"""
+    query = f"select max({ts_col}) as max_ts from {table_name}"
+    return f"{query} where {ts_col} >= '{start_date}'" if start_date is not None else query
+
+
+def prepare_touches_ctes(entity_key_col: str,
+                         event_col: str,
+                         ts_col: str,
+                         table_name: str,
+                         conversion_event: str,
+                         ignore_events_list: Optional[List[str]]=None,
+                         start_date: Optional[str]=None,
+                         end_date: Optional[str]=None) -> List[str]:
+    """Common table expressions up to `touches`: the touches of each user till the first conversion, without exact duplicates,
+    with the conversion timestamp of the user in converted_ts (null for users who did not convert). Same as preprocessing.separate_conversions.
+    """
+    source_query = prepare_query(entity_key_col, event_col, ts_col, table_name, ignore_events_list, start_date, end_date=end_date)
+    return [
+        f"source as ({source_query})",
+        (f"labelled as (select {entity_key_col}, {event_col}, {ts_col}, "
+         f"min(case when {event_col} = {quote_literal(conversion_event)} then {ts_col} end) over (partition by {entity_key_col}) as converted_ts "
+         f"from source)"),
+        (f"touches as (select distinct {entity_key_col}, {event_col}, {ts_col}, converted_ts from labelled "
+         f"where ({event_col} is null or {event_col} <> {quote_literal(conversion_event)}) "
+         f"and (converted_ts is null or {ts_col} <= converted_ts))"),
+    ]
+
+
+def prepare_distinct_touches_query(entity_key_col: str,
+                                   event_col: str,
+                                   ts_col: str,
+                                   table_name: str,
+                                   conversion_event: str,
+                                   ignore_events_list: Optional[List[str]]=None,
+                                   start_date: Optional[str]=None,
+                                   end_date: Optional[str]=None) -> str:
+    """Distinct touches of the users till their first conversion, to pick the default_event of prepare_journeys_query with
+    preprocessing.get_default_event, as EventEncoder does"""
+    ctes = prepare_touches_ctes(entity_key_col, event_col, ts_col, table_name, conversion_event, ignore_events_list, start_date, end_date)
+    return "with " + ",\n".join(ctes) + f"\nselect distinct {event_col} from touches where {event_col} is not null"
+
+
+def prepare_touch_counts_query(entity_key_col: str,
+                               event_col: str,
+                               ts_col: str,
+                               table_name: str,
+                               conversion_event: str,
+                               ignore_events_list: Optional[List[str]]=None,
+                               start_date: Optional[str]=None,
+                               end_date: Optional[str]=None) -> str:
+    """No:of touches of each event (n_touches) of the users till their first conversion, null events included, to fit
+    preprocessing.EventEncoder (fit_counts) without reading all the touches"""
+    ctes = prepare_touches_ctes(entity_key_col, event_col, ts_col, table_name, conversion_event, ignore_events_list, start_date, end_date)
+    return "with " + ",\n".join(ctes) + f"\nselect {event_col}, count(*) as n_touches from touches group by {event_col}"
+
+
+def prepare_conversions_query(entity_key_col: str,
+                              event_col: str,
+                              ts_col: str,
+                              table_name: str,
+                              conversion_event: str,
+                              ignore_events_list: Optional[List[str]]=None,
+                              start_date: Optional[str]=None,
+                              end_date: Optional[str]=None) -> str:
+    """First conversion timestamp of each user who converted. Same as preprocessing.get_conversion_timestamps"""
+    source_query = prepare_query(entity_key_col, event_col, ts_col, table_name, ignore_events_list, start_date, end_date=end_date)
+    return (f"with source as ({source_query})\n"
+            f"select {entity_key_col}, min({ts_col}) as {ts_col} from source "
+            f"where {event_col} = {quote_literal(conversion_event)} and {entity_key_col} is not null group by {entity_key_col}")
+
+
+def prepare_journeys_query(entity_key_col: str,
+                           event_col: str,
+                           ts_col: str,
+                           table_name: str,
+                           conversion_event: str,
+                           warehouse: str,
+                           ignore_events_list: Optional[List[str]]=None,
+                           start_date: Optional[str]=None,
+                           top_k: Optional[int]=None,
+                           default_event: Optional[str]=None,
+                           events_mapping: Optional[Dict[str, Optional[str]]]=None,
+                           min_event_interval_in_sec: int=0,
+                           aggregate_paths: bool=True,
+                           path_separator: str=">",
+                           end_date: Optional[str]=None) -> str:
+    """Generates a query that runs the notebook's cleanup steps in the warehouse, in the same order:
+    1. Conversion timestamp of each user (first conversion event), as a min over the user's partition. Touches after it are dropped, along with exact duplicate rows.
+    2. Only the top_k touches by volume are kept, rest all (and null touches) are grouped as default_event.
+    3. Touches are renamed using events_mapping. Touches mapped to None are dropped.
+    4. A touch that repeats the user's previous touch within min_event_interval_in_sec is dropped (lag over the user's partition).
+    5. Touches in ignore_events_list are dropped (both from the raw rows and after the mapping).
+
+    Args:
+        entity_key_col (str): Primary key column (user id, domain etc)
+        event_col (str): Touches column
+        ts_col (str): Timestamp column
+        table_name (str): Fully qualified table name
+        conversion_event (str): Value of event_col that marks a conversion
+        warehouse (str): One of SQL_DIALECTS (snowflake, redshift)
+        ignore_events_list (Optional[List[str]], optional): Touches to be ignored. Defaults to None.
+        start_date (Optional[str], optional): Ignores touches before this date. Defaults to None.
+        top_k (Optional[int], optional): No:of top touches to keep. If None, all touches are kept. Defaults to None.
+        default_event (Optional[str], optional): Name of the group of touches outside the top_k. Should not be an existing touch, and is needed
+         with top_k: pick it with preprocessing.get_default_event over the results of prepare_distinct_touches_query. Defaults to None.
+        events_mapping (Optional[Dict[str, Optional[str]]], optional): Touch to touch group mapping (events_type_mapping in the notebook). Defaults to None.
+        min_event_interval_in_sec (int, optional): Dedup interval. If 0, no dedup is done. Defaults to 0.
+        aggregate_paths (bool, optional): If True, returns one row per distinct (path, is_converted) with the no:of users in n_journeys,
+         where path is the user's touches joined by path_separator in chronological order.
+         If False, returns the cleaned up touches with the converted_ts and is_converted columns, ordered by user and timestamp. Defaults to True.
+        path_separator (str, optional): Separator of touches in a path. Should not occur in any touch name. Defaults to ">".
+        end_date (Optional[str], optional): Ignores touches after this timestamp. Defaults to None.
+
+    Returns:
+        str: Query string
+    """
+    if warehouse not in SQL_DIALECTS:
+        raise ValueError(f"Warehouse {warehouse} not supported. Should be one of {list(SQL_DIALECTS)}")
+    if top_k is not None and default_event is None:
+        raise ValueError("default_event is needed with top_k. See preprocessing.get_default_event")
+    dialect = SQL_DIALECTS[warehouse]
+    ctes = prepare_touches_ctes(entity_key_col, event_col, ts_col, table_name, conversion_event, ignore_events_list, start_date, end_date)
+    previous_cte = "touches"
+    if top_k is not None:
+        ctes.append(f"top_events as (select {event_col} from touches where {event_col} is not null "
+                    f"group by {event_col} order by count(*) desc limit {int(top_k)})")
+        ctes.append(f"top_k_touches as (select t.{entity_key_col}, "
+                    f"case when e.{event_col} is not null then t.{event_col} else {quote_literal(default_event)} end as {event_col}, "
+                    f"t.{ts_col}, t.converted_ts from touches t left join top_events e on t.{event_col} = e.{event_col})")
+        previous_cte = "top_k_touches"
+    if events_mapping:
+        when_clauses = " ".join(f"when {quote_literal(touch)} then {'null' if group is None else quote_literal(group)}"
+                                for touch, group in events_mapping.items())
+        mapped_event = f"case {event_col} {when_clauses} else {event_col} end"
+    else:
+        mapped_event = event_col
+    ctes.append(f"mapped as (select distinct {entity_key_col}, {mapped_event} as {event_col}, {ts_col}, converted_ts from {previous_cte})")
+    ctes.append(f"non_null as (select * from mapped where {event_col} is not null)")
+    previous_cte = "non_null"
+    if min_event_interval_in_sec > 0:
+        seconds_since_prev = dialect["seconds_between"].format(start="prev_ts", end=ts_col)
+        ctes.append(f"lagged as (select {entity_key_col}, {event_col}, {ts_col}, converted_ts, "
+                    f"lag({event_col}) over (partition by {entity_key_col} order by {ts_col}) as prev_event, "
+                    f"lag({ts_col}) over (partition by {entity_key_col} order by {ts_col}) as prev_ts "
+                    f"from non_null)")
+        ctes.append(f"deduped as (select {entity_key_col}, {event_col}, {ts_col}, converted_ts from lagged "
+                    f"where prev_event is null or prev_ts is null or prev_event <> {event_col} "
+                    f"or {seconds_since_prev} > {min_event_interval_in_sec})")
+        previous_cte = "deduped"
+    ignore_cond = ""
+    if ignore_events_list:
+        ignore_cond = f" where {event_col} not in ({', '.join(quote_literal(e) for e in ignore_events_list)})"
+    ctes.append(f"clean_touches as (select {entity_key_col}, {event_col}, {ts_col}, converted_ts, "
+                f"case when converted_ts is null then 0 else 1 end as is_converted from {previous_cte}{ignore_cond})")
+    if aggregate_paths:
+        path = dialect["path_agg"].format(col=event_col, separator=path_separator.replace("'", "''"), order_col=ts_col)
+        ctes.append(f"journeys as (select {entity_key_col}, {path} as path, max(is_converted) as is_converted "
+                    f"from clean_touches group by {entity_key_col})")
+        final_query = "select path, is_converted, count(*) as n_journeys from journeys group by path, is_converted"
+    else:
+        final_query = f"select {entity_key_col}, {event_col}, {ts_col}, converted_ts, is_converted from clean_touches order by {entity_key_col}, {ts_col}"
+    return "with " + ",\n".join(ctes) + "\n" + final_query
+
+
+if __name__ == "__main__":
+    assert prepare_query('user_id', 'event_name','ts', 'table') == 'select user_id, event_name, ts from table'
+    assert prepare_query('user_id', 'event_name','ts', 'table', ['v1','v2']) == "select user_id, event_name, ts from table where event_name not in ('v1', 'v2')"
+    assert prepare_query('user_id', 'event_name','ts', 'table',
+                         ['v1','v2'], '2022-02-02') == "select user_id, event_name, ts from table where event_name not in ('v1', 'v2') and ts >= '2022-02-02'"
+    assert prepare_query('user_id', 'event_name','ts', 'table', None, '2022-02-02') == "select user_id, event_name, ts from table where ts >= '2022-02-02'"
+
+    # Journeys pushdown: the same cleanup steps for every warehouse
+    for warehouse in SQL_DIALECTS:
+        query = prepare_journeys_query('user_id', 'event', 'ts', 'db.sc.t', 'signup', warehouse, ['v1'], '2022-02-02', top_k=5, default_event='others_1',
+                                       events_mapping={'a': 'g', "b'c": None}, min_event_interval_in_sec=300)
+        assert query.startswith("with source as (select user_id, event, ts from db.sc.t where event not in ('v1') and ts >= '2022-02-02'),")
+        assert "min(case when event = 'signup' then ts end) over (partition by user_id) as converted_ts" in query
+        assert "order by count(*) desc limit 5)" in query and "else 'others_1' end as event" in query
+        assert "case event when 'a' then 'g' when 'b''c' then null else event end as event" in query
+        assert "or datediff(millisecond, prev_ts, ts) / 1000.0 > 300)" in query
+        assert "listagg(event, '>') within group (order by ts) as path" in query
+        assert query.endswith("select path, is_converted, count(*) as n_journeys from journeys group by path, is_converted")
+        query = prepare_journeys_query('user_id', 'event', 'ts', 'db.sc.t', 'signup', warehouse, aggregate_paths=False)
+        assert "top_events" not in query and "lagged" not in query and "listagg" not in query
+        assert query.endswith("select user_id, event, ts, converted_ts, is_converted from clean_touches order by user_id, ts")
+        try:
+            prepare_journeys_query('user_id', 'event', 'ts', 'db.sc.t', 'signup', warehouse, top_k=5)
+            raise AssertionError("top_k without default_event should raise")
+        except ValueError:
+            pass
+    assert prepare_distinct_touches_query('user_id', 'event', 'ts', 'db.sc.t', 'signup').endswith("\nselect distinct event from touches where event is not null")
+    assert prepare_touch_counts_query('user_id', 'event', 'ts', 'db.sc.t', 'signup').endswith("\nselect event, count(*) as n_touches from touches group by event")
+    assert prepare_conversions_query('user_id', 'event', 'ts', 'db.sc.t', 'signup', None, '2022-02-02') == (
+        "with source as (select user_id, event, ts from db.sc.t where ts >= '2022-02-02')\n"
+        "select user_id, min(ts) as ts from source where event = 'signup' and user_id is not null group by user_id")
+    assert prepare_query('user_id', 'event_name', 'ts', 'table', None, '2022-02-02',
+                         order_by=['user_id', 'ts']) == "select user_id, event_name, ts from table where ts >= '2022-02-02' order by user_id, ts"
+    assert prepare_query('user_id', 'event_name', 'ts', 'table', None, '2022-02-02', end_date='2022-03-01 10:00:00', active_since='2022-02-28 10:00:00') == (
+        "select user_id, event_name, ts from table where ts >= '2022-02-02' and ts <= '2022-03-01 10:00:00' and user_id in "
+        "(select user_id from table where ts > '2022-02-28 10:00:00' and ts <= '2022-03-01 10:00:00')")
+    assert "where ts >= '2022-02-02' and ts <= '2022-03-01')" in prepare_touch_counts_query('user_id', 'event', 'ts', 't', 'signup', None, '2022-02-02', '2022-03-01')
+    assert "where ts <= '2022-03-01')" in prepare_journeys_query('user_id', 'event', 'ts', 't', 'signup', 'snowflake', end_date='2022-03-01')
+    assert prepare_max_timestamp_query('ts', 'table', '2022-02-02') == "select max(ts) as max_ts from table where ts >= '2022-02-02'"
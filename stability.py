@@ -0,0 +1,200 @@
+"""
+Bootstrap stability analysis of the attribution values.
+
+The journeys are compressed into distinct paths (JourneyStore.compress), and each resample is represented by how many users of every
+path are drawn, and not by a new copy of the journeys. The per-path inputs of the models (encoded channels for Shapley, encoded touches
+for Markov) are computed once, placed in shared memory, and every resample only re-weights them (weighted bincounts).
+Resamples are spread across a process pool, and each worker attaches to the shared arrays instead of receiving its own pickled copy.
+
+Resample i always uses the same random stream, derived from (random_state, i), so the results do not depend on n_jobs.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from multiprocessing import shared_memory
+except ImportError: # Python < 3.8. Workers then get their own copy of the arrays, pickled once per worker
+    shared_memory = None
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from journeys import JourneyStore
+from models import (shapley_values_from_journeys, encode_journeys, count_transitions, drop_unvisited_touches,
+                    get_markov_attribution_from_counts)
+
+
+BOOTSTRAP_METHODS = ("shapley", "markov")
+
+# Arrays of the current bootstrap run, keyed by name. In workers, they are views on the shared memory blocks.
+_shared_arrays: Dict[str, np.ndarray] = {}
+_shared_blocks: list = []
+_run_settings: dict = {}
+
+
+def _to_shared_memory(arrays: Dict[str, np.ndarray]) -> Tuple[list, Dict[str, tuple]]:
+    """Copies the arrays into new shared memory blocks. Returns the blocks and the (block name, shape, dtype) spec of each array"""
+    blocks, specs = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        specs[name] = (block.name, array.shape, array.dtype.str)
+    return blocks, specs
+
+
+def _attach_shared_arrays(specs: Dict[str, tuple], settings: dict) -> None:
+    """Process pool initializer. Attaches to the shared memory blocks created by the parent process"""
+    _shared_arrays.clear()
+    _shared_blocks.clear()
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _shared_blocks.append(block)
+        _shared_arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    _run_settings.clear()
+    _run_settings.update(settings)
+
+
+def _set_arrays(arrays: Dict[str, np.ndarray], settings: dict) -> None:
+    """Process pool initializer, when shared memory is not available"""
+    _attach_shared_arrays({}, settings)
+    _shared_arrays.update(arrays)
+
+
+def _resample_multiplicity(rng: np.random.Generator, path_counts: np.ndarray, frac: float, replace: bool) -> np.ndarray:
+    """No:of users of each path drawn in a resample of round(frac * total users) users"""
+    n_users = path_counts.sum()
+    n_draws = int(round(frac * n_users))
+    if n_users == 0:
+        return np.zeros(len(path_counts))
+    if replace:
+        return rng.multinomial(n_draws, path_counts / n_users).astype(np.float64)
+    return rng.multivariate_hypergeometric(path_counts, n_draws).astype(np.float64)
+
+
+def _run_iterations(iterations: List[int]) -> List[Tuple[int, Dict[str, np.ndarray]]]:
+    """Computes the attribution values of the given resamples, from the arrays of the current run"""
+    arrays, settings = _shared_arrays, _run_settings
+    channels, touches = settings["channels"], settings["touches"]
+    results = []
+    for iteration in iterations:
+        rng = np.random.default_rng(np.random.SeedSequence(settings["random_state"], spawn_key=(iteration,)))
+        pos_weights = _resample_multiplicity(rng, arrays["pos_counts"], settings["frac"], settings["replace"])
+        neg_weights = _resample_multiplicity(rng, arrays["neg_counts"], settings["frac"], settings["replace"])
+        values = {}
+        if "shapley" in settings["methods"]:
+            # Channels missing from a resample are null players, so their value is 0 and the values of the rest are unaffected
+            values["shapley"] = shapley_values_from_journeys(arrays["channel_codes"], arrays["pos_offsets"], len(channels), pos_weights)
+        if "markov" in settings["methods"]:
+            transitions = (count_transitions(arrays["pos_codes"], arrays["pos_offsets"], len(touches), True, pos_weights)
+                           + count_transitions(arrays["neg_codes"], arrays["neg_offsets"], len(touches), False, neg_weights))
+            # Touches missing from a resample have no outgoing transitions. They are dropped from the chain and get 0 attribution
+            transitions, labels = drop_unvisited_touches(transitions, ["Start"] + touches + ["Dropoff", "Converted"])
+            attribution, _ = get_markov_attribution_from_counts(transitions,
+                                                                np.zeros_like(transitions),
+                                                                labels,
+                                                                pos_weights.sum(),
+                                                                solver=settings["markov_solver"])
+            values["markov"] = np.array([attribution.get(touch, 0.) for touch in touches])
+        results.append((iteration, values))
+    return results
+
+
+def summarize_bootstrap(values: pd.DataFrame, confidence: float = 0.95) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Ranks of the touches within each resample (1 is the highest value) and percentile confidence intervals of the values.
+
+    Args:
+        values (pd.DataFrame): Attribution values, with touches as rows and resamples as columns
+        confidence (float, optional): Confidence level of the intervals. Defaults to 0.95.
+
+    Returns:
+        Tuple[pd.DataFrame, pd.DataFrame]: ranks (same shape as values), and intervals with columns mean, std, lower, upper and median_rank
+    """
+    ranks = values.rank(axis=0, ascending=False, method="min").astype(int)
+    alpha = (1 - confidence) / 2
+    intervals = pd.DataFrame({"mean": values.mean(axis=1),
+                              "std": values.std(axis=1),
+                              "lower": values.quantile(alpha, axis=1),
+                              "upper": values.quantile(1 - alpha, axis=1),
+                              "median_rank": ranks.median(axis=1)})
+    return ranks, intervals.sort_values("mean", ascending=False)
+
+
+def bootstrap_attribution(journeys_pos: JourneyStore,
+                          journeys_neg: JourneyStore,
+                          distinct_touches_list: List[str],
+                          n_iter: int = 200,
+                          frac: float = 0.7,
+                          replace: bool = False,
+                          n_jobs: int = -1,
+                          methods: Tuple[str, ...] = BOOTSTRAP_METHODS,
+                          markov_solver: str = "sherman_morrison",
+                          confidence: float = 0.95,
+                          random_state: Optional[int] = None) -> Dict[str, Dict[str, pd.DataFrame]]:
+    """Attribution values over n_iter random resamples of the journeys, to check how stable they are.
+    With the defaults, each resample is a 70% subsample (as train_test_split(train_size=0.7) in the notebook).
+    For a classic bootstrap, use frac=1 and replace=True.
+
+    Args:
+        journeys_pos (JourneyStore): Converted journeys. Can be a compressed store with integer weights.
+        journeys_neg (JourneyStore): Non converted journeys. Can be a compressed store with integer weights.
+        distinct_touches_list (List[str]): All the touches (states of the Markov chain)
+        n_iter (int, optional): No:of resamples. Defaults to 200.
+        frac (float, optional): Size of each resample, as a fraction of the no:of journeys. Converted and non converted journeys are resampled separately. Defaults to 0.7.
+        replace (bool, optional): Whether journeys are drawn with replacement. Defaults to False.
+        n_jobs (int, optional): No:of worker processes. -1 uses all the cores, 1 runs in the current process. Defaults to -1.
+        methods (Tuple[str, ...], optional): Subset of BOOTSTRAP_METHODS. Defaults to both.
+        markov_solver (str, optional): Solver passed to get_markov_attribution_from_counts. Defaults to "sherman_morrison".
+        confidence (float, optional): Confidence level of the intervals. Defaults to 0.95.
+        random_state (Optional[int], optional): Seed, for reproducible resamples. Defaults to None.
+
+    Returns:
+        Dict[str, Dict[str, pd.DataFrame]]: For each method, a dict with
+         values (touches x resamples), ranks (touches x resamples) and intervals (see summarize_bootstrap)
+    """
+    unknown_methods = set(methods) - set(BOOTSTRAP_METHODS)
+    if unknown_methods:
+        raise ValueError(f"Unknown methods {unknown_methods}. Should be a subset of {BOOTSTRAP_METHODS}")
+    channels = sorted(journeys_pos.vocabulary[code] for code in np.unique(journeys_pos.codes))
+    touches = list(distinct_touches_list)
+    journeys_pos, journeys_neg = journeys_pos.compress(), journeys_neg.compress()
+    pos_codes, pos_offsets = encode_journeys(journeys_pos, touches)
+    neg_codes, neg_offsets = encode_journeys(journeys_neg, touches)
+    channel_codes, _ = encode_journeys(journeys_pos, channels)
+    arrays = {"pos_codes": pos_codes, "pos_offsets": pos_offsets, "neg_codes": neg_codes, "neg_offsets": neg_offsets,
+              "pos_counts": np.rint(journeys_pos.weights).astype(np.int64), "neg_counts": np.rint(journeys_neg.weights).astype(np.int64),
+              "channel_codes": channel_codes}
+    settings = {"channels": channels, "touches": touches, "frac": frac, "replace": replace, "methods": tuple(methods),
+                "markov_solver": markov_solver,
+                "random_state": np.random.SeedSequence(random_state).entropy}
+
+    n_jobs = os.cpu_count() if n_jobs == -1 else n_jobs
+    n_jobs = max(1, min(n_jobs, n_iter))
+    if n_jobs == 1:
+        _set_arrays(arrays, settings)
+        results = _run_iterations(list(range(n_iter)))
+    else:
+        blocks, initializer, initargs = [], _set_arrays, (arrays, settings)
+        if shared_memory is not None:
+            blocks, specs = _to_shared_memory(arrays)
+            initializer, initargs = _attach_shared_arrays, (specs, settings)
+        try:
+            # A few tasks per worker, so that uneven task durations even out
+            tasks = [chunk.tolist() for chunk in np.array_split(np.arange(n_iter), min(n_iter, 4 * n_jobs))]
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=initializer, initargs=initargs) as executor:
+                results = [result for task_results in executor.map(_run_iterations, tasks) for result in task_results]
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    _shared_arrays.clear()
+
+    results = sorted(results, key=lambda result: result[0])
+    bootstrap_results = {}
+    for method in methods:
+        index = channels if method == "shapley" else touches
+        values = pd.DataFrame(np.column_stack([result[1][method] for result in results]), index=index, columns=range(n_iter))
+        ranks, intervals = summarize_bootstrap(values, confidence)
+        bootstrap_results[method] = {"values": values, "ranks": ranks, "intervals": intervals}
+    return bootstrap_results
@@ -0,0 +1,153 @@
+"""
+Staging of dataframes as Parquet files, for bulk loads into the warehouse (see ConnectorBase.bulk_write).
+
+A dataframe is split into parts of rows_per_part rows, and the parts are written as compressed Parquet files in parallel.
+The parts are then uploaded to a stage, also in parallel, from where the warehouse loads them with a single COPY:
+    FilesystemStage: a local folder. Stand-in for the warehouse stages, ex: to test the write back locally.
+    S3Stage: a bucket prefix, for Redshift's COPY ... FORMAT AS PARQUET.
+    SnowflakeTableStage: the table stage of a Snowflake table (@%table), uploaded with PUT, for COPY INTO.
+"""
+
+import os
+import shutil
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_ROWS_PER_PART = 1_000_000
+DEFAULT_UPLOAD_WORKERS = 8
+PARQUET_COMPRESSION = "snappy"
+
+
+def write_parquet_parts(df: pd.DataFrame,
+                        folder: str,
+                        rows_per_part: int = DEFAULT_ROWS_PER_PART,
+                        max_workers: int = DEFAULT_UPLOAD_WORKERS,
+                        compression: str = PARQUET_COMPRESSION) -> List[str]:
+    """Writes df to folder as part-00000.parquet, part-00001.parquet, ... of at most rows_per_part rows each, in parallel.
+    Timestamps are written in microseconds, which both Snowflake and Redshift load.
+
+    Returns:
+        List[str]: Paths of the parts, in order
+    """
+    os.makedirs(folder, exist_ok=True)
+    n_parts = max(1, int(np.ceil(len(df) / rows_per_part)))
+    paths = [os.path.join(folder, f"part-{part_no:05d}.parquet") for part_no in range(n_parts)]
+
+    def write_part(part_no: int) -> None:
+        part = df.iloc[part_no * rows_per_part:(part_no + 1) * rows_per_part]
+        part.to_parquet(paths[part_no], engine="pyarrow", compression=compression, index=False,
+                        coerce_timestamps="us", allow_truncated_timestamps=True)
+
+    with ThreadPoolExecutor(max_workers=min(max_workers, n_parts)) as executor:
+        list(executor.map(write_part, range(n_parts)))
+    return paths
+
+
+class FilesystemStage:
+    def __init__(self, root: str) -> None:
+        """
+        Args:
+            root (str): Local folder that plays the role of the stage
+        """
+        self.root = root
+
+    def uri(self, prefix: str) -> str:
+        return os.path.join(self.root, prefix)
+
+    def upload(self, paths: List[str], prefix: str, max_workers: int = DEFAULT_UPLOAD_WORKERS) -> None:
+        os.makedirs(self.uri(prefix), exist_ok=True)
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+            list(executor.map(lambda path: shutil.copy(path, os.path.join(self.uri(prefix), os.path.basename(path))), paths))
+
+    def list(self, prefix: str) -> List[str]:
+        return sorted(glob(os.path.join(self.uri(prefix), "*.parquet")))
+
+    def remove(self, prefix: str) -> None:
+        shutil.rmtree(self.uri(prefix), ignore_errors=True)
+
+
+class S3Stage:
+    def __init__(self, bucket: str, sub_directory: Optional[str], s3_client) -> None:
+        """
+        Args:
+            bucket (str): S3 bucket of the stage
+            sub_directory (Optional[str]): Key prefix under which the staged files are uploaded
+            s3_client: boto3 s3 client
+        """
+        self.bucket = bucket
+        self.sub_directory = (sub_directory or "").strip("/")
+        self.s3_client = s3_client
+
+    def key(self, prefix: str) -> str:
+        return "/".join(part for part in (self.sub_directory, prefix.strip("/")) if part) + "/"
+
+    def uri(self, prefix: str) -> str:
+        return f"s3://{self.bucket}/{self.key(prefix)}"
+
+    def upload(self, paths: List[str], prefix: str, max_workers: int = DEFAULT_UPLOAD_WORKERS) -> None:
+        # upload_file switches to multipart uploads for large parts on its own
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(paths)))) as executor:
+            list(executor.map(lambda path: self.s3_client.upload_file(path, self.bucket, self.key(prefix) + os.path.basename(path)), paths))
+
+    def list(self, prefix: str) -> List[str]:
+        keys = []
+        for page in self.s3_client.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=self.key(prefix)):
+            keys.extend(obj["Key"] for obj in page.get("Contents", []))
+        return keys
+
+    def remove(self, prefix: str) -> None:
+        keys = self.list(prefix)
+        for start in range(0, len(keys), 1000):
+            self.s3_client.delete_objects(Bucket=self.bucket, Delete={"Objects": [{"Key": key} for key in keys[start:start + 1000]]})
+
+
+class SnowflakeTableStage:
+    def __init__(self, connection, table_name: str, schema: Optional[str] = None) -> None:
+        """
+        Args:
+            connection: sqlalchemy connection to Snowflake
+            table_name (str): Table whose stage (@%table_name) is used
+            schema (Optional[str], optional): Schema of the table. Defaults to None.
+        """
+        self.connection = connection
+        self.stage = f"@{schema}.%{table_name}" if schema else f"@%{table_name}"
+
+    def uri(self, prefix: str) -> str:
+        return f"{self.stage}/{prefix.strip('/')}/"
+
+    def upload(self, paths: List[str], prefix: str, max_workers: int = DEFAULT_UPLOAD_WORKERS) -> None:
+        # One PUT with a wildcard uploads all the parts, max_workers at a time. Parquet parts are already compressed.
+        folder = os.path.dirname(os.path.abspath(paths[0]))
+        self.connection.execute(f"PUT 'file://{folder}/*.parquet' '{self.uri(prefix)}' PARALLEL={max(1, min(max_workers, 99))} "
+                                "AUTO_COMPRESS=FALSE OVERWRITE=TRUE")
+
+    def remove(self, prefix: str) -> None:
+        self.connection.execute(f"REMOVE '{self.uri(prefix)}'")
+
+
+if __name__ == "__main__":
+    import tempfile
+    from local_s3 import LocalS3Client
+    df = pd.DataFrame({"touch": [f"t{i}" for i in range(2500)], "value": np.arange(2500) / 7, "ts": pd.Timestamp("2022-01-01 00:00:00.123456789")})
+    with tempfile.TemporaryDirectory() as folder:
+        paths = write_parquet_parts(df, os.path.join(folder, "parts"), rows_per_part=1000, max_workers=2)
+        assert [os.path.basename(path) for path in paths] == ["part-00000.parquet", "part-00001.parquet", "part-00002.parquet"]
+        staged = pd.concat([pd.read_parquet(path) for path in paths], ignore_index=True)
+        assert staged.drop(columns="ts").equals(df.drop(columns="ts"))
+        assert (staged["ts"] == pd.Timestamp("2022-01-01 00:00:00.123456")).all()
+        assert len(write_parquet_parts(df.head(0), os.path.join(folder, "empty"))) == 1
+
+        stages = [FilesystemStage(os.path.join(folder, "stage")), S3Stage("bucket", "/staging/", LocalS3Client(os.path.join(folder, "s3")))]
+        assert stages[1].uri("results/run_1") == "s3://bucket/staging/results/run_1/"
+        for stage in stages:
+            stage.upload(paths, "results/run_1", max_workers=2)
+            stage.upload(paths[:1], "results/run_2")
+            assert [os.path.basename(path) for path in stage.list("results/run_1")] == [os.path.basename(path) for path in paths]
+            stage.remove("results/run_1")
+            assert stage.list("results/run_1") == []
+            assert len(stage.list("results/run_2")) == 1
@@ -1,22 +1,20 @@
+import io
 import os
+import json
 import yaml
+import hashlib
 import logging
-import sagemaker
-import boto3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pandas as pd
 
-from sqlalchemy import create_engine
 from pathlib import Path
-from sklearn.base import BaseEstimator, TransformerMixin
-from typing import Optional, List, Tuple
+from typing import Iterator, Optional, List, Tuple, Union
 from glob import glob
 
-try:
-    import StringIO
-except:
-    from io import StringIO
-    
+# sagemaker, boto3 and sklearn are imported on first use, so that callers of load_config, parse_s3_path etc don't pay for them.
+
 
 def create_logger(log_file_name: str='log.log', log_level: int=logging.INFO) -> logging.Logger:
     """
@@ -49,32 +47,273 @@ def parse_s3_path(s3_path: str) -> Tuple[str, str]:
     return s3_bucket, s3_file_location
 
 
+# Streaming s3 I/O. Writes go through S3MultipartWriter, which uploads parts of S3_PART_SIZE bytes as soon as they fill up, a few at a
+# time, so memory stays bounded irrespective of the object size. Large reads are split into ranged GETs of S3_PART_SIZE bytes each,
+# fetched concurrently straight into one buffer.
+# The helpers accept a boto3 s3 client, resource or session (see get_s3_client), or a local_s3.LocalS3Client to run them without aws.
+
+S3_PART_SIZE = 8 * 1024**2 # s3 needs parts of at least 5 MB, except the last one
+S3_MAX_WORKERS = 8
+CSV_CHUNK_ROWS = 100000
+
+def get_s3_client(s3):
+    """s3 client from a boto3 client, resource (s3_resource.meta.client) or session"""
+    if hasattr(s3, "get_object"):
+        return s3
+    if hasattr(s3, "meta") and hasattr(s3.meta, "client"):
+        return s3.meta.client
+    return s3.client("s3")
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Writable file object that streams to an s3 object with a multipart upload. At most max_workers parts are uploading at a time,
+    and a write blocks while they are, so at most (max_workers + 1) * part_size bytes are buffered.
+    Objects smaller than one part are written with a single put. If an exception is raised inside the with block, the upload is aborted.
+    """
+
+    def __init__(self, s3, bucket: str, key: str, part_size: int = S3_PART_SIZE, max_workers: int = S3_MAX_WORKERS) -> None:
+        self.s3_client = get_s3_client(s3)
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.buffer = bytearray()
+        self.position = 0
+        self.upload_id = None
+        self.part_futures = []
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.slots = threading.BoundedSemaphore(max_workers)
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data: Union[bytes, bytearray, memoryview]) -> int:
+        self.buffer.extend(data)
+        self.position += len(data)
+        while len(self.buffer) >= self.part_size:
+            part, self.buffer = bytes(self.buffer[:self.part_size]), self.buffer[self.part_size:]
+            self._upload_part(part)
+        return len(data)
+
+    def _upload_part(self, part: bytes) -> None:
+        if self.upload_id is None:
+            self.upload_id = self.s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.key)["UploadId"]
+        part_number = len(self.part_futures) + 1
+        self.slots.acquire()
+
+        def upload() -> dict:
+            try:
+                response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number, Body=part)
+                return {"PartNumber": part_number, "ETag": response["ETag"]}
+            finally:
+                self.slots.release()
+        self.part_futures.append(self.executor.submit(upload))
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            if self.upload_id is None:
+                self.s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+            else:
+                if len(self.buffer) > 0:
+                    self._upload_part(bytes(self.buffer))
+                parts = [future.result() for future in self.part_futures]
+                self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, MultipartUpload={"Parts": parts})
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.buffer = bytearray()
+            self.executor.shutdown(wait=True)
+            super().close()
+
+    def abort(self) -> None:
+        """Discards the upload. Parts already uploaded are deleted by s3"""
+        self.executor.shutdown(wait=True)
+        if self.upload_id is not None:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()
+
+
 def pd_to_csv_s3(df: pd.DataFrame, 
                  s3_bucket_name: str,
                  s3_path: str, 
                  s3_resource, 
                  index: bool=False,
-                 header: bool=False) -> None:
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=index,header=header)
-    s3_resource.Object(s3_bucket_name, s3_path).put(Body=csv_buffer.getvalue())
+                 header: bool=False,
+                 chunk_rows: int=CSV_CHUNK_ROWS) -> None:
+    """Writes df as a csv to s3, chunk_rows rows at a time, without building the whole csv in memory"""
+    with S3MultipartWriter(s3_resource, s3_bucket_name, s3_path) as writer:
+        for start in range(0, max(len(df), 1), chunk_rows):
+            chunk_csv = df.iloc[start:start + chunk_rows].to_csv(index=index, header=header if start == 0 else False)
+            writer.write(chunk_csv.encode("utf-8"))
 
 
 def read_csv_from_s3(s3_bucket, 
                      file_path, 
                      boto_session, 
                      header: Optional[int]=None, 
-                     index: Optional[str]=None) -> pd.DataFrame:
-    s3_client = boto_session.client("s3")
-    csv_obj = s3_client.get_object(Bucket=s3_bucket, Key=file_path)
-    body = csv_obj["Body"]
-    csv_string = body.read().decode("utf-8")
-    return pd.read_csv(StringIO(csv_string), header=header, index_col=index)
+                     index: Optional[str]=None,
+                     chunksize: Optional[int]=None) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
+    """Reads a csv from s3, parsing the response body as it streams in. With chunksize, returns an iterator of dataframes of chunksize rows."""
+    csv_obj = get_s3_client(boto_session).get_object(Bucket=s3_bucket, Key=file_path)
+    return pd.read_csv(csv_obj["Body"], header=header, index_col=index, chunksize=chunksize)
+
+
+def read_s3_object(s3, s3_bucket: str, key: str, part_size: int=S3_PART_SIZE, max_workers: int=S3_MAX_WORKERS) -> memoryview:
+    """Downloads an object with concurrent ranged GETs of part_size bytes, each written into its slice of a single buffer"""
+    s3_client = get_s3_client(s3)
+    size = s3_client.head_object(Bucket=s3_bucket, Key=key)["ContentLength"]
+    buffer = memoryview(bytearray(size))
+
+    def read_range(start: int) -> None:
+        end = min(start + part_size, size) - 1
+        body = s3_client.get_object(Bucket=s3_bucket, Key=key, Range=f"bytes={start}-{end}")["Body"]
+        position = start
+        while position <= end:
+            n_read = body.readinto(buffer[position:end + 1]) if hasattr(body, "readinto") else None
+            if n_read is None:
+                chunk = body.read(end + 1 - position)
+                n_read = len(chunk)
+                buffer[position:position + n_read] = chunk
+            if n_read == 0:
+                raise IOError(f"s3://{s3_bucket}/{key}: range {start}-{end} ended early")
+            position += n_read
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(read_range, range(0, size, part_size)))
+    return buffer
+
+
+def pd_to_parquet_s3(df: pd.DataFrame, s3_bucket: str, key: str, s3, **kwargs) -> None:
+    """Writes df as parquet to s3, streaming row groups into a multipart upload. kwargs are passed to df.to_parquet."""
+    with S3MultipartWriter(s3, s3_bucket, key) as writer:
+        df.to_parquet(writer, engine="pyarrow", **kwargs)
+
+
+def read_parquet_from_s3(s3_bucket: str, key: str, s3, columns: Optional[List[str]]=None, as_arrow: bool=False):
+    """Reads a parquet object from s3 with concurrent ranged GETs. Returns a dataframe, or a pyarrow Table if as_arrow."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    table = pq.read_table(pa.BufferReader(pa.py_buffer(read_s3_object(s3, s3_bucket, key))), columns=columns)
+    return table if as_arrow else table.to_pandas()
+
+
 
+def list_s3_prefix(s3, s3_bucket: str, prefix: str, delimiter: Optional[str]=None) -> Tuple[List[dict], List[str]]:
+    """Lists prefix, following the pagination.
+
+    Args:
+        s3: boto3 s3 client, resource or session
+        s3_bucket (str): Bucket name
+        prefix (str): Key prefix to list
+        delimiter (Optional[str], optional): With a delimiter (ex: "/"), keys that have it after the prefix are not listed, and are rolled up
+            into common prefixes instead, like listing a folder without its sub folders. Defaults to None.
+
+    Returns:
+        Tuple[List[dict], List[str]]: Objects (with Key, Size and ETag) and common prefixes
+    """
+    kwargs = {"Bucket": s3_bucket, "Prefix": prefix}
+    if delimiter:
+        kwargs["Delimiter"] = delimiter
+    objects, common_prefixes = [], []
+    for page in get_s3_client(s3).get_paginator("list_objects_v2").paginate(**kwargs):
+        objects.extend(page.get("Contents", []))
+        common_prefixes.extend(common_prefix["Prefix"] for common_prefix in page.get("CommonPrefixes", []))
+    return objects, common_prefixes
+
+
+S3_MANIFEST_FILE_NAME = ".s3_manifest.json"
+
+def get_file_md5(file_path: str, block_size: int=S3_PART_SIZE) -> str:
+    md5 = hashlib.md5()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def is_unchanged(local_file: str, obj: dict, manifest_entry: Optional[dict]) -> bool:
+    """Whether local_file already holds the s3 object. The object's ETag is compared with the one recorded in the manifest when local_file
+    was downloaded (if the file was not modified since), else with the md5 of the file, which is the ETag of objects not uploaded in parts."""
+    if not os.path.isfile(local_file) or os.path.getsize(local_file) != obj["Size"]:
+        return False
+    if manifest_entry is not None and manifest_entry["mtime"] == os.path.getmtime(local_file):
+        return manifest_entry["etag"] == obj["ETag"]
+    etag = obj["ETag"].strip('"')
+    return "-" not in etag and get_file_md5(local_file) == etag
+
+
+def download_s3_prefix(s3,
+                       s3_bucket: str,
+                       prefix: str,
+                       local_path: str,
+                       max_workers: int=S3_MAX_WORKERS,
+                       skip_unchanged: bool=True,
+                       flatten: bool=True) -> List[str]:
+    """Downloads all the objects under prefix to local_path, max_workers at a time. Files that already match their object are skipped.
+    The ETags of the downloaded objects are recorded in local_path/.s3_manifest.json, for the next call to compare against.
+
+    Args:
+        s3: boto3 s3 client, resource or session
+        s3_bucket (str): Bucket name
+        prefix (str): Key prefix (folder or single key) to download
+        local_path (str): Local folder to download to
+        max_workers (int, optional): No:of concurrent downloads. Defaults to S3_MAX_WORKERS.
+        skip_unchanged (bool, optional): Whether to skip files whose ETag/md5 match. Defaults to True.
+        flatten (bool, optional): If True, files are saved by their base name directly under local_path. Else, the key path after prefix is kept.
+            Defaults to True.
+
+    Returns:
+        List[str]: Local paths of the files that were downloaded (excludes the skipped ones)
+    """
+    s3_client = get_s3_client(s3)
+    Path(local_path).mkdir(parents=True, exist_ok=True)
+    manifest_path = os.path.join(local_path, S3_MANIFEST_FILE_NAME)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, "r") as f:
+            manifest = json.load(f)
+    objects, _ = list_s3_prefix(s3_client, s3_bucket, prefix)
+
+    def download(obj: dict) -> Optional[str]:
+        relative_path = os.path.basename(obj["Key"]) if flatten else os.path.relpath(obj["Key"], prefix.rstrip("/") or ".")
+        local_file = os.path.join(local_path, relative_path)
+        if skip_unchanged and is_unchanged(local_file, obj, manifest.get(relative_path)):
+            return None
+        os.makedirs(os.path.dirname(local_file), exist_ok=True)
+        # Downloads to a temporary file first, so an interrupted download does not leave a partial file behind
+        temp_file = f"{local_file}.{threading.get_ident()}.part"
+        s3_client.download_file(s3_bucket, obj["Key"], temp_file)
+        os.replace(temp_file, local_file)
+        manifest[relative_path] = {"etag": obj["ETag"], "mtime": os.path.getmtime(local_file)}
+        return local_file
+
+    objects = [obj for obj in objects if not obj["Key"].endswith("/")]
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(objects)))) as executor:
+        downloaded = [local_file for local_file in executor.map(download, objects) if local_file is not None]
+    with open(manifest_path, "w") as f:
+        json.dump(manifest, f, indent=2)
+    logging.info(f"Downloaded {len(downloaded)} of {len(objects)} objects from s3://{s3_bucket}/{prefix} to {local_path}")
+    return downloaded
 
 
 def create_s3_resource(aws_cred_file_path: str):
+    import boto3
     try:
+        import sagemaker
         sm_role = sagemaker.get_execution_role()
         print("Able to get aws session")
         region = boto3.session.Session().region_name
@@ -91,16 +330,28 @@ def create_s3_resource(aws_cred_file_path: str):
         return boto_session.resource("s3")
 
 
-def get_s3_paths_by_file_name(s3_bucket: str, s3_path_prefix: str, file_name: str, s3_resource) -> List[str]:
-    """
-    List all folders in the s3 path.
+def get_s3_paths_by_file_name(s3_bucket: str,
+                              s3_path_prefix: str,
+                              file_name: str,
+                              s3_resource,
+                              delimiter: Optional[str]=None,
+                              max_workers: int=S3_MAX_WORKERS) -> List[str]:
+    """Keys under s3_path_prefix that contain file_name.
+
+    By default (delimiter=None), every key under s3_path_prefix is listed and those containing file_name anywhere are returned.
+    With a delimiter (ex: "/"), only the files named file_name* in s3_path_prefix and in its immediate sub folders (ex: one folder per run)
+    are returned: the sub folders are listed with the delimiter, and each is then queried for Prefix=<folder><file_name> concurrently,
+    so only the matching keys are listed instead of every object under s3_path_prefix.
     """
-    bucket = s3_resource.Bucket(s3_bucket)
-    s3_paths = []
-    for obj in bucket.objects.filter(Prefix=s3_path_prefix):
-        if file_name in obj.key:
-            s3_paths.append(obj.key)
-    return s3_paths
+    s3_client = get_s3_client(s3_resource)
+    if delimiter is None:
+        objects, _ = list_s3_prefix(s3_client, s3_bucket, s3_path_prefix)
+        return [obj["Key"] for obj in objects if file_name in obj["Key"]]
+    _, folders = list_s3_prefix(s3_client, s3_bucket, s3_path_prefix, delimiter=delimiter)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(folders) + 1))) as executor:
+        listings = executor.map(lambda folder: list_s3_prefix(s3_client, s3_bucket, folder + file_name, delimiter=delimiter)[0],
+                                [s3_path_prefix] + folders)
+        return sorted(obj["Key"] for objects in listings for obj in objects)
 
 def get_latest_folder(path:str, filter_substr:str=None) -> str:
     """Gets latest folder by creation time
@@ -131,26 +382,40 @@ def get_onehot_encoder_names(onehot_encoder, col_names):
             category_names.append(f"{col}_{value}")
     return category_names
     
-class NamedColumns(BaseEstimator, TransformerMixin):
-    """ 
-    Based on the df passed in in fit, filter / reformat the df in transform so the columns match
-    Fill any missing columns with default_value
-    """
+def _define_named_columns() -> type:
+    from sklearn.base import BaseEstimator, TransformerMixin
 
-    def __init__(self, default_value = 0):
-        self.cols = None
-        self.default_value = default_value
+    class NamedColumns(BaseEstimator, TransformerMixin):
+        """ 
+        Based on the df passed in in fit, filter / reformat the df in transform so the columns match
+        Fill any missing columns with default_value
+        """
 
-    def fit(self, X: pd.DataFrame, y: pd.Series):
-        self.cols = X.columns
-        return self
+        def __init__(self, default_value = 0):
+            self.cols = None
+            self.default_value = default_value
 
-    def transform(self, X:pd.DataFrame):
-        ret_df = pd.DataFrame(self.default_value, index=X.index, columns=self.cols)
-        for col in self.cols:
-            if col in X.columns:
-                ret_df[col] = X[col]
-        return ret_df
+        def fit(self, X: pd.DataFrame, y: pd.Series):
+            self.cols = X.columns
+            return self
+
+        def transform(self, X:pd.DataFrame):
+            ret_df = pd.DataFrame(self.default_value, index=X.index, columns=self.cols)
+            for col in self.cols:
+                if col in X.columns:
+                    ret_df[col] = X[col]
+            return ret_df
+
+    # So that instances pickle as utils.NamedColumns
+    NamedColumns.__qualname__ = "NamedColumns"
+    return NamedColumns
+
+def __getattr__(name: str):
+    # NamedColumns subclasses sklearn classes, so it is defined (and sklearn imported) on first access
+    if name == "NamedColumns":
+        globals()["NamedColumns"] = _define_named_columns()
+        return globals()["NamedColumns"]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 if __name__ == "__main__":
     assert parse_s3_path("s3://bucket/location.txt") == ("bucket", "location.txt")
@@ -158,3 +423,41 @@ if __name__ == "__main__":
     assert parse_s3_path("s3://bucket/folder/location.txt") == ("bucket", "folder/location.txt")
     assert parse_s3_path("s3://bucket/folder/") == ("bucket", "folder/")
     assert parse_s3_path("s3://bucket/folder/subfolder/file.txt") == ("bucket", "folder/subfolder/file.txt")
+
+    # s3 helpers, on the filesystem backed client
+    import tempfile
+    import numpy as np
+    from local_s3 import LocalS3Client
+    with tempfile.TemporaryDirectory() as folder:
+        s3 = LocalS3Client(os.path.join(folder, "s3"))
+        payload = bytes(range(256)) * 100
+        with S3MultipartWriter(s3, "bucket", "run_1/blob.bin", part_size=1000, max_workers=2) as writer:
+            for start in range(0, len(payload), 700):
+                writer.write(payload[start:start + 700])
+        assert s3.head_object(Bucket="bucket", Key="run_1/blob.bin")["ETag"].endswith('-26"')
+        assert bytes(read_s3_object(s3, "bucket", "run_1/blob.bin", part_size=999, max_workers=3)) == payload
+        try:
+            with S3MultipartWriter(s3, "bucket", "run_1/aborted.bin", part_size=1000) as writer:
+                writer.write(payload)
+                raise RuntimeError("abort")
+        except RuntimeError:
+            pass
+        assert "run_1/aborted.bin" not in [obj["Key"] for obj in list_s3_prefix(s3, "bucket", "run_1/")[0]]
+
+        df = pd.DataFrame({"user": np.arange(1000), "touch": ["email", "ads"] * 500})
+        pd_to_parquet_s3(df, "bucket", "run_1/values.parquet", s3)
+        pd_to_parquet_s3(df.head(10), "bucket", "run_2/values.parquet", s3)
+        pd_to_csv_s3(df, "bucket", "run_2/nested/values.csv", s3, header=True, chunk_rows=300)
+        assert read_parquet_from_s3("bucket", "run_1/values.parquet", s3).equals(df)
+        assert read_csv_from_s3("bucket", "run_2/nested/values.csv", s3, header=0).equals(df)
+        assert [len(chunk) for chunk in read_csv_from_s3("bucket", "run_2/nested/values.csv", s3, header=0, chunksize=400)] == [400, 400, 200]
+
+        objects, folders = list_s3_prefix(s3, "bucket", "", delimiter="/")
+        assert (objects, folders) == ([], ["run_1/", "run_2/"])
+        assert get_s3_paths_by_file_name("bucket", "", "values", s3) == ["run_1/values.parquet", "run_2/nested/values.csv", "run_2/values.parquet"]
+        assert get_s3_paths_by_file_name("bucket", "", "values", s3, delimiter="/") == ["run_1/values.parquet", "run_2/values.parquet"]
+
+        local_path = os.path.join(folder, "local")
+        assert len(download_s3_prefix(s3, "bucket", "run_2/", local_path, flatten=False)) == 2
+        assert download_s3_prefix(s3, "bucket", "run_2/", local_path, flatten=False) == []
+        assert pd.read_parquet(os.path.join(local_path, "values.parquet")).equals(df.head(10))
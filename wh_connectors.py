@@ -1,13 +1,24 @@
 import os
+import json
+import time
+import uuid
+import atexit
+import hashlib
+import tempfile
+import threading
 import pandas as pd
 
+from typing import Iterator, Union, Dict
+
 from sqlalchemy.engine.url import URL
 from sqlalchemy import orm as sa_orm
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
 
 import redshift_connector
 import pandas_redshift as pr
 
+from staging import DEFAULT_ROWS_PER_PART, DEFAULT_UPLOAD_WORKERS, write_parquet_parts, FilesystemStage, S3Stage, SnowflakeTableStage
+
 class ConnectorBase:
     def __init__(self, creds: dict, db_config: dict, aws_config: dict):
         self.creds = creds
@@ -26,13 +37,140 @@ class ConnectorBase:
             df = pd.DataFrame(columns=columns)
         return df
 
+    def execute_streaming(self, query: str):
+        """Executes the query with a server side cursor, so that rows are fetched from the warehouse only as they are consumed"""
+        return self.connection.execution_options(stream_results=True).execute(query)
+
+    def run_query_iter(self, query: str, chunksize: int = 100000, as_arrow: bool = False) -> Iterator[Union[pd.DataFrame, "pyarrow.RecordBatch"]]:
+        """Runs the query and yields the results in chunks, instead of fetching all the rows at once as in run_query.
+        Peak memory is bounded by the chunk size and not by the result size.
+
+        Args:
+            query (str): Query to run
+            chunksize (int, optional): Max no:of rows per chunk. Defaults to 100000.
+            as_arrow (bool, optional): If True, yields pyarrow RecordBatches instead of DataFrames. Defaults to False.
+
+        Yields:
+            Iterator[Union[pd.DataFrame, pyarrow.RecordBatch]]: Result chunks, with the same columns as run_query. An empty result yields
+             one empty chunk, so the columns are known.
+        """
+        query_result = self.execute_streaming(query)
+        columns = list(query_result.keys())
+        try:
+            n_chunks = 0
+            while True:
+                rows = query_result.fetchmany(chunksize)
+                if not rows and n_chunks > 0:
+                    break
+                n_chunks += 1
+                df = pd.DataFrame(rows, columns=columns)
+                if as_arrow:
+                    import pyarrow as pa
+                    yield pa.RecordBatch.from_pandas(df, preserve_index=False)
+                else:
+                    yield df
+        finally:
+            query_result.close()
+
     def write_to_table(self, df: pd.DataFrame, table_name: str, schema: str = None, if_exists: str = "append"):
         raise NotImplementedError()
 
-    def __del__(self):
-        self.connection.close()
+    def default_stage(self, table_name: str, schema: str = None):
+        """Stage used by bulk_write when none is given"""
+        raise NotImplementedError()
+
+    def copy_from_stage(self, connection, table_name: str, schema: str, stage, prefix: str) -> None:
+        """Loads the parquet files staged under prefix into the table, on the given (transactional) connection.
+        This generic version reads the files of a FilesystemStage back and inserts them, as a stand-in for the warehouse's COPY.
+        """
+        if not isinstance(stage, FilesystemStage):
+            raise NotImplementedError(f"{type(self).__name__} can not load from {type(stage).__name__}")
+        for path in stage.list(prefix):
+            pd.read_parquet(path).to_sql(table_name, connection, schema=schema, if_exists="append", index=False, chunksize=10000)
+
+    def align_to_table_columns(self, df: pd.DataFrame, table_name: str, schema: str = None) -> pd.DataFrame:
+        """Reorders df's columns to the column order of the existing table, as some COPYs (ex: Redshift from parquet) match the
+        columns by position and not by name. Column names are compared case insensitively, as the warehouses fold the case.
+        Raises ValueError if df and the table do not have the same columns.
+        """
+        table_columns = [column["name"] for column in inspect(self.engine).get_columns(table_name, schema=schema)]
+        df_columns = {str(column).lower(): column for column in df.columns}
+        missing = [column for column in table_columns if column.lower() not in df_columns]
+        extra = sorted(set(df_columns) - {column.lower() for column in table_columns})
+        if missing or extra:
+            qualified_name = f"{schema}.{table_name}" if schema else table_name
+            raise ValueError(f"Columns of the rows do not match the table {qualified_name}. Missing: {missing}, not in the table: {extra}")
+        return df[[df_columns[column.lower()] for column in table_columns]]
+
+    def bulk_write(self,
+                   df: pd.DataFrame,
+                   table_name: str,
+                   schema: str = None,
+                   run_id: str = None,
+                   run_id_column: str = "run_id",
+                   stage=None,
+                   rows_per_part: int = DEFAULT_ROWS_PER_PART,
+                   max_workers: int = DEFAULT_UPLOAD_WORKERS) -> None:
+        """
+        Writes df to the table with a bulk load: df is staged as compressed parquet parts (written and uploaded in parallel), and
+        loaded with a single COPY. The table is created from df's columns if it does not exist.
+        If run_id is given, it is added as the run_id_column, and rows of the same run_id already in the table are replaced in the same
+        transaction as the load. So writing the results of a run again (ex: a retried job) does not duplicate them.
+
+        :param df: Rows to write.
+        :param table_name: Table name, optionally as schema.table.
+        :param run_id: Id of the run the rows belong to.
+        :param stage: FilesystemStage, S3Stage or SnowflakeTableStage. Defaults to the connector's default_stage.
+        """
+        table_name, schema = table_name.split('.') if '.' in table_name else (table_name, schema)
+        if run_id is not None:
+            df = df.assign(**{run_id_column: str(run_id)})
+        stage = stage if stage is not None else self.default_stage(table_name, schema)
+        prefix = f"{table_name}/{run_id if run_id is not None else uuid.uuid4().hex}"
+        print("Bulk writing {} rows to table: {}.{}".format(len(df), schema, table_name))
+        df.head(0).to_sql(table_name, self.engine, schema=schema, if_exists="append", index=False)
+        df = self.align_to_table_columns(df, table_name, schema)
+        with tempfile.TemporaryDirectory() as folder:
+            paths = write_parquet_parts(df, folder, rows_per_part, max_workers)
+            stage.upload(paths, prefix, max_workers)
+        try:
+            with self.engine.begin() as connection:
+                if run_id is not None:
+                    qualified_name = f"{schema}.{table_name}" if schema else table_name
+                    connection.execute(text(f"delete from {qualified_name} where {run_id_column} = :run_id"), {"run_id": str(run_id)})
+                self.copy_from_stage(connection, table_name, schema, stage, prefix)
+        finally:
+            stage.remove(prefix)
+
+    def is_healthy(self) -> bool:
+        """Checks that the connection is still usable, with a round trip to the warehouse"""
+        if self.connection is None:
+            return False
+        try:
+            self.connection.execute("select 1")
+            return True
+        except Exception:
+            return False
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
         if self.engine is not None:
             self.engine.dispose()
+            self.engine = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
 
 class SnowflakeConnector(ConnectorBase):
     def __init__(self, creds: dict, db_config:dict, aws_config:dict) -> None:
@@ -46,14 +184,47 @@ class SnowflakeConnector(ConnectorBase):
                     url += f"?warehouse={creds['warehouse']}"
                     if 'role' in creds:
                         url += f"&role={creds['role']}"
-        self.engine = create_engine(url)
+        # pool_pre_ping checks pooled connections before handing them out, so a reused engine survives dropped connections
+        self.engine = create_engine(url, pool_pre_ping=True)
         self.connection = self.engine.connect()
 
+    def run_query_iter(self, query: str, chunksize: int = 100000, as_arrow: bool = False) -> Iterator[Union[pd.DataFrame, "pyarrow.RecordBatch"]]:
+        """Same as ConnectorBase.run_query_iter, using Snowflake's native Arrow result batches instead of python row tuples.
+        Snowflake decides the size of the result batches it sends. They are re-sliced to at most chunksize rows.
+        """
+        import pyarrow as pa
+        # Same column name normalization as sqlalchemy: Snowflake's case insensitive (upper case) names are lower cased
+        normalize = lambda name: name.lower() if name.isupper() else name
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.execute(query)
+            n_batches = 0
+            for table in cursor.fetch_arrow_batches():
+                for batch in table.rename_columns([normalize(name) for name in table.column_names]).to_batches(max_chunksize=chunksize):
+                    n_batches += 1
+                    yield batch if as_arrow else batch.to_pandas()
+            if n_batches == 0:
+                # No result batches for an empty result. The columns come from the cursor description instead.
+                empty = pd.DataFrame(columns=[normalize(column[0]) for column in cursor.description])
+                yield pa.RecordBatch.from_pandas(empty, preserve_index=False) if as_arrow else empty
+        finally:
+            cursor.close()
+
     def write_to_table(self, df: pd.DataFrame, table_name: str, schema: str = None, if_exists: str = "append"):
         table_name, schema = table_name.split('.') if '.' in table_name else (table_name, schema)
         print("Writing to table: {}.{}".format(schema, table_name))
         df.to_sql(table_name, self.engine, schema=schema, if_exists=if_exists, index=False)
 
+    def default_stage(self, table_name: str, schema: str = None):
+        return SnowflakeTableStage(self.connection, table_name, schema)
+
+    def copy_from_stage(self, connection, table_name: str, schema: str, stage, prefix: str) -> None:
+        if not isinstance(stage, SnowflakeTableStage):
+            return super().copy_from_stage(connection, table_name, schema, stage, prefix)
+        qualified_name = f"{schema}.{table_name}" if schema else table_name
+        connection.execute(text(f"copy into {qualified_name} from '{stage.uri(prefix)}' file_format = (type = parquet) "
+                                "match_by_column_name = case_insensitive purge = true"))
+
 class RedShiftConnector(ConnectorBase):
     def __init__(self, creds: dict, db_config:dict, aws_config:dict) -> None:
         super().__init__(creds, db_config, aws_config)
@@ -68,15 +239,20 @@ class RedShiftConnector(ConnectorBase):
         #)
 
         #self.engine = create_engine(url)
-        self.engine = create_engine(f"postgresql://{creds['user']}:{creds['password']}@{creds['host']}:{creds['port']}/{db_config['database']}")
+        self.engine = create_engine(f"postgresql://{creds['user']}:{creds['password']}@{creds['host']}:{creds['port']}/{db_config['database']}", pool_pre_ping=True)
+        self.pandas_redshift_connected = False
 
         Session = sa_orm.sessionmaker()
         Session.configure(bind=self.engine)
         self.connection = Session()
 
-    def write_to_table(self, df: pd.DataFrame, table_name: str, schema: str = None, if_exists: str = "append"):
-        table_name, schema = table_name.split('.') if '.' in table_name else (table_name, schema)
+    def execute_streaming(self, query: str):
+        return self.connection.connection(execution_options={"stream_results": True}).execute(query)
 
+    def connect_pandas_redshift(self):
+        """Connects pandas_redshift to the cluster and the s3 staging location, once per connector"""
+        if self.pandas_redshift_connected:
+            return
         pr.connect_to_redshift(
             dbname = self.db_config["database"],
             host = self.creds["host"],
@@ -99,7 +275,42 @@ class RedShiftConnector(ConnectorBase):
             # As of release 1.1.1 you are able to specify an aws_session_token (if necessary):
             # aws_session_token = <aws_session_token>
         )
-        
+        self.pandas_redshift_connected = True
+
+    def close(self):
+        if getattr(self, "pandas_redshift_connected", False):
+            pr.close_up_shop()
+            self.pandas_redshift_connected = False
+        super().close()
+
+    def default_stage(self, table_name: str, schema: str = None):
+        """Same s3 location as the one pandas_redshift stages its csv files in"""
+        import boto3
+        s3_bucket = self.creds.get("s3Bucket", None)
+        s3_bucket = s3_bucket if s3_bucket is not None else self.aws_config["s3Bucket"]
+        s3_sub_dir = self.creds.get("s3SubDirectory", None)
+        s3_sub_dir = s3_sub_dir if s3_sub_dir is not None else self.aws_config.get("s3SubDirectory")
+        s3_client = boto3.client("s3",
+                                 aws_access_key_id=self.aws_config["access_key_id"],
+                                 aws_secret_access_key=self.aws_config["access_key_secret"],
+                                 region_name=self.aws_config.get("region"))
+        return S3Stage(s3_bucket, s3_sub_dir, s3_client)
+
+    def copy_from_stage(self, connection, table_name: str, schema: str, stage, prefix: str) -> None:
+        if not isinstance(stage, S3Stage):
+            return super().copy_from_stage(connection, table_name, schema, stage, prefix)
+        qualified_name = f"{schema}.{table_name}" if schema else table_name
+        # Parquet columns are matched by position. bulk_write has already put the staged columns in the table's order
+        if "iam_role" in self.creds:
+            authorization = f"iam_role '{self.creds['iam_role']}'"
+        else:
+            authorization = f"access_key_id '{self.aws_config['access_key_id']}' secret_access_key '{self.aws_config['access_key_secret']}'"
+        connection.execute(text(f"copy {qualified_name} from '{stage.uri(prefix)}' {authorization} format as parquet"))
+
+    def write_to_table(self, df: pd.DataFrame, table_name: str, schema: str = None, if_exists: str = "append"):
+        table_name, schema = table_name.split('.') if '.' in table_name else (table_name, schema)
+        self.connect_pandas_redshift()
+
         # Write the DataFrame to S3 and then to redshift
         pr.pandas_to_redshift(
             data_frame = df,
@@ -131,3 +342,57 @@ def Connector(config: dict, aws_config: dict = None) -> ConnectorBase:
 
     connector = connector(creds, config, aws_config)
     return connector
+
+
+# Process wide registry of connectors, so that workflows running several queries reuse one engine (and its connection pool)
+# instead of paying connection and auth latency on every call.
+_connector_registry: Dict[str, ConnectorBase] = {}
+_connector_last_used: Dict[str, float] = {}
+_connector_registry_lock = threading.Lock()
+# A connector handed out within this many seconds of its last use is not health checked again. Connections that pool_pre_ping hands out
+# are checked by sqlalchemy, but the connector's own open connection is only checked here, after it has been idle for a while.
+HEALTH_CHECK_IDLE_SECONDS = 60
+
+def connector_key(config: dict, aws_config: dict = None) -> str:
+    """Hash of everything that identifies a connection, including credentials. Credentials themselves are not kept in the key."""
+    return hashlib.sha256(json.dumps([config, aws_config], sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+def get_pooled_connector(config: dict, aws_config: dict = None) -> ConnectorBase:
+    """
+    Returns a shared connector for the given config, creating it on first use. A cached connector that has been idle for more than
+    HEALTH_CHECK_IDLE_SECONDS is health checked before reuse, and replaced by a new one if its connection is no longer usable.
+    Pooled connectors are closed at exit, or explicitly with close_pooled_connectors. They should not be used as context managers.
+
+    :param config: A dictionary containing the connection configuration.
+    :type config: dict
+    :return: A connector object.
+    :rtype: ConnectorBase
+    """
+    key = connector_key(config, aws_config)
+    with _connector_registry_lock:
+        connector = _connector_registry.get(key)
+        now = time.monotonic()
+        is_idle = now - _connector_last_used.get(key, now) > HEALTH_CHECK_IDLE_SECONDS
+        if connector is not None and is_idle and not connector.is_healthy():
+            try:
+                connector.close()
+            except Exception:
+                pass
+            connector = None
+        if connector is None:
+            connector = Connector(config, aws_config)
+            _connector_registry[key] = connector
+        _connector_last_used[key] = now
+        return connector
+
+def close_pooled_connectors() -> None:
+    with _connector_registry_lock:
+        for connector in _connector_registry.values():
+            try:
+                connector.close()
+            except Exception:
+                pass
+        _connector_registry.clear()
+        _connector_last_used.clear()
+
+atexit.register(close_pooled_connectors)